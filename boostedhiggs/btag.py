@@ -2,8 +2,6 @@ import os
 import numpy
 import logging
 from coffea import processor, hist, util
-from coffea.lookup_tools.dense_lookup import dense_lookup
-from coffea.btag_tools import BTagScaleFactor
 
 
 logger = logging.getLogger(__name__)
@@ -64,8 +62,177 @@ class BTagEfficiency(processor.ProcessorABC):
         return a
 
 
+def efficiencyMap(btag):
+    '''Compact efficiency map of a BTagEfficiency histogram
+
+    Returns a dict with the (flavor, pt, abseta) bin ``edges`` and the ``eff`` array of
+    shape (3, nflavor, npt, nabseta) holding the nominal efficiency and the upper and lower
+    Clopper-Pearson bands.
+    '''
+    bpass = btag.integrate('btag', 'pass').values()[()]
+    ball = btag.integrate('btag').values()[()]
+    nom = bpass / numpy.maximum(ball, 1.)
+    dn, up = hist.clopper_pearson_interval(bpass, ball)
+    return {
+        'edges': [ax.edges() for ax in btag.axes()[1:]],
+        'eff': numpy.stack([nom, up, dn]),
+    }
+
+
+def efficiencyMapFiles(year, directory=None):
+    '''Paths of the (histogram, compact map) efficiency files of a year'''
+    directory = directory or os.path.join(os.path.dirname(__file__), 'data')
+    return (
+        os.path.join(directory, 'btagQCD%s.coffea' % year),
+        os.path.join(directory, 'btagEff%s.coffea' % year),
+    )
+
+
+def saveEfficiencyMap(btag, year, directory=None):
+    '''Write the BTagEfficiency histogram of a year and its compact efficiency map'''
+    histfile, mapfile = efficiencyMapFiles(year, directory)
+    util.save(btag, histfile)
+    util.save(efficiencyMap(btag), mapfile)
+    return histfile, mapfile
+
+
+def loadEfficiencyMap(year, directory=None):
+    '''Load the compact efficiency map of a year, falling back to its histogram if the map is missing'''
+    histfile, mapfile = efficiencyMapFiles(year, directory)
+    if os.path.exists(mapfile):
+        return util.load(mapfile)
+    logger.warning("No efficiency map %s, computing it from %s", mapfile, histfile)
+    return efficiencyMap(util.load(histfile))
+
+
+def _bins(edges, values):
+    # same binning as dense_lookup: under/overflow (and nan) go to the first/last bin
+    values = numpy.asarray(values, dtype=edges.dtype)
+    if len(edges) > 16:
+        return numpy.clip(numpy.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    # comparing against a few edges beats a binary search
+    out = numpy.full(values.shape, len(edges) - 2, dtype=numpy.intp)
+    for edge in edges[1:-1]:
+        out -= values < edge
+    return out
+
+
+class BTagScaleFactorTable:
+    '''BTag scale factors of one working point tabulated on a fine (flavour, abseta, pt) grid
+
+    The formulas of the CSV file are evaluated once with numpy, at both edges and the middle
+    of each pt step, and are interpolated with a parabola within the step. The pt steps include
+    all pt bin edges of the CSV file, so the interpolation never crosses a formula boundary.
+    Calling the table returns the 'central', 'up' and 'down' scale factors stacked in one array.
+
+    Parameters
+    ----------
+        filename : str
+            The BTag-formatted CSV file
+        workingpoint : str
+            The working point, one of loose, medium, tight
+        ptstep : float
+            The pt step of the grid, in GeV
+    '''
+    systematics = ('central', 'up', 'down')
+    # bump when the table layout changes, to rebuild the cached tables
+    version = 2
+    _flavor = numpy.array([0, 4, 5, 6])
+
+    def __init__(self, filename, workingpoint, ptstep=1.):
+        # imported here as it pulls in pandas, which dominates the package import time
+        from coffea.btag_tools import BTagScaleFactor
+        sf = BTagScaleFactor(filename, workingpoint)
+        corrections = [sf._corrections[syst] for syst in self.systematics]
+        self._eta = numpy.unique(numpy.concatenate([corr[0] for corr in corrections]))
+        ptedges = numpy.unique(numpy.concatenate([corr[1] for corr in corrections]))
+        self._pt = numpy.unique(numpy.concatenate([ptedges, numpy.arange(ptedges[0], ptedges[-1], ptstep)]))
+        # last grid node below each multiple of ptstep, to find the pt step without a binary search
+        self._ptstep = ptstep
+        self._ptfirst = _bins(self._pt, numpy.arange(ptedges[0], ptedges[-1] + ptstep, ptstep))
+        flavor, abseta, pt = (x.ravel() for x in numpy.meshgrid(
+            self._flavor[:-1], 0.5 * (self._eta[:-1] + self._eta[1:]), self._pt[:-1], indexing='ij'
+        ))
+        width = numpy.tile(numpy.diff(self._pt), len(pt) // (len(self._pt) - 1))
+        # quadratic in t = (pt - step edge) / step width, through the left edge, middle and right edge
+        self._coefs = numpy.empty((3, len(self.systematics), len(pt)))
+        for i, (edges_eta, edges_pt, _, mapping, formulas) in enumerate(corrections):
+            # the formula of each grid step, as BTagScaleFactor.eval would pick it (-1 if missing)
+            step = mapping[2 - _bins(self._flavor, flavor), _bins(edges_eta, abseta), _bins(edges_pt, pt), 0]
+            nodes = numpy.full((3, len(pt)), numpy.nan)
+            for iformula in numpy.unique(step[step >= 0]):
+                func = eval('lambda x: ' + formulas[iformula], {'log': numpy.log, 'sqrt': numpy.sqrt})
+                where = step == iformula
+                for k in range(3):
+                    nodes[k, where] = func(numpy.clip(pt[where] + 0.5 * k * width[where], edges_pt[0], edges_pt[-1]))
+            left, middle, right = nodes
+            self._coefs[:, i] = [left, 4 * middle - 3 * left - right, 2 * (left + right) - 4 * middle]
+
+    @classmethod
+    def fromcsv(cls, filename, workingpoint):
+        '''Load the table cached next to the CSV file, building (and caching) it if missing or outdated'''
+        cachename = '%s_%s_table.coffea' % (filename[:filename.index('.csv')], workingpoint)
+        if os.path.exists(cachename) and os.path.getmtime(cachename) >= os.path.getmtime(filename):
+            try:
+                out = util.load(cachename)
+            except Exception as ex:
+                logger.warning("Could not load the cached btag SF table %s, rebuilding it: %s", cachename, ex)
+            else:
+                if getattr(out, '_version', None) == cls.version:
+                    return out
+        out = cls(filename, workingpoint)
+        out._version = cls.version
+        # written under a unique name and moved in place, concurrent jobs never see a partial file
+        tmp = '%s.%d.tmp' % (cachename, os.getpid())
+        try:
+            util.save(out, tmp)
+            os.replace(tmp, cachename)
+        except OSError as ex:
+            logger.warning("Could not cache the btag SF table in %s: %s", cachename, ex)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return out
+
+    def __call__(self, flavor, abseta, pt):
+        '''Scale factors for the flat jet arrays, as a (systematic, jet) array'''
+        pt = numpy.clip(numpy.asarray(pt, dtype=numpy.float64), self._pt[0], self._pt[-1])
+        ipt = self._ptfirst[((pt - self._pt[0]) / self._ptstep).astype(numpy.intp)]
+        # CSV bin edges that are not multiples of ptstep split a step in two
+        while True:
+            after = pt >= self._pt[numpy.minimum(ipt + 1, len(self._pt) - 2)]
+            after &= ipt < len(self._pt) - 2
+            if not after.any():
+                break
+            ipt += after
+        index = (_bins(self._flavor, flavor) * (len(self._eta) - 1) + _bins(self._eta, abseta)) * (len(self._pt) - 1) + ipt
+        t = (pt - self._pt[ipt]) / (self._pt[ipt + 1] - self._pt[ipt])
+        c0, c1, c2 = self._coefs[:, :, index]
+        out = c0 + t * (c1 + t * c2)
+        if numpy.isnan(out).any():
+            raise ValueError('No correction was available for some items')
+        return out
+
+    def eval(self, systematic, flavor, abseta, pt):
+        '''Same interface as BTagScaleFactor.eval, for one systematic'''
+        try:
+            flavor.counts
+            jin, flavor, abseta, pt = flavor, flavor.flatten(), abseta.flatten(), pt.flatten()
+        except AttributeError:
+            jin = None
+        out = self(flavor, abseta, pt)[self.systematics.index(systematic)]
+        if jin is not None:
+            out = jin.copy(content=out)
+        return out
+
+
 class BTagCorrector:
-    def __init__(self, year, workingpoint):
+    '''Per-event b-tag weights (method 1a) with SF and efficiency variations
+
+    With ``compiled=True`` the scale factors come from a ``BTagScaleFactorTable``
+    cached in the data directory, otherwise the CSV formulas are evaluated per call.
+    The efficiencies come from the compact map of the year (see ``saveEfficiencyMap``).
+    '''
+    def __init__(self, year, workingpoint, compiled=True):
         self._year = year
         self._wp = BTagEfficiency.btagWPs[year][workingpoint]
         files = {
@@ -74,58 +241,65 @@ class BTagCorrector:
             '2018': 'DeepCSV_102XSF_V1.csv.gz',
         }
         filename = os.path.join(os.path.dirname(__file__), 'data', files[year])
-        self.sf = BTagScaleFactor(filename, workingpoint)
-        files = {
-            '2016': 'btagQCD2017.coffea',
-            '2017': 'btagQCD2017.coffea',
-            '2018': 'btagQCD2017.coffea',
-        }
-        filename = os.path.join(os.path.dirname(__file__), 'data', files[year])
-        btag = util.load(filename)
-        bpass = btag.integrate('btag', 'pass').values()[()]
-        ball = btag.integrate('btag').values()[()]
-        nom = bpass / numpy.maximum(ball, 1.)
-        dn, up = hist.clopper_pearson_interval(bpass, ball)
-        self.eff = dense_lookup(nom, [ax.edges() for ax in btag.axes()[1:]])
-        self.eff_statUp = dense_lookup(up, [ax.edges() for ax in btag.axes()[1:]])
-        self.eff_statDn = dense_lookup(dn, [ax.edges() for ax in btag.axes()[1:]])
+        if compiled:
+            self.sf = BTagScaleFactorTable.fromcsv(filename, workingpoint)
+        else:
+            from coffea.btag_tools import BTagScaleFactor
+            self.sf = BTagScaleFactor(filename, workingpoint)
+        # nominal, stat. up and stat. down efficiencies in (flavor, pt, abseta) bins
+        effmap = loadEfficiencyMap(year)
+        self._effEdges = effmap['edges']
+        self._eff = effmap['eff']
+
+    def _sfs(self, flavor, abseta, pt):
+        if isinstance(self.sf, BTagScaleFactorTable):
+            return self.sf(flavor, abseta, pt)
+        return numpy.stack([self.sf.eval(syst, flavor, abseta, pt) for syst in BTagScaleFactorTable.systematics])
+
+    def _effs(self, flavor, pt, abseta):
+        flavorbin, ptbin, etabin = (_bins(edges, x) for edges, x in zip(self._effEdges, (flavor, pt, abseta)))
+        return self._eff[:, flavorbin, ptbin, etabin]
 
     def addBtagWeight(self, weights, jets):
-        abseta = abs(jets.eta)
-        passbtag = jets.btagDeepB > self._wp
+        counts = jets.counts
+        flavor = jets.hadronFlavour.flatten()
+        pt = jets.pt.flatten()
+        abseta = abs(jets.eta.flatten())
+        passbtag = jets.btagDeepB.flatten() > self._wp
 
+        sf_nom, sf_systUp, sf_systDn = self._sfs(flavor, abseta, pt)
+        eff_nom, eff_statUp, eff_statDn = self._effs(flavor, pt, abseta)
         # https://twiki.cern.ch/twiki/bin/viewauth/CMS/BTagSFMethods#1a_Event_reweighting_using_scale
-        def combine(eff, sf):
-            # tagged SF = SF*eff / eff = SF
-            tagged_sf = sf[passbtag].prod()
-            # untagged SF = (1 - SF*eff) / (1 - eff)
-            untagged_sf = ((1 - sf*eff) / (1 - eff))[~passbtag].prod()
-            return tagged_sf * untagged_sf
-
-        eff_nom = self.eff(jets.hadronFlavour, jets.pt, abseta)
-        eff_statUp = self.eff_statUp(jets.hadronFlavour, jets.pt, abseta)
-        eff_statDn = self.eff_statDn(jets.hadronFlavour, jets.pt, abseta)
-        sf_nom = self.sf.eval('central', jets.hadronFlavour, abseta, jets.pt)
-        sf_systUp = self.sf.eval('up', jets.hadronFlavour, abseta, jets.pt)
-        sf_systDn = self.sf.eval('down', jets.hadronFlavour, abseta, jets.pt)
-
-        nom = combine(eff_nom, sf_nom)
-        weights.add('btagWeight', nom, weightUp=combine(eff_nom, sf_systUp), weightDown=combine(eff_nom, sf_systDn))
-        weights.add('btagEffStat', numpy.ones_like(nom), weightUp=combine(eff_statUp, sf_nom) / nom, weightDown=combine(eff_statDn, sf_nom) / nom)
+        # all (sf, eff) combinations at once: nominal, sf up, sf down, eff up, eff down
+        sf = numpy.stack([sf_nom, sf_systUp, sf_systDn, sf_nom, sf_nom])
+        eff = numpy.stack([eff_nom, eff_nom, eff_nom, eff_statUp, eff_statDn])
+        # tagged SF = SF*eff / eff = SF
+        # untagged SF = (1 - SF*eff) / (1 - eff)
+        jetweight = numpy.where(passbtag, sf, (1 - sf*eff) / (1 - eff))
+        offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+        eventweight = numpy.ones((len(sf), len(counts)))
+        nonempty = counts > 0
+        if nonempty.any():
+            eventweight[:, nonempty] = numpy.multiply.reduceat(jetweight, offsets[:-1][nonempty], axis=1)
+        nom, systUp, systDn, statUp, statDn = eventweight
+
+        weights.add('btagWeight', nom, weightUp=systUp, weightDown=systDn)
+        weights.add('btagEffStat', numpy.ones_like(nom), weightUp=statUp / nom, weightDown=statDn / nom)
         for i in numpy.where((nom < 0.01) | (nom > 10) | numpy.isnan(nom))[0][:4]:
             jet = jets[i]
+            ijets = slice(offsets[i], offsets[i + 1])
             logger.info("Strange weight for event: %r", nom[i])
             logger.info("    jet pts: %r", jet.pt)
             logger.info("    jet etas: %r", jet.eta)
             logger.info("    jet flavors: %r", jet.hadronFlavour)
             logger.info("    jet btags: %r", jet.btagDeepB)
-            logger.info("    result eff: %r up %r down %r", eff_nom[i], eff_statUp[i], eff_statDn[i])
-            logger.info("    result sf: %r", sf_nom[i])
+            logger.info("    result eff: %r up %r down %r", eff_nom[ijets], eff_statUp[ijets], eff_statDn[ijets])
+            logger.info("    result sf: %r", sf_nom[ijets])
         return nom
 
 
 if __name__ == '__main__':
-    b = BTagCorrector('2017', 'medium')
+    b = BTagCorrector('2017', 'medium', compiled=False)
     b.sf.eval('central', numpy.array([0, 1, 2]), numpy.array([-2.3, 2., 0.]), numpy.array([20.1, 300., 10.]))
     b.sf.eval('down_uncorrelated', numpy.array([2, 2, 2]), numpy.array([-2.6, 2.9, 0.]), numpy.array([20.1, 300., 1000.]))
     import awkward as ak
@@ -133,5 +307,7 @@ if __name__ == '__main__':
     import pickle
     bb = pickle.loads(pickle.dumps(b))
     bb.sf.eval('central', ak.fromiter([[0], [1, 2]]), ak.fromiter([[-2.3], [2., 0.]]), ak.fromiter([[20.1], [300., 10.]]))
+    bc = pickle.loads(pickle.dumps(BTagCorrector('2017', 'medium')))
+    bc.sf.eval('central', ak.fromiter([[0], [1, 2]]), ak.fromiter([[-2.3], [2., 0.]]), ak.fromiter([[20.1], [300., 10.]]))
     b2 = BTagCorrector('2016', 'medium')
     b3 = BTagCorrector('2018', 'medium')
@@ -1,6 +1,16 @@
+import os
+import fcntl
+import hashlib
+import math
+import tempfile
+import time
+import warnings
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import awkward
 from uproot_methods import TLorentzVectorArray
+from coffea.processor import Weights
 
 #dataset_ordering = ['JetHT','SingleElectron','SingleMuon','MET','Tau']
 dataset_ordering = {
@@ -89,31 +99,650 @@ pd_to_trig = {
   },
 }
 
-def isOverlap(events,dataset,triggers,year):
-    trig_to_pd = {}
-    for p in dataset_ordering[year]:
-        trig_to_pd[p] = []
-    for t in triggers:
-        if t not in trig_to_pd[pd_to_trig[year][t]]:
-            trig_to_pd[pd_to_trig[year][t]].append(t)
-    overlap = np.ones(events.size, dtype='bool')
-    for p in dataset_ordering[year]:
-        if dataset.startswith(p):
-            pass_pd = np.zeros(events.size, dtype='bool')
-            for t in trig_to_pd[p]:
-                try:
-                    pass_pd = pass_pd | events.HLT[t]
-                except:
-                    pass
-            overlap = overlap & pass_pd
-            break
+class TriggerMask(object):
+    '''Channel trigger ORs, MET filter AND and primary dataset overlap removal
+
+    The trigger lists are resolved once per set of ``HLT`` branches present in the
+    file; missing paths are reported once with a warning and treated as not
+    fired, while a missing MET filter raises KeyError. All the needed ``HLT``
+    branches are stacked into one (triggers x events) boolean matrix and the
+    channel ORs and per-primary-dataset ORs are obtained together from a single
+    product with a precompiled 0/1 table.
+
+    Parameters
+    ----------
+        triggers : dict
+            channel name -> list of HLT paths (without the ``HLT_`` prefix)
+        flags : list, optional
+            ``Flag`` branches that must all pass
+        year : str, optional
+            year used to look up ``dataset_ordering`` and ``pd_to_trig`` for the overlap removal
+        overlap : list, optional
+            channels whose triggers enter the overlap removal (default: all)
+    '''
+    def __init__(self, triggers, flags=(), year=None, overlap=None):
+        self._triggers = {k: list(v) for k, v in triggers.items()}
+        self._flags = list(flags)
+        self._year = year
+        overlap = list(self._triggers) if overlap is None else overlap
+        self._overlap = []
+        for c in overlap:
+            for t in self._triggers[c]:
+                if t not in self._overlap:
+                    self._overlap.append(t)
+        self._tables = {}
+        self._reported = set()
+
+    def columns(self):
+        '''``HLT`` and ``Flag`` branches used by this mask'''
+        paths = []
+        for t in self._overlap + [t for v in self._triggers.values() for t in v]:
+            if t not in paths:
+                paths.append(t)
+        return ['HLT_' + t for t in paths] + ['Flag_' + f for f in self._flags]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_tables'] = {}
+        return state
+
+    def _report(self, kind, names):
+        new = [n for n in names if (kind, n) not in self._reported]
+        if new:
+            warnings.warn("%s not found in file, treated as not fired: %s" % (kind, ', '.join(new)))
+            self._reported.update((kind, n) for n in new)
+
+    def _table(self, events):
+        key = tuple(events.HLT.columns)
+        if key not in self._tables:
+            hlt = set(events.HLT.columns)
+            paths = []
+            for t in list(self._overlap) + [t for v in self._triggers.values() for t in v]:
+                if t in hlt and t not in paths:
+                    paths.append(t)
+            self._report('HLT', sorted(set(t for v in self._triggers.values() for t in v) - hlt))
+            if self._flags:
+                # running without a MET filter must not go unnoticed
+                missing = [f for f in self._flags if f not in events.Flag.columns]
+                if missing:
+                    raise KeyError("MET filters not found in file: %s" % ', '.join(missing))
+            for c, trigs in self._triggers.items():
+                if trigs and not any(t in hlt for t in trigs):
+                    raise ValueError("None of following triggers found in dataset:", trigs)
+            rows = list(self._triggers)
+            if self._year is not None:
+                rows += ['pd_' + pd for pd in dataset_ordering[self._year]]
+            table = np.zeros((len(rows), len(paths)), dtype=np.float32)
+            for i, c in enumerate(self._triggers):
+                for t in self._triggers[c]:
+                    if t in hlt:
+                        table[i, paths.index(t)] = 1.
+            if self._year is not None:
+                for t in self._overlap:
+                    pd = pd_to_trig[self._year][t]
+                    if t in hlt:
+                        table[rows.index('pd_' + pd), paths.index(t)] = 1.
+            self._tables[key] = (paths, rows, table, self._flags)
+        return self._tables[key]
+
+    def __call__(self, events, dataset=None):
+        '''Compute the masks for a chunk
+
+        Parameters
+        ----------
+            events : NanoEvents
+                events of the chunk
+            dataset : str, optional
+                primary dataset name; if given (data only), the overlap removal is computed
+
+        Returns a dict with one boolean mask per channel, ``met_filters`` and ``overlap``.
+        '''
+        paths, rows, table, flags = self._table(events)
+        size = events.size
+        if paths:
+            matrix = np.empty((len(paths), size), dtype=np.float32)
+            for i, t in enumerate(paths):
+                matrix[i] = np.asarray(events.HLT[t])
+            fired = np.dot(table, matrix) > 0
         else:
-            for t in trig_to_pd[p]:
+            fired = np.zeros((len(rows), size), dtype='bool')
+        out = {c: fired[i] for i, c in enumerate(self._triggers)}
+
+        met_filters = np.ones(size, dtype='bool')
+        for f in flags:
+            met_filters = met_filters & np.asarray(events.Flag[f])
+        out['met_filters'] = met_filters
+
+        overlap = np.ones(size, dtype='bool')
+        if dataset is not None:
+            pds = dataset_ordering[self._year]
+            pass_pd = fired[len(self._triggers):]
+            for i, pd in enumerate(pds):
+                if dataset.startswith(pd):
+                    overlap = pass_pd[i] & ~pass_pd[:i].any(axis=0)
+                    break
+            else:
+                overlap = ~pass_pd.any(axis=0)
+        out['overlap'] = overlap
+        return out
+
+
+# collections stored as one value per event (no n<Collection> counter branch)
+flat_collections = ['MET', 'PuppiMET', 'Pileup', 'HLT', 'Flag', 'IN', 'GRU', 'MassReg', 'PostTagger', 'LHEWeight', 'LHE']
+
+# columns only present in simulation, never to be read for data
+mc_columns = {
+    'genWeight': [],
+    'Pileup': ['nPU'],
+    'GenPart': ['pt', 'eta', 'phi', 'mass', 'pdgId', 'statusFlags', 'genPartIdxMother'],
+}
+
+
+def nanoColumns(*collections):
+    '''Expand ``{collection: [fields]}`` manifests into NanoAOD branch names
+
+    Jagged collections also get their ``n<Collection>`` counter; an empty field list
+    means a top-level branch (e.g. ``genWeight``).
+    '''
+    columns = []
+    for manifest in collections:
+        for name, fields in manifest.items():
+            if not fields:
+                branches = [name]
+            else:
+                branches = [] if name in flat_collections else ['n' + name]
+                branches += ['%s_%s' % (name, f) for f in fields]
+            columns += [b for b in branches if b not in columns]
+    return columns
+
+
+def _materialize(events, branch):
+    name, _, field = branch.partition('_')
+    if name not in events.columns or (field and field not in events[name].columns):
+        return branch
+    array = events[name][field] if field else events[name]
+    if isinstance(array, awkward.JaggedArray):
+        array = array.content
+    if isinstance(array, awkward.VirtualArray):
+        array.array
+    return None
+
+
+def prereadColumns(events, columns, workers=4):
+    '''Read the declared branches of a chunk in bulk
+
+    The branches are materialized concurrently into the NanoEvents cache, so the
+    basket requests to a remote file are issued together instead of one at a time
+    as the processor touches them. Returns the declared branches absent from the file.
+    '''
+    columns = [c for c in columns if not (c.startswith('n') and c[1:] in events.columns)]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            missing = list(pool.map(lambda c: _materialize(events, c), columns))
+    else:
+        missing = [_materialize(events, c) for c in columns]
+    return [c for c in missing if c is not None]
+
+
+def columnBytes(tree, columns, entrystart=None, entrystop=None):
+    '''Compressed bytes of the baskets of each branch overlapping ``[entrystart, entrystop)``'''
+    entrystart = 0 if entrystart is None else entrystart
+    entrystop = tree.numentries if entrystop is None else entrystop
+    branches = set(k.decode() for k in tree.keys())
+    out = {}
+    for column in columns:
+        if column not in branches:
+            continue
+        branch = tree[column]
+        out[column] = sum(
+            branch.basket_compressedbytes(i) for i in range(branch.numbaskets)
+            if branch.basket_entrystart(i) < entrystop and branch.basket_entrystop(i) > entrystart
+        )
+    return out
+
+
+class ChunkCache(object):
+    '''On-disk LRU cache of the branch arrays read for each chunk
+
+    Arrays are keyed on the NanoEvents persistent key (file uuid, tree, entry
+    range and branch) and stored as one ``.npy`` file per branch, so reruns over
+    the same remote files read from local disk instead of the network. Writes
+    are atomic and eviction is serialized with a lock file, so one directory
+    can be shared by concurrent worker processes. Eviction runs after each
+    ``store``, so the cache exceeds ``maxsize`` by at most the chunks being stored.
+
+    The arrays are exchanged through the array cache of ``NanoEvents.from_file``
+    (``events._cache``, the one ``events.materialized`` reads), which is specific
+    to coffea 0.6 and is checked on every call.
+
+    Parameters
+    ----------
+        directory : str
+            cache location on local disk
+        maxsize : int
+            size cap in bytes, least recently used arrays are evicted beyond it
+    '''
+    def __init__(self, directory, maxsize=10 * 1024**3):
+        self._directory = os.path.abspath(directory)
+        self._maxsize = maxsize
+        os.makedirs(self._directory, exist_ok=True)
+
+    @staticmethod
+    def chunkKey(events):
+        '''Persistent key of the chunk, without the branch name'''
+        key = getattr(events['run'], 'persistentkey', None)
+        # file uuid;tree;entrystart;entrystop;branch, as set by coffea 0.6 NanoEvents.from_file
+        if not isinstance(key, str) or key.count(';') != 4:
+            raise RuntimeError('ChunkCache needs NanoEvents read with coffea 0.6 NanoEvents.from_file, got the key %r' % (key,))
+        return key.rsplit(';', 1)[0]
+
+    @staticmethod
+    def _arrays(events):
+        cache = getattr(events, '_cache', None)
+        if not isinstance(cache, MutableMapping):
+            raise RuntimeError('ChunkCache needs the array cache of coffea 0.6 NanoEvents, got %r' % type(cache))
+        return cache
+
+    def _chunkdir(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, events):
+        '''Fill the NanoEvents cache with the arrays stored for this chunk, returns the branches found'''
+        key = self.chunkKey(events)
+        arrays = self._arrays(events)
+        path = self._chunkdir(key)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            if not name.endswith('.npy'):
+                continue
+            fname = os.path.join(path, name)
+            try:
+                array = np.load(fname, allow_pickle=False)
+                os.utime(fname)
+            except (OSError, ValueError):
+                # evicted by another worker in the meantime
+                continue
+            arrays['%s;%s' % (key, name[:-4])] = array
+            found.append(name[:-4])
+        return found
+
+    def store(self, events):
+        '''Write the arrays materialized for this chunk that are not on disk yet, returns the bytes written'''
+        key = self.chunkKey(events)
+        path = self._chunkdir(key)
+        written = 0
+        for k, array in list(self._arrays(events).items()):
+            chunk, _, branch = k.rpartition(';')
+            if chunk != key or not isinstance(array, np.ndarray) or array.dtype.hasobject:
+                continue
+            fname = os.path.join(path, branch + '.npy')
+            if os.path.exists(fname):
+                continue
+            os.makedirs(path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(tmp, fname)
+            written += array.nbytes
+        if written:
+            self.evict()
+        return written
+
+    def evict(self):
+        '''Remove the least recently used arrays until the cache fits in ``maxsize``, returns the size left'''
+        with open(os.path.join(self._directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for chunk in os.scandir(self._directory):
+                if not chunk.is_dir():
+                    continue
+                for entry in os.scandir(chunk.path):
+                    if not entry.name.endswith('.npy'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, fname in sorted(entries):
+                if total <= self._maxsize:
+                    break
                 try:
-                    overlap = overlap & np.logical_not(events.HLT[t])
-                except:
+                    os.remove(fname)
+                except FileNotFoundError:
                     pass
-    return overlap
+                total -= size
+            return total
+
+
+class StageTimer(object):
+    '''Accumulate the wall time spent in consecutive named stages of ``process()``
+
+    Each call to ``stage`` closes the running stage and opens the next one, and
+    ``stop`` closes the last one. Times are added to ``timing[(dataset, stage)]``,
+    so they merge across chunks and jobs like the other accumulators.
+
+    Parameters
+    ----------
+        timing : defaultdict_accumulator or None
+            output entry to fill, if None the timer does nothing
+        dataset : str
+            dataset name used in the keys
+    '''
+    def __init__(self, timing, dataset):
+        self._timing = timing
+        self._dataset = dataset
+        self._stage = None
+        self._tic = None
+
+    def stage(self, name):
+        if self._timing is None:
+            return
+        toc = time.perf_counter()
+        if self._stage is not None:
+            self._timing[(self._dataset, self._stage)] += toc - self._tic
+        self._stage = name
+        self._tic = toc
+
+    def stop(self):
+        self.stage(None)
+
+
+def printTiming(timing):
+    '''Print the stages of each dataset ranked by total wall time'''
+    datasets = sorted(set(dataset for dataset, _ in timing))
+    for dataset in datasets:
+        stages = {stage: t for (d, stage), t in timing.items() if d == dataset}
+        total = sum(stages.values())
+        print(dataset)
+        print('    %-20s %12s %8s' % ('stage', 'time [s]', 'frac'))
+        for stage in sorted(stages, key=stages.get, reverse=True):
+            print('    %-20s %12.3f %7.1f%%' % (stage, stages[stage], 100. * stages[stage] / total if total > 0 else 0.))
+        print('    %-20s %12.3f' % ('total', total))
+
+
+def singletonJagged(values):
+    '''Wrap a flat per-event column as a JaggedArray with exactly one entry per event
+
+    Equivalent to ``awkward.JaggedArray.fromiter([[v] for v in values])``, but built
+    directly from offsets so there is no Python loop over events.
+    '''
+    values = np.asarray(values)
+    return awkward.JaggedArray.fromoffsets(np.arange(values.size + 1), values)
+
+
+def decode_vid_bitmap(bitmap, level=None, skip=(7,)):
+    '''Electron cut-based ID working point from ``vidNestedWPBitmap``, ignoring some cuts
+
+    The bitmap packs one 3-bit field per cut, holding the tightest working point the
+    cut passes (0 fail, 1 veto, 2 loose, 3 medium, 4 tight)::
+
+        0 MinPtCut                         5 GsfEleHadronicOverEMEnergyScaledCut
+        1 GsfEleSCEtaMultiRangeCut         6 GsfEleEInverseMinusPInverseCut
+        2 GsfEleDEtaInSeedCut              7 GsfEleRelPFIsoScaledCut
+        3 GsfEleDPhiInCut                  8 GsfEleConversionVetoCut
+        4 GsfEleFull5x5SigmaIEtaIEtaCut    9 GsfEleMissingHitsCut
+
+    The working point passed is the minimum over the fields not in ``skip`` (by default
+    the isolation cut), computed in one pass over the flat content.
+
+    Parameters
+    ----------
+        bitmap : JaggedArray or ndarray
+            ``Electron.vidNestedWPBitmap``
+        level : int or sequence of int, optional
+            working point(s) to return the ``>= level`` masks of; if None the working point is returned
+        skip : sequence of int
+            indices of the cuts to ignore
+    '''
+    jagged = isinstance(bitmap, awkward.JaggedArray)
+    content = np.asarray(bitmap.content if jagged else bitmap)
+    shifts = np.array([3 * k for k in range(10) if k not in skip], dtype=content.dtype)
+    wp = (np.right_shift(content[:, None], shifts) & 7).min(axis=1)
+    wrap = (lambda x: bitmap.copy(content=x)) if jagged else (lambda x: x)
+    if level is None:
+        return wrap(wp)
+    if np.ndim(level) == 0:
+        return wrap(wp >= level)
+    return tuple(wrap(wp >= lvl) for lvl in level)
+
+
+def metP4(pt, phi):
+    '''MET four-vector with one (massless, eta=0) entry per event'''
+    zeros = np.zeros(len(pt))
+    return TLorentzVectorArray.from_ptetaphim(singletonJagged(pt), singletonJagged(zeros), singletonJagged(phi), singletonJagged(zeros))
+
+
+class CachedWeights(Weights):
+    '''Weights container that memoizes the event weight vectors
+
+    ``weight(modifier)`` is evaluated once per modifier and the same array is returned
+    on later calls, so regions sharing a ``Weights`` object do not each recompute the
+    product. The cache is cleared whenever a new weight is added. The returned arrays
+    are shared and must not be modified in place.
+    '''
+    def __init__(self, size, storeIndividual=False):
+        super(CachedWeights, self).__init__(size, storeIndividual)
+        self._cache = {}
+        self._version = 0
+
+    def add(self, name, weight, weightUp=None, weightDown=None, shift=False):
+        self._cache = {}
+        self._version += 1
+        super(CachedWeights, self).add(name, weight, weightUp, weightDown, shift)
+
+    def weight(self, modifier=None):
+        if modifier not in self._cache:
+            self._cache[modifier] = super(CachedWeights, self).weight(modifier)
+        return self._cache[modifier]
+
+
+class LayeredWeights(object):
+    '''Channel weights layered on top of a shared base ``CachedWeights``
+
+    Replaces ``deepcopy(weights)`` for channel-specific corrections: the base weights
+    and their systematic modifiers are used by reference, and the layer keeps its own
+    weights in a ``CachedWeights`` of its own. It is not a ``Weights`` itself, only
+    ``add``, ``weight`` and ``variations`` are provided. The event weight is the base
+    weight times the product of the layer's weights, a modifier of the layer replaces
+    a base modifier of the same name as it would in the deep-copied container.
+
+    Parameters
+    ----------
+        base : CachedWeights or LayeredWeights
+            weights shared by all the channels, may still be added to afterwards
+        storeIndividual : bool, optional
+            passed to the ``CachedWeights`` of the layer
+    '''
+    def __init__(self, base, storeIndividual=False):
+        self._base = base
+        self._layer = CachedWeights(base.weight().size, storeIndividual)
+        self._cache = {}
+        self._cacheversion = self._version
+
+    @property
+    def _version(self):
+        return (self._base._version, self._layer._version)
+
+    def add(self, name, weight, weightUp=None, weightDown=None, shift=False):
+        '''Add a weight to this layer only, same arguments as ``Weights.add``'''
+        self._layer.add(name, weight, weightUp, weightDown, shift)
+
+    def weight(self, modifier=None):
+        '''Event weight vector of the channel, see ``Weights.weight``'''
+        if self._cacheversion != self._version:
+            self._cache = {}
+            self._cacheversion = self._version
+        if modifier not in self._cache:
+            if modifier is not None and modifier in self._layer.variations:
+                self._cache[modifier] = self._base.weight() * self._layer.weight(modifier)
+            else:
+                self._cache[modifier] = self._base.weight(modifier) * self._layer.weight()
+        return self._cache[modifier]
+
+    @property
+    def variations(self):
+        '''Modifiers of the base and of the layer'''
+        return self._base.variations | self._layer.variations
+
+
+class CutflowAccumulator(object):
+    '''Fill the weighted cutflows of several regions in one pass
+
+    The cumulative selections are built incrementally: the mask of each cut is taken
+    once from ``selection.all(cut)``, each step only tests it on the events that
+    survived the previous steps, and selections with a common set of cuts are shared
+    between regions. The nominal weight vector of each distinct ``Weights`` object is
+    evaluated once, and regions sharing both weights and cuts reuse the same sum. The
+    entries are identical to summing ``weights.weight()[selection.all(*cuts)]`` for
+    each step of each region.
+
+    Parameters
+    ----------
+        regions : dict
+            region name -> ordered list of cut names
+        selection : coffea.processor.PackedSelection
+            selection holding all the cuts used in ``regions``
+        weights : dict
+            region name -> ``Weights`` object for that region
+        cumulative : bool, optional
+            if False, each cutflow entry only applies its own cut (no previous ones)
+    '''
+    def __init__(self, regions, selection, weights, cumulative=True):
+        self._regions = regions
+        self._selection = selection
+        self._weights = weights
+        self._cumulative = cumulative
+        self._selected = {}
+        self._masks = {}
+        self._weightcache = {}
+        self._sums = {}
+
+    def _mask(self, cut):
+        if cut not in self._masks:
+            self._masks[cut] = self._selection.all(cut)
+        return self._masks[cut]
+
+    def _weight(self, region):
+        w = self._weights[region]
+        if id(w) not in self._weightcache:
+            self._weightcache[id(w)] = w.weight()
+        return self._weightcache[id(w)]
+
+    def indices(self, region):
+        '''Yield (cut, key, indices of selected events) for each step of the cutflow of ``region``'''
+        allcuts = frozenset()
+        for cut in self._regions[region]:
+            if self._cumulative:
+                prev, allcuts = allcuts, allcuts | {cut}
+            else:
+                prev, allcuts = frozenset(), frozenset([cut])
+            if allcuts not in self._selected:
+                if prev:
+                    idx = self._selected[prev]
+                    self._selected[allcuts] = idx[self._mask(cut)[idx]]
+                else:
+                    self._selected[allcuts] = np.flatnonzero(self._mask(cut))
+            yield cut, allcuts, self._selected[allcuts]
+
+    def selected(self, region):
+        '''Indices of the events passing the last step of the cutflow of ``region``'''
+        idx = np.flatnonzero(self._selection.all())
+        for _, _, idx in self.indices(region):
+            pass
+        return idx
+
+    def fill(self, output, dataset, cutflows):
+        '''Add the cutflows to the output accumulator
+
+        Parameters
+        ----------
+            output : dict_accumulator
+                processor output
+            dataset : str
+                dataset name
+            cutflows : dict
+                output cutflow name -> region name
+        '''
+        for name, region in cutflows.items():
+            weight = self._weight(region)
+            output[name][dataset]['none'] += float(weight.sum())
+            for cut, key, idx in self.indices(region):
+                if (id(weight), key) not in self._sums:
+                    self._sums[(id(weight), key)] = float(weight[idx].sum())
+                output[name][dataset][cut] += self._sums[(id(weight), key)]
+
+
+class RegionFiller(object):
+    '''Fill a histogram for all regions and systematics from columns flattened once
+
+    The columns are flattened (``pad(1, clip=True).fillna(0).flatten()``) once for all
+    events, and the selected rows of every region are passed to the public ``Hist.fill``.
+    The selection of each region is computed once, and the columns of the regions with
+    the same ``group`` key are shared. The histogram contents are identical to one
+    ``hist.fill`` call per region and systematic with the columns of that region.
+
+    Parameters
+    ----------
+        regions : dict
+            region name -> list of cut names
+        selection : coffea.processor.PackedSelection
+            selection holding all the cuts used in ``regions``
+        weights : dict, optional
+            region name -> ``Weights`` object; if None the histograms are filled unweighted
+        group : callable, optional
+            region name -> key used to pick region-dependent columns (see ``fill``)
+    '''
+    def __init__(self, regions, selection, weights=None, group=None):
+        self._regions = list(regions)
+        self._weights = weights
+        self._group = group if group is not None else (lambda region: None)
+        cutflow = CutflowAccumulator(regions, selection, weights)
+        self._selected = {region: cutflow.selected(region) for region in self._regions}
+        self._flat = {}
+
+    def _column(self, val):
+        if isinstance(val, awkward.JaggedArray):
+            if id(val) not in self._flat:
+                self._flat[id(val)] = (val, val.pad(1, clip=True).fillna(0).flatten())
+            return self._flat[id(val)][1]
+        return val
+
+    def fill(self, hist, systematics=(None,), **values):
+        '''Fill ``hist`` for every region
+
+        Parameters
+        ----------
+            hist : coffea.hist.Hist
+                histogram with a ``region`` category axis and at least one dense axis
+            systematics : iterable, optional
+                weight modifiers; written to the ``systematic`` axis (None as 'nominal') if present
+            ``**values``
+                literals for the other sparse axes, and per-event columns for the dense axes.
+                A column may be a dict mapping the ``group`` key of a region to its column.
+        '''
+        dense = [axis.name for axis in hist.dense_axes()]
+        hassyst = any(d.name == 'systematic' for d in hist.sparse_axes())
+        literals = {k: v for k, v in values.items() if k not in dense and k != 'region'}
+        columns = {}
+        for region in self._regions:
+            key = self._group(region)
+            if key not in columns:
+                columns[key] = {name: self._column(values[name][key] if isinstance(values[name], dict) else values[name]) for name in dense}
+        for systematic in systematics:
+            if hassyst:
+                literals['systematic'] = 'nominal' if systematic is None else systematic
+            for region in self._regions:
+                selected = self._selected[region]
+                fillargs = {name: column[selected] for name, column in columns[self._group(region)].items()}
+                if self._weights is not None:
+                    fillargs['weight'] = self._weights[region].weight(modifier=systematic)[selected]
+                hist.fill(region=region, **fillargs, **literals)
 
 
 def getParticles(events,lo_id=22,hi_id=25,flags=['fromHardProcess', 'isLastCopy']):
@@ -128,6 +757,89 @@ def getParticles(events,lo_id=22,hi_id=25,flags=['fromHardProcess', 'isLastCopy'
 def getBosons(events):
     return getParticles(events)
 
+class PairMatcher(object):
+    '''Delta phi and delta R reductions over all (left, right) pairs of each event
+
+    Replaces ``left.cross(right, nested=True)`` when only the angular distances are
+    needed: the pairs are index arrays into the flat eta and phi columns, so no pair
+    table of the collections is built. Pairs are ordered as in the cross product,
+    ``left`` first. The distances are computed as in ``TLorentzVectorArray``, and the
+    per-pair values are cached by metric.
+
+    Parameters
+    ----------
+        left : JaggedArray
+            collection with ``eta`` and ``phi``, the reductions have its structure
+        right : JaggedArray
+            collection with ``eta`` and ``phi`` and the same number of events
+    '''
+    metrics = ('dphi', 'dr')
+
+    def __init__(self, left, right):
+        self._left = left
+        self._right = right
+        nleft = left.counts
+        nright = right.counts
+        # pairs of each left object, and the flat left and right indices of each pair
+        self._npairs = np.repeat(nright, nleft)
+        self._pairoffsets = np.cumsum(self._npairs) - self._npairs
+        self._ileft = np.repeat(np.arange(len(self._npairs)), self._npairs)
+        self._rstart = np.repeat(np.cumsum(nright) - nright, nleft)
+        self._iright = np.arange(self._npairs.sum()) - np.repeat(self._pairoffsets - self._rstart, self._npairs)
+        self._counts = nleft * nright
+        self._cache = {}
+
+    def values(self, metric='dr'):
+        '''Flat ``abs(delta_phi)`` (``'dphi'``) or ``delta_r`` (``'dr'``) of every pair'''
+        if metric not in self._cache:
+            if metric not in self.metrics:
+                raise ValueError("Unknown metric %r, expected one of %s" % (metric, ', '.join(self.metrics)))
+            if 'phi' not in self._cache:
+                phi = (self._left.phi.flatten()[self._ileft] - self._right.phi.flatten()[self._iright] + math.pi) % (2*math.pi) - math.pi
+                self._cache['phi'] = phi
+            phi = self._cache['phi']
+            if metric == 'dphi':
+                self._cache[metric] = np.abs(phi)
+            else:
+                deta = self._left.eta.flatten()[self._ileft] - self._right.eta.flatten()[self._iright]
+                # np.power rather than **, which numpy turns into np.square, as for JaggedArrays
+                self._cache[metric] = np.sqrt(np.power(deta, 2) + np.power(phi, 2))
+        return self._cache[metric]
+
+    def pairs(self, metric='dr'):
+        '''Distance of every pair, jagged by event like ``left.cross(right)``'''
+        return awkward.JaggedArray.fromcounts(self._counts, self.values(metric))
+
+    def _reduce(self, ufunc, values, identity):
+        out = np.full(len(self._npairs), identity, dtype=values.dtype)
+        nonempty = self._npairs > 0
+        if nonempty.any():
+            out[nonempty] = ufunc.reduceat(values, self._pairoffsets[nonempty])
+        return awkward.JaggedArray.fromcounts(self._left.counts, out)
+
+    def min(self, metric='dr'):
+        '''Distance of each left object to the closest right object, inf if there is none'''
+        return self._reduce(np.minimum, self.values(metric), np.inf)
+
+    def argmin(self, metric='dr', maximum=np.inf):
+        '''Index in its event of the closest right object to each left object
+
+        -1 if there is none, or if it is not closer than ``maximum``.
+        '''
+        values = self.values(metric)
+        closest = np.repeat(self.min(metric).content, self._npairs)
+        local = self._iright - self._rstart[self._ileft]
+        # first of the closest right objects, as JaggedArray.argmin
+        candidates = np.where((values == closest) & (values < maximum), local, np.iinfo(local.dtype).max)
+        out = self._reduce(np.minimum, candidates, np.iinfo(local.dtype).max)
+        out.content[out.content == np.iinfo(local.dtype).max] = -1
+        return out
+
+    def within(self, maximum, metric='dr'):
+        '''Whether each left object has a right object closer than ``maximum``'''
+        return self._reduce(np.logical_or, self.values(metric) < maximum, False)
+
+
 def match(left, right, metric, maximum=np.inf):
     '''Matching utility
 
@@ -145,51 +857,110 @@ def match(left, right, metric, maximum=np.inf):
         return lr.i1[idx]
 
 
+def matchIndex(left, right, metric='dr', maximum=np.inf):
+    '''Index matching utility, without the cross product of ``match``
+
+    For each item in ``left``, find the index of the closest item in ``right.flatten()``,
+    using ``PairMatcher`` metric ``metric``. If maximum is specified, the index is -1
+    where the metric was not smaller than it.
+    '''
+    idx = PairMatcher(left, right).argmin(metric, maximum)
+    start = np.repeat(np.cumsum(right.counts) - right.counts, left.counts)
+    return idx.copy(content=np.where(idx.content >= 0, start + idx.content, -1))
+
+
+def _matchedChildId(candidates, bosons, maxdR):
+    '''abs(pdgId) of the children of the boson matched to each candidate, and where there is one'''
+    idx = matchIndex(candidates, bosons, 'dr', maxdR).content
+    matched = idx >= 0
+    return abs(bosons.flatten()[idx[matched]].children.pdgId), matched
+
+
 def matchedBosonFlavor(candidates, bosons, maxdR=0.8):
-    matched = match(candidates, bosons, lambda a, b: a.delta_r(b), maxdR)
-    childid = abs(matched.children.pdgId)
-    genflavor = (childid == 5).any() * 3 + (childid == 4).any() * 2 + (childid < 4).all() * 1
-    return genflavor.fillna(0)
+    childid, matched = _matchedChildId(candidates, bosons, maxdR)
+    genflavor = np.zeros(len(matched), dtype=np.int64)
+    genflavor[matched] = (childid == 5).any() * 3 + (childid == 4).any() * 2 + (childid < 4).all() * 1
+    return awkward.JaggedArray.fromcounts(candidates.counts, genflavor)
 
 def matchedBosonFlavorLep(candidates, bosons, maxdR=0.8):
-    matched = match(candidates, bosons, lambda a, b: a.delta_r(b), maxdR)
-    childid = abs(matched.children.pdgId)
-    genflavor = (childid == 13).any() * 3 + (childid == 11).any() * 2 + (childid == 15).any() * 1 + ((childid != 15) & (childid != 13) & (childid != 11)).all() * 0
-    return genflavor.fillna(0)
+    childid, matched = _matchedChildId(candidates, bosons, maxdR)
+    genflavor = np.zeros(len(matched), dtype=np.int64)
+    genflavor[matched] = (childid == 13).any() * 3 + (childid == 11).any() * 2 + (childid == 15).any() * 1 + ((childid != 15) & (childid != 13) & (childid != 11)).all() * 0
+    return awkward.JaggedArray.fromcounts(candidates.counts, genflavor)
+
+
+# (GenVisTau, electron, muon) multiplicities of each H->tautau decay code
+_htautau_decays = [(2, 0, 0), (1, 1, 0), (1, 0, 1), (0, 1, 1), (0, 2, 0), (0, 0, 2)]
+
+
+def _hadTauDecay(status):
+    '''GenVisTau decay mode category: 1 for 1 prong, 2 for 1 prong + pi0s, 3 for 3 prongs, 0 otherwise'''
+    out = np.zeros(status.shape, dtype=np.int64)
+    out[status == 0] = 1
+    out[(status == 1) | (status == 2)] = 2
+    out[(status == 10) | (status == 11)] = 3
+    return out
 
 
 def getHTauTauDecayInfo(events,mod=False):
-    #print('genvistau pt')
-    #print(events.GenVisTau.pt)
-    #print('genvistau parent id')
-    #print(events.GenVisTau.parent.pdgId)
-    #print('genvistau id')
-    #print(events.GenVisTau.parent.children.pdgId)
-    #genvistau_higgs = events.GenVisTau[events.GenVisTau.parent.pdgId==25]
-    genvistau_higgs = events.GenVisTau
-    ngenvistau_higgs = (genvistau_higgs.pt.fillna(0.)>0.).sum()
-    el_taus = getParticles(events,11,11,['isDirectTauDecayProduct'])
-    mu_taus = getParticles(events,13,13,['isDirectTauDecayProduct'])
-    nel_taus = (el_taus.pt.fillna(0.)>0.).sum()
-    nmu_taus = (mu_taus.pt.fillna(0.)>0.).sum()
-    tau_pt = awkward.concatenate([genvistau_higgs.pt, el_taus.pt, mu_taus.pt], axis=1).pad(2, clip=True)
-    tau_eta = awkward.concatenate([genvistau_higgs.eta, el_taus.eta, mu_taus.eta], axis=1).pad(2, clip=True)
-    tau_phi = awkward.concatenate([genvistau_higgs.phi, el_taus.phi, mu_taus.phi], axis=1).pad(2, clip=True)
-    tau_mass = awkward.concatenate([genvistau_higgs.mass, el_taus.mass, mu_taus.mass], axis=1).pad(2, clip=True)
-    tau_p4 = TLorentzVectorArray.from_ptetaphim(tau_pt.fillna(0),tau_eta.fillna(0),tau_phi.fillna(0),tau_mass.fillna(0))
-    tau_pair = tau_p4.cross(tau_p4)
-    tau_pair_dr = tau_pair.i0.delta_r(tau_pair.i1)
-    genvistau1_decay = genvistau_higgs[:,0:1].status.pad(1,clip=True).fillna(15).flatten()
-    genvistau2_decay = genvistau_higgs[:,1:2].status.pad(1,clip=True).fillna(15).flatten()
-    genHTauTauDecay = np.zeros_like(ngenvistau_higgs)
-    genHadTau1Decay = np.zeros_like(ngenvistau_higgs)
-    genHadTau2Decay = np.zeros_like(ngenvistau_higgs)
-    genHTauTauDecay = np.zeros_like(ngenvistau_higgs) + 1*np.array((ngenvistau_higgs==2) & (nel_taus==0) & (nmu_taus==0)).astype(int) + 2*np.array((ngenvistau_higgs==1) & (nel_taus==1) & (nmu_taus==0)).astype(int) + 3*np.array((ngenvistau_higgs==1) & (nel_taus==0) & (nmu_taus==1)).astype(int) + 4*np.array((ngenvistau_higgs==0) & (nel_taus==1) & (nmu_taus==1)).astype(int) + 5*np.array((ngenvistau_higgs==0) & (nel_taus==2) & (nmu_taus==0)).astype(int) + 6*np.array((ngenvistau_higgs==0) & (nel_taus==0) & (nmu_taus==2)).astype(int)
+    '''Generator-level H->tautau decay category and hadronic tau decay modes
+
+    The decay code is 1 (hadhad), 2 (hadel), 3 (hadmu), 4 (elmu), 5 (elel), 6 (mumu) or 0,
+    from the GenVisTau and tau decay electron and muon multiplicities. It is signed by
+    (multiplied by, if ``mod``) whether the first two of those objects are within dR < 0.8
+    and have pt > 25. The decay modes are the ``_hadTauDecay`` of the first two GenVisTau.
+
+    All quantities are computed from the flat GenVisTau and GenPart columns.
+    '''
+    nevents = len(events)
+    vistau = events.GenVisTau
+    absid = np.abs(events.GenPart.pdgId.flatten())
+    direct = events.GenPart.hasFlags(['isDirectTauDecayProduct']).flatten()
+    genpart_event = np.repeat(np.arange(nevents), events.GenPart.counts)
+    # (event, pt, eta, phi) of the visible taus, then the electrons and muons from tau decays
+    sources = [(np.repeat(np.arange(nevents), vistau.counts), vistau.pt.flatten(), vistau.eta.flatten(), vistau.phi.flatten())]
+    for pdgid in (11, 13):
+        sel = (absid == pdgid) & direct
+        sources.append((genpart_event[sel],) + tuple(getattr(events.GenPart, key).flatten()[sel] for key in ('pt', 'eta', 'phi')))
+
+    # pt, eta and phi of the first two objects of the concatenated [taus, electrons, muons] lists
+    dtype = np.result_type(*(src[1] for src in sources))
+    pt = np.full((nevents, 2), np.nan, dtype=dtype)
+    eta = np.zeros((nevents, 2), dtype=dtype)
+    phi = np.zeros((nevents, 2), dtype=dtype)
+    offset = np.zeros(nevents, dtype=np.int64)
+    npositive = []
+    for event, src_pt, src_eta, src_phi in sources:
+        counts = np.bincount(event, minlength=nevents)
+        npositive.append(np.bincount(event[src_pt > 0.], minlength=nevents))
+        position = np.arange(len(event)) - (np.cumsum(counts) - counts)[event] + offset[event]
+        first = position < 2
+        pt[event[first], position[first]] = src_pt[first]
+        eta[event[first], position[first]] = src_eta[first]
+        phi[event[first], position[first]] = src_phi[first]
+        offset += counts
+
+    genHTauTauDecay = np.zeros(nevents, dtype=np.int64)
+    for code, multiplicities in enumerate(_htautau_decays, 1):
+        genHTauTauDecay[np.logical_and.reduce([n == m for n, m in zip(npositive, multiplicities)])] = code
+    # the pair is tested in both orders, as the float32 delta phi is not symmetric
+    close = np.zeros(nevents, dtype=bool)
+    for i, j in ((0, 1), (1, 0)):
+        dphi = (phi[:, i] - phi[:, j] + np.pi) % (2*np.pi) - np.pi
+        dr = np.sqrt((eta[:, i] - eta[:, j])**2 + dphi**2)
+        close |= (dr < 0.8) & (dr > 0.)
+    # missing objects do not fail the pt requirement
+    close &= ~(pt <= 25.).any(axis=1)
     if mod:
-        genHTauTauDecay = genHTauTauDecay * np.array(((tau_pair_dr<0.8) & (tau_pair_dr>0.)).any() & (tau_pt[:,:2]>25.).all()).astype(float)
+        genHTauTauDecay = genHTauTauDecay * close.astype(float)
     else:
-        genHTauTauDecay = genHTauTauDecay * (2*np.array(((tau_pair_dr<0.8) & (tau_pair_dr>0.)).any() & (tau_pt[:,:2]>25.).all()).astype(float)-1)
-    genHadTau1Decay = np.zeros_like(genvistau1_decay) + 1*np.array((genvistau1_decay==0)).astype(int) + 2*np.array((genvistau1_decay==1)  | (genvistau1_decay==2)).astype(int) + 3*np.array((genvistau1_decay==10) | (genvistau1_decay==11)).astype(int)
-    genHadTau2Decay = np.zeros_like(genvistau2_decay) + 1*np.array((genvistau2_decay==0)).astype(int) + 2*np.array((genvistau2_decay==1)  | (genvistau2_decay==2)).astype(int) + 3*np.array((genvistau2_decay==10) | (genvistau2_decay==11)).astype(int)
-    return genHTauTauDecay, genHadTau1Decay, genHadTau2Decay
+        genHTauTauDecay = genHTauTauDecay * (2*close.astype(float)-1)
+
+    status = vistau.status.flatten()
+    starts = np.cumsum(vistau.counts) - vistau.counts
+    genvistau_decay = [np.full(nevents, 15, dtype=status.dtype) for _ in range(2)]
+    for i, decay in enumerate(genvistau_decay):
+        has = vistau.counts > i
+        decay[has] = status[starts[has] + i]
+    return genHTauTauDecay, _hadTauDecay(genvistau_decay[0]), _hadTauDecay(genvistau_decay[1])
 
@@ -1,13 +1,12 @@
 import os
+import functools
 import numpy as np
 import awkward as ak
-from coffea.util import load
+from coffea.util import load, save
 from coffea.lookup_tools import extractor
+from coffea.lookup_tools.dense_lookup import dense_lookup
 import json
 
-compiled = load(os.path.join(os.path.dirname(__file__), 'data', 'corrections.coffea'))
-compiled_trigger = load(os.path.join(os.path.dirname(__file__), 'data', 'trig_sf_corr.coffea'))
-
 #from https://www.research-collection.ethz.ch/bitstream/handle/20.500.11850/240924/1/s10052-017-5389-1.pdf
 Vpt_corr_bins = np.array([
     30.0, 40.0, 50.0, 60.0, 70.0, 80.0, 90.0, 100.0, 110.0, 120.0, 130.0, 140.0, 150.0, 200.0, 250.0, 300.0, 350.0, 400.0, 450.0, 500.0, 550.0, 600.0, 650.0, 700.0, 750.0, 800.0, 850.0, 900.0, 950.0, 1000.0, 1100.0, 1200.0, 1300.0, 1400.0, 1600.0, 1800.0, 2000.0, 2200.0, 2400.0, 2600.0, 2800.0, 3000.0, 6500.0
@@ -54,13 +53,71 @@ lepton_sf_dict = {"elec_RECO":["egammaEffi_txt_EGM2D_runBCDEF_passingRECO.root",
                   "muon_TRIG27":["muonEff_RunBCDEF_SF_Trig_Nov17Nov2017.json","IsoMu27_PtEtaBins/pt_abseta_ratio_value","IsoMu27_PtEtaBins/pt_abseta_ratio_error",2],
                   "muon_TRIG50":["muonEff_RunBCDEF_SF_Trig_Nov17Nov2017.json","Mu50_PtEtaBins/pt_abseta_ratio_value","Mu50_PtEtaBins/pt_abseta_ratio_error",2],
 }
-ext = extractor()
+# pt range [min, max] in which a lepton SF applies, outside of it the SF is 1 with no uncertainty
+lepton_sf_ptrange = {
+    "elec_TRIG32": (None, 120.),
+    "elec_TRIG115": (120., None),
+    "muon_TRIG27": (None, 55.),
+    "muon_TRIG50": (55., None),
+}
+
+
+def _lepton_sf_evaluator():
+    ext = extractor()
+    for sfname, sfopts in lepton_sf_dict.items():
+        ext.add_weight_sets(["%s_value %s %s"%(sfname,sfopts[1],os.path.join(os.path.dirname(__file__), 'data' , sfopts[0]))])
+        ext.add_weight_sets(["%s_error %s %s"%(sfname,sfopts[2],os.path.join(os.path.dirname(__file__), 'data' , sfopts[0]))])
+    ext.finalize()
+    return ext.make_evaluator()
+
+
+class CorrectionRegistry(object):
+    '''Correction payloads loaded on first access and cached in-process
+
+    ``registry[name]`` returns the payload, built by ``loaders[name]`` the first
+    time it is requested. All payloads can be written to a single pre-compiled
+    file with ``compile`` and read back with ``use``, in which case none of the
+    source files is opened. If the ``BOOSTEDHIGGS_CORRECTIONS`` environment
+    variable points to such a file, it is used on first access.
+
+    Parameters
+    ----------
+        loaders : dict
+            payload name -> callable returning the payload
+    '''
+    def __init__(self, loaders):
+        self._loaders = loaders
+        self._payloads = {}
+        self._checked_env = False
+
+    def __getitem__(self, name):
+        try:
+            return self._payloads[name]
+        except KeyError:
+            pass
+        if not self._checked_env:
+            self._checked_env = True
+            if os.environ.get('BOOSTEDHIGGS_CORRECTIONS'):
+                self.use(os.environ['BOOSTEDHIGGS_CORRECTIONS'])
+                return self[name]
+        payload = self._payloads[name] = self._loaders[name]()
+        return payload
+
+    def compile(self, filename):
+        '''Load every payload and save them all to ``filename``'''
+        save({name: self[name] for name in self._loaders}, filename)
+
+    def use(self, filename):
+        '''Fill the cache from a file written by ``compile``'''
+        self._payloads.update(load(filename))
 
-for sfname, sfopts in lepton_sf_dict.items():
-    ext.add_weight_sets(["%s_value %s %s"%(sfname,sfopts[1],os.path.join(os.path.dirname(__file__), 'data' , sfopts[0]))])
-    ext.add_weight_sets(["%s_error %s %s"%(sfname,sfopts[2],os.path.join(os.path.dirname(__file__), 'data' , sfopts[0]))])
-ext.finalize()
-lepsf_evaluator = ext.make_evaluator()
+
+corrections = CorrectionRegistry({
+    'compiled': lambda: load(os.path.join(os.path.dirname(__file__), 'data', 'corrections.coffea')),
+    'trigger': lambda: load(os.path.join(os.path.dirname(__file__), 'data', 'trig_sf_corr.coffea')),
+    'lepton_sf': _lepton_sf_evaluator,
+    'lepton_sf_batched': lambda: LeptonSFEvaluator(corrections['lepton_sf']),
+})
 
 puW2017_nonUL = np.array([0.183454, 3.93313, 3.47111, 2.4924, 1.62495, 1.5151, 1.28791, 1.27825, 0.615845, 1.45208, 1.49768, 1.48747, 1.33116, 1.1645, 1.07901, 1.05437, 1.08066, 1.12907, 1.16584, 1.18936, 1.21284, 1.23849, 1.25967, 1.27099, 1.2727, 1.2713, 1.27087, 1.26652, 1.27449, 1.25163, 1.22131, 1.16954, 1.10903, 1.03816, 0.969432, 0.91188, 0.86681, 0.834505, 0.788379, 0.750796, 0.759152, 0.793175, 0.858347, 0.958795, 1.09432, 1.25564, 1.41965, 1.49593, 1.53054, 1.4622, 1.33676, 1.15439, 0.950556, 0.749702, 0.569789, 0.410747, 0.290007, 0.198655, 0.137644, 0.096639, 0.0692314, 0.0508587, 0.038443, 0.0299595, 0.0240949, 0.01712, 0.0124798, 0.0107683, 0.0095972, 0.00881241, 0.00830987, 0.00801759, 0.00788476, 0.0078747, 0.00633731, 0.00533369, 0.00544371, 0.00558365, 0.00574411, 0.00591599, 0.00609007, 0.00625711, 0.00640816, 0.00509462, 0.00422803, 0.00425915, 0.00426558, 0.00424666, 0.00420325, 0.00413738, 0.00405193, 0.00395019, 0.00294303, 0.00229603, 0.00220003, 0.00210138, 0.00200166, 0.00190214, 0.0018038]) #for non-UL
 notUL2017 = [
@@ -105,77 +162,160 @@ def _msoftdrop_weight(pt, eta):
     gpar = np.array([1.00626, -1.06161, 0.0799900, 1.20454])
     cpar = np.array([1.09302, -0.000150068, 3.44866e-07, -2.68100e-10, 8.67440e-14, -1.00114e-17])
     fpar = np.array([1.27212, -0.000571640, 8.37289e-07, -5.20433e-10, 1.45375e-13, -1.50389e-17])
+    pt = np.asarray(pt, dtype=np.float64)
     genw = gpar[0] + gpar[1]*np.power(pt*gpar[2], -gpar[3])
-    ptpow = np.power.outer(pt, np.arange(cpar.size))
-    cenweight = np.dot(ptpow, cpar)
-    forweight = np.dot(ptpow, fpar)
+    # evaluate both polynomials with Horner's scheme, in place
+    cenweight = np.full(pt.size, cpar[-1])
+    forweight = np.full(pt.size, fpar[-1])
+    for c, f in zip(cpar[-2::-1], fpar[-2::-1]):
+        cenweight *= pt
+        cenweight += c
+        forweight *= pt
+        forweight += f
     weight = np.where(np.abs(eta) < 1.3, cenweight, forweight)
     return genw*weight
 
 
+def _fourvector_sum(pt, eta, phi, mass, groups, size):
+    '''Cartesian sum of the (pt, eta, phi, mass) vectors with the same group index, as (px, py, pz, E)'''
+    return (
+        np.bincount(groups, pt * np.cos(phi), minlength=size),
+        np.bincount(groups, pt * np.sin(phi), minlength=size),
+        np.bincount(groups, pt * np.sinh(eta), minlength=size),
+        np.bincount(groups, np.hypot(mass, pt * np.cosh(eta)), minlength=size),
+    )
+
+
+def _subjet_msoftdrop(fatjets):
+    '''Mass of the sum of the raw (uncorrected) subjets of each fatjet
+
+    When fatjets is the full NanoEvents collection, the subjets are gathered from the flat
+    SubJet columns with the subJetIdx indices, without materializing the fatjet.subjets
+    cross-reference. Otherwise the cross-reference is flattened.
+    '''
+    array = getattr(fatjets, 'array', fatjets)
+    crossref = array.content.contents.get('subjets') if isinstance(array.content, ak.Table) else None
+    size = len(array.content)
+    if (isinstance(crossref, ak.VirtualArray) and len(crossref.args) == 2 and len(crossref.args[0][0]) == size
+            and (array.offsets[0], array.offsets[-1]) == (0, size)):
+        indices, subjets = crossref.args
+        subjets = subjets.array
+        starts = subjets.starts[array.parents]
+        subjets = subjets.content
+        flat = [np.asarray(index) for index in indices]
+        groups = np.concatenate([np.flatnonzero(index >= 0) for index in flat])
+        rows = np.concatenate([index[index >= 0] for index in flat]) + starts[groups]
+        columns = {key: np.asarray(subjets[key])[rows] for key in ('pt', 'eta', 'phi', 'mass', 'rawFactor')}
+    else:
+        subjets = fatjets.subjets.flatten()
+        size = len(subjets)
+        groups = np.repeat(np.arange(size), subjets.counts)
+        columns = {key: subjets[key].flatten() for key in ('pt', 'eta', 'phi', 'mass', 'rawFactor')}
+    # sum in double precision, the float32 columns lose the mass of light subjets in E^2 - p^2
+    pt, eta, phi, mass, rawfactor = (columns[key].astype(np.float64) for key in ('pt', 'eta', 'phi', 'mass', 'rawFactor'))
+    px, py, pz, e = _fourvector_sum(pt * (1 - rawfactor), eta, phi, mass * (1 - rawfactor), groups, size)
+    return np.sqrt(e*e - px*px - py*py - pz*pz)
+
+
 def corrected_msoftdrop(fatjets):
+    '''Corrected soft drop mass, computed once per fatjet collection and kept on it as a column'''
+    if '_memo_msdcorr' in fatjets.columns:
+        return fatjets['_memo_msdcorr']
     sf_flat = _msoftdrop_weight(fatjets.pt.flatten(), fatjets.eta.flatten())
     sf_flat = np.maximum(1e-5, sf_flat)
     try:
         # old pancakes
-        dazsle_msd = fatjets.msoftdrop_raw
+        dazsle_msd = fatjets.msoftdrop_raw.flatten()
     except AttributeError:
-        dazsle_msd = (fatjets.subjets * (1 - fatjets.subjets.rawFactor)).sum().mass
-    return dazsle_msd * ak.JaggedArray.fromoffsets(fatjets.array.offsets, sf_flat)
+        dazsle_msd = _subjet_msoftdrop(fatjets)
+    out = ak.JaggedArray.fromcounts(fatjets.counts, dazsle_msd * sf_flat)
+    try:
+        fatjets['_memo_msdcorr'] = out
+    except ValueError:
+        # fatjets is a view of the collection, nothing to keep the result on
+        pass
+    return out
 
 
 def n2ddt_shift(fatjets, year='2017'):
-    return compiled[f'{year}_n2ddt_rho_pt'](fatjets.rho, fatjets.pt)
+    return corrections['compiled'][f'{year}_n2ddt_rho_pt'](fatjets.rho, fatjets.pt)
 
 
-def add_pileup_weight(weights, nPU, year='2017', dataset=None):
+@functools.lru_cache(maxsize=None)
+def pileup_weight_table(year, dataset=None):
+    '''Pileup weights of a dataset as a dense table in the (integer) number of pileup interactions
+
+    Resolved once per (year, dataset) and process. Returns the first nPU of the table and
+    the (nominal, up, down) weights as a (3, n) array, or (1, n) when there are no variations.
+    Values of nPU outside of the table are clipped to it, as in the lookups.
+    '''
     if (year == '2017' or year == '2018') and dataset in notUL2017:
-        weights.add('pileup_weight',
-            puW2017_nonUL[np.clip(nPU,0,len(puW2017_nonUL)-1)]
-        )
-    elif year == '2017' and dataset in compiled['2017_pileupweight_dataset']:
-        weights.add(
-            'pileup_weight',
-            compiled['2017_pileupweight_dataset'][dataset](nPU),
-            compiled['2017_pileupweight_dataset_puUp'][dataset](nPU),
-            compiled['2017_pileupweight_dataset_puDown'][dataset](nPU),
-        )
+        return 0, puW2017_nonUL[None, :]
+    compiled = corrections['compiled']
+    if year == '2017' and dataset in compiled['2017_pileupweight_dataset']:
+        lookups = [compiled['2017_pileupweight_dataset%s' % var][dataset] for var in ('', '_puUp', '_puDown')]
     else:
-        weights.add(
-            'pileup_weight',
-            compiled[f'{year}_pileupweight'](nPU),
-            compiled[f'{year}_pileupweight_puUp'](nPU),
-            compiled[f'{year}_pileupweight_puDown'](nPU),
-        )
+        lookups = [compiled['%s_pileupweight%s' % (year, var)] for var in ('', '_puUp', '_puDown')]
+    edges = np.concatenate([lookup._axes for lookup in lookups])
+    if not np.array_equal(edges, np.round(edges)):
+        raise ValueError('Pileup weights of %s %s are not binned in integer nPU' % (year, dataset))
+    # every integer nPU below (above) the first (last) edge falls in the first (last) bin
+    first, last = int(edges.min()), int(edges.max())
+    npu = np.arange(first, last + 1)
+    return first, np.stack([lookup(npu) for lookup in lookups])
 
 
-def add_VJets_NLOkFactor(weights, genBosonPt, year, dataset):
+def add_pileup_weight(weights, nPU, year='2017', dataset=None):
+    first, table = pileup_weight_table(year, dataset)
+    nPU = np.asarray(nPU)
+    if not np.issubdtype(nPU.dtype, np.integer):
+        nPU = np.floor(nPU)
+    weights.add('pileup_weight', *table[:, np.clip(nPU, first, first + table.shape[1] - 1).astype(np.intp) - first])
+
+
+@functools.lru_cache(maxsize=None)
+def vjets_kfactor_table(year, dataset):
+    '''NLO k-factor of a V+jets dataset as (bin edges, values) in the generator boson pt
+
+    Resolved once per (year, dataset) and process. The QCD and EWK corrections are multiplied
+    on the union of their binnings, ``values[i]`` applies from ``edges[i]`` to ``edges[i + 1]``
+    and the first and last values below and above the edges. None if the dataset has no k-factor.
+    '''
+    compiled = corrections['compiled']
     if (year == '2017' or year == '2018') and 'ZJetsToQQ_HT' in dataset:
-        nlo_over_lo_qcd = compiled['2017_Z_nlo_qcd'](genBosonPt)
-        nlo_over_lo_ewk = compiled['Z_nlo_over_lo_ewk'](genBosonPt)
+        lookups = [compiled['2017_Z_nlo_qcd'], compiled['Z_nlo_over_lo_ewk']]
     elif (year == '2017' or year == '2018') and 'WJetsToQQ_HT' in dataset:
-        nlo_over_lo_qcd = compiled['2017_W_nlo_qcd'](genBosonPt)
-        nlo_over_lo_ewk = compiled['W_nlo_over_lo_ewk'](genBosonPt)
+        lookups = [compiled['2017_W_nlo_qcd'], compiled['W_nlo_over_lo_ewk']]
     elif year == '2016' and 'DYJetsToQQ' in dataset:
-        nlo_over_lo_qcd = compiled['2016_Z_nlo_qcd'](genBosonPt)
-        nlo_over_lo_ewk = compiled['Z_nlo_over_lo_ewk'](genBosonPt)
+        lookups = [compiled['2016_Z_nlo_qcd'], compiled['Z_nlo_over_lo_ewk']]
     elif year == '2016' and 'WJetsToQQ' in dataset:
-        nlo_over_lo_qcd = compiled['2016_W_nlo_qcd'](genBosonPt)
-        nlo_over_lo_ewk = compiled['W_nlo_over_lo_ewk'](genBosonPt)
+        lookups = [compiled['2016_W_nlo_qcd'], compiled['W_nlo_over_lo_ewk']]
     elif 'DYJetsToLL_Pt' in dataset:
-        nlo_over_lo_qcd = np.ones_like(genBosonPt.flatten())
-        nlo_over_lo_ewk = Vpt_corr_value[np.digitize(np.clip(genBosonPt.flatten(),Vpt_corr_bins[0], Vpt_corr_bins[-1]), Vpt_corr_bins)-1]
+        lookups = [dense_lookup(Vpt_corr_value, Vpt_corr_bins)]
     else:
+        return None
+    edges = np.unique(np.concatenate([lookup._axes for lookup in lookups]))
+    values = lookups[0](edges)
+    for lookup in lookups[1:]:
+        values = values * lookup(edges)
+    return edges, values
+
+
+def add_VJets_NLOkFactor(weights, genBosonPt, year, dataset):
+    table = vjets_kfactor_table(year, dataset)
+    if table is None:
         return
-    weights.add('VJets_NLOkFactor', nlo_over_lo_qcd * nlo_over_lo_ewk)
+    edges, values = table
+    genBosonPt = genBosonPt.flatten() if isinstance(genBosonPt, ak.JaggedArray) else np.asarray(genBosonPt)
+    weights.add('VJets_NLOkFactor', values[np.clip(np.searchsorted(edges, genBosonPt, side='right') - 1, 0, len(values) - 1)])
 
 
 def add_jetTriggerWeight(weights, jet_msd, jet_pt, year):
     jet_msd = jet_msd.pad(1, clip=True).fillna(0).flatten()
     jet_pt = jet_pt.pad(1, clip=True).fillna(0).flatten()
-    nom = compiled[f'{year}_trigweight_msd_pt'](jet_msd, jet_pt)
-    up = compiled[f'{year}_trigweight_msd_pt_trigweightUp'](jet_msd, jet_pt)
-    down = compiled[f'{year}_trigweight_msd_pt_trigweightDown'](jet_msd, jet_pt)
+    nom = corrections['compiled'][f'{year}_trigweight_msd_pt'](jet_msd, jet_pt)
+    up = corrections['compiled'][f'{year}_trigweight_msd_pt_trigweightUp'](jet_msd, jet_pt)
+    down = corrections['compiled'][f'{year}_trigweight_msd_pt_trigweightDown'](jet_msd, jet_pt)
     weights.add('jet_trigger', nom, up, down)
 
 def add_TriggerWeight(weights, jet_msd, jet_pt, lep_pt, year, channel):
@@ -184,55 +324,118 @@ def add_TriggerWeight(weights, jet_msd, jet_pt, lep_pt, year, channel):
     jet_pt = jet_pt.pad(1, clip=True).fillna(0).flatten()
     lep_pt = lep_pt.pad(1, clip=True).fillna(0).flatten()
     if (channel=="hadhad"):
-        nom = compiled_trigger[f'{year}_trigsf_hadhad_nom/ratio_value'](jet_pt,jet_msd)
-        up = compiled_trigger[f'{year}_trigsf_hadhad_up/ratio_value'](jet_pt,jet_msd)
-        down = compiled_trigger[f'{year}_trigsf_hadhad_down/ratio_value'](jet_pt,jet_msd)
+        nom = corrections['trigger'][f'{year}_trigsf_hadhad_nom/ratio_value'](jet_pt,jet_msd)
+        up = corrections['trigger'][f'{year}_trigsf_hadhad_up/ratio_value'](jet_pt,jet_msd)
+        down = corrections['trigger'][f'{year}_trigsf_hadhad_down/ratio_value'](jet_pt,jet_msd)
     if (channel=="hadel"):
-        nom = compiled_trigger[f'{year}_trigsf_hadel_nom/ratio_value'](jet_pt,lep_pt)
-        up = compiled_trigger[f'{year}_trigsf_hadel_up/ratio_value'](jet_pt,lep_pt)
-        down = compiled_trigger[f'{year}_trigsf_hadel_down/ratio_value'](jet_pt,lep_pt)
+        nom = corrections['trigger'][f'{year}_trigsf_hadel_nom/ratio_value'](jet_pt,lep_pt)
+        up = corrections['trigger'][f'{year}_trigsf_hadel_up/ratio_value'](jet_pt,lep_pt)
+        down = corrections['trigger'][f'{year}_trigsf_hadel_down/ratio_value'](jet_pt,lep_pt)
     if (channel=="hadmu"):
-        nom = compiled_trigger[f'{year}_trigsf_hadmu_nom/ratio_value'](jet_pt,lep_pt)
-        up = compiled_trigger[f'{year}_trigsf_hadmu_up/ratio_value'](jet_pt,lep_pt)
-        down = compiled_trigger[f'{year}_trigsf_hadmu_down/ratio_value'](jet_pt,lep_pt)
-    #up = compiled[f'{year}_trigweight_msd_pt_trigweightUp'](jet_msd, jet_pt)
-    #down = compiled[f'{year}_trigweight_msd_pt_trigweightDown'](jet_msd, jet_pt)
+        nom = corrections['trigger'][f'{year}_trigsf_hadmu_nom/ratio_value'](jet_pt,lep_pt)
+        up = corrections['trigger'][f'{year}_trigsf_hadmu_up/ratio_value'](jet_pt,lep_pt)
+        down = corrections['trigger'][f'{year}_trigsf_hadmu_down/ratio_value'](jet_pt,lep_pt)
+    #up = corrections['compiled'][f'{year}_trigweight_msd_pt_trigweightUp'](jet_msd, jet_pt)
+    #down = corrections['compiled'][f'{year}_trigweight_msd_pt_trigweightDown'](jet_msd, jet_pt)
     weights.add('%s_trigger'%channel, nom, up, down)
 
-#    0        eta - pt
-#    1        abseta - pt
-#    2        pt - abseta
+class LeptonSFEvaluator(object):
+    '''Batched evaluation of the lepton SFs selected by a name pattern
+
+    The value and error tables of the selected SFs are packed into one flat table,
+    the bin indices are computed once per distinct axis and all SFs are gathered
+    in a single lookup. Packed tables are cached per pattern.
+
+    Parameters
+    ----------
+        evaluator : coffea.lookup_tools.evaluator
+            holds the ``<name>_value`` and ``<name>_error`` dense lookups
+        sfs : dict
+            SF name -> [file, value key, error key, ordering] as in ``lepton_sf_dict``,
+            the ordering is 0 for eta-pt, 1 for abseta-pt, 2 for pt-abseta
+        ptrange : dict
+            SF name -> (ptmin, ptmax) range where the SF applies, as in ``lepton_sf_ptrange``
+    '''
+    _variables = {0: ('eta', 'pt'), 1: ('abseta', 'pt'), 2: ('pt', 'abseta')}
+
+    def __init__(self, evaluator, sfs=lepton_sf_dict, ptrange=lepton_sf_ptrange):
+        self._sfs = {}
+        for name, opts in sfs.items():
+            if opts[3] not in self._variables:
+                raise ValueError('invalid type ordering for lepton SF %s' % name)
+            value = evaluator['%s_value' % name]
+            error = evaluator['%s_error' % name]
+            axes = tuple(zip(self._variables[opts[3]], (tuple(edges) for edges in value._axes)))
+            self._sfs[name] = (axes, np.stack([value._values, error._values]).astype(np.float64))
+        self._ptrange = dict(ptrange)
+        self._groups = {}
+
+    def _group(self, match):
+        try:
+            return self._groups[match]
+        except KeyError:
+            pass
+        names = [name for name in self._sfs if match in name]
+        axes, index, tables = [], [], []
+        offset = 0
+        for name in names:
+            sfaxes, table = self._sfs[name]
+            slots = []
+            for key in sfaxes:
+                if key not in axes:
+                    axes.append(key)
+                slots.append(axes.index(key))
+            index.append((offset, table.shape[2], slots[0], slots[1]))
+            tables.append(table.reshape(2, -1))
+            offset += table.shape[1] * table.shape[2]
+        # last entry of the table (SF 1, error 0) is used outside of the pt range
+        tables.append(np.array([[1.], [0.]]))
+        gates = [(i, self._ptrange[name]) for i, name in enumerate(names) if name in self._ptrange]
+        group = self._groups[match] = (
+            names,
+            [(variable, np.array(edges)) for variable, edges in axes],
+            index,
+            gates,
+            np.concatenate(tables, axis=1).T.copy(),
+        )
+        return group
+
+    @staticmethod
+    def _bin(x, edges):
+        # same bins as dense_lookup (under/overflow clipped), but the SF axes have
+        # few edges so comparing against each of them beats a binary search
+        out = np.full(x.size, edges.size - 2, dtype=np.intp)
+        for edge in edges[1:-1]:
+            out -= x < edge
+        return out
+
+    def __call__(self, match, pt, eta):
+        '''Names of the SFs containing ``match`` and their (nSF, nlep) nominal, up and down stacks'''
+        names, axes, index, gates, table = self._group(match)
+        pt = np.asarray(pt)
+        coords = {'pt': pt, 'eta': np.asarray(eta), 'abseta': np.abs(eta)}
+        bins = [self._bin(coords[variable], edges) for variable, edges in axes]
+        flat = np.empty((len(names), pt.size), dtype=np.intp)
+        for i, (offset, ny, x, y) in enumerate(index):
+            np.add(bins[x] * ny, bins[y] + offset, out=flat[i])
+        for i, (ptmin, ptmax) in gates:
+            outside = np.zeros(pt.size, dtype=bool)
+            if ptmin is not None:
+                outside |= pt < ptmin
+            if ptmax is not None:
+                outside |= pt > ptmax
+            np.putmask(flat[i], outside, table.shape[0] - 1)
+        values = table.take(flat, axis=0)
+        nom, err = values[..., 0], values[..., 1]
+        return names, nom, nom + err, nom - err
+
+
 def add_LeptonSFs(weights, lep_pt, lep_eta, year, match):
     lep_pt  = lep_pt.pad(1, clip=True).fillna(0).flatten()
     lep_eta = lep_eta.pad(1, clip=True).fillna(0).flatten()
-    for sf in lepton_sf_dict:
-        if match in sf:
-            if lepton_sf_dict[sf][3]==0:
-                nom = lepsf_evaluator['%s_value'%sf](lep_eta,lep_pt)
-                err = lepsf_evaluator['%s_value'%sf](lep_eta,lep_pt)
-            elif lepton_sf_dict[sf][3]==1:
-                nom = lepsf_evaluator['%s_value'%sf](np.abs(lep_eta),lep_pt)
-                err = lepsf_evaluator['%s_value'%sf](np.abs(lep_eta),lep_pt)
-            elif lepton_sf_dict[sf][3]==2:
-                nom = lepsf_evaluator['%s_value'%sf](lep_pt,np.abs(lep_eta))
-                err = lepsf_evaluator['%s_value'%sf](lep_pt,np.abs(lep_eta))
-            else: 
-                print('invalid type ordering for lepton SF %s'%sf)
-                return
-            wname = sf
-            if "TRIG27" in sf:
-                nom[lep_pt>55.] = 1.
-                err[lep_pt>55.] = 0.
-            if "TRIG50" in sf:
-                nom[lep_pt<55.] = 1.
-                err[lep_pt<55.] = 0.
-            if "TRIG32" in sf:
-                nom[lep_pt>120.] = 1.
-                err[lep_pt>120.] = 0.
-            if "TRIG115" in sf:
-                nom[lep_pt<120.] = 1.
-                err[lep_pt<120.] = 0.
-            weights.add(sf, nom, nom+err, nom-err)
+    names, nom, up, down = corrections['lepton_sf_batched'](match, lep_pt, lep_eta)
+    for i, sf in enumerate(names):
+        weights.add(sf, nom[i], up[i], down[i])
 
 def add_TopPtReweighting(weights, topPt, year, dataset):
 #$SF(p_T)=e^{0.0615-0.0005\cdot p_T}$ for data/POWHEG+Pythia8
@@ -243,3 +446,9 @@ def add_TopPtReweighting(weights, topPt, year, dataset):
         toppt_weight1 = np.ones_like(topPt[:,0])
         toppt_weight2 = np.ones_like(topPt[:,1])
     weights.add('TopPtReweight', np.sqrt(toppt_weight1 * toppt_weight2), np.ones_like(toppt_weight1), np.sqrt(toppt_weight1 * toppt_weight2))
+
+
+if __name__ == '__main__':
+    #ex. python -m boostedhiggs.corrections corrections_all.coffea; export BOOSTEDHIGGS_CORRECTIONS=$PWD/corrections_all.coffea
+    import sys
+    corrections.compile(sys.argv[1])
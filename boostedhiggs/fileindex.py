@@ -0,0 +1,239 @@
+import os
+import json
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import uproot
+from coffea.processor.executor import FileMeta
+
+from .merging import XRootDStorage, LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+def indexPath(filesetpath):
+    '''Sidecar file next to a fileset json holding the metadata of its files'''
+    return os.path.splitext(filesetpath)[0] + '.index.json'
+
+
+def fileMetadata(url, treename='Events'):
+    '''Entries, sizes and branch names of ``treename`` in one input file
+
+    A file without the tree counts as empty. ``bytes`` is the size of the file on
+    disk, ``zipbytes`` the compressed size of the tree and ``uuid`` the ROOT file
+    uuid coffea uses to identify the file.
+    '''
+    try:
+        f = uproot.open(url)
+        out = {'entries': 0, 'bytes': int(f.source.size()), 'zipbytes': 0, 'uuid': f._context.uuid.hex(), 'branches': []}
+        try:
+            tree = f[treename]
+        except KeyError:
+            return out
+        out.update(entries=int(tree.numentries), zipbytes=int(tree._fZipBytes), branches=sorted(k.decode() for k in tree.keys()))
+        return out
+    except Exception as ex:
+        raise RuntimeError('Could not index %s' % url) from ex
+
+
+def _storage(url):
+    # root://host//store/... -> (XRootDStorage('root://host/'), '/store/...')
+    if url.startswith('root://'):
+        pos = url.index('/', len('root://'))
+        return XRootDStorage(url[:pos + 1]), url[pos + 1:]
+    return LocalStorage(), url
+
+
+class FileIndex(object):
+    '''Per-file metadata of a fileset, kept in a sidecar json next to it (see ``indexPath``)
+
+    For each file the sidecar keeps the entries, size on disk, compressed size of
+    the tree, ROOT uuid, adler32 checksum (recorded the first time the stamp of the
+    file changes), the stamp (size, mtime) from the directory listing, and the index
+    of its list of branches in ``branchsets`` (the files of a production share a
+    handful of branch lists, storing each once keeps the sidecar small).
+    '''
+    def __init__(self, filesetpath, treename='Events'):
+        self.path = indexPath(filesetpath)
+        self.treename = treename
+        self.files = {}
+        self.branchsets = []
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                index = json.load(fin)
+            if index.get('treename') == treename:
+                self.files = index['files']
+                self.branchsets = index['branchsets']
+            else:
+                logger.warning('%s does not index %s, rebuilding it', self.path, treename)
+        self._branchsetids = {tuple(b): i for i, b in enumerate(self.branchsets)}
+
+    def branches(self, url):
+        '''Set of the branches of ``url``'''
+        return set(self.branchsets[self.files[url]['branchset']])
+
+    def metadataCache(self, fileset):
+        '''Metadata of the indexed files of ``fileset`` in the form of the coffea ``metadata_cache``
+
+        With it ``run_uproot_job`` plans the chunks without opening the files first.
+        '''
+        return {
+            FileMeta(dataset, url, self.treename): {'numentries': self.files[url]['entries'], 'uuid': bytes.fromhex(self.files[url]['uuid'])}
+            for dataset, urls in fileset.items() for url in urls if url in self.files
+        }
+
+    def _add(self, url, stamp, checksum, metadata):
+        branches = tuple(metadata.pop('branches'))
+        if branches not in self._branchsetids:
+            self._branchsetids[branches] = len(self.branchsets)
+            self.branchsets.append(list(branches))
+        self.files[url] = dict(metadata, stamp=stamp, checksum=checksum, branchset=self._branchsetids[branches])
+
+    def update(self, urls, threads=8):
+        '''Index the files of ``urls`` that are new or changed since they were indexed
+
+        Files are listed once per directory and a file whose stamp matches the index is
+        skipped. New files are opened without being checksummed. A file with a different
+        stamp is checksummed (on the server for xrootd), an identical checksum only
+        refreshes the stamp and otherwise the file is reopened. New and changed files are opened
+        in a pool of ``threads`` threads. Files that cannot be listed or opened do not stop
+        the others, the sidecar is written with what was indexed so a rerun only retries them.
+
+        Returns
+        -------
+            dict with the number of ``indexed``, ``refreshed`` and ``unchanged`` files, and
+            the ``failed`` files with their error
+        '''
+        directories = {}
+        for url in dict.fromkeys(urls):
+            storage, path = _storage(url)
+            directories.setdefault((type(storage), getattr(storage, 'redirector', None), os.path.dirname(path) or '.'), []).append((url, storage, path))
+        failed = {}
+        stats = {'indexed': 0, 'refreshed': 0, 'unchanged': 0, 'failed': failed}
+
+        def index(url, storage, path, stamp):
+            # only changed files are checksummed, on xrootd each checksum is a query to the server
+            entry = self.files.get(url)
+            checksum = None
+            if entry is not None:
+                checksum = storage.checksum(path)
+                if checksum == entry['checksum']:
+                    return url, stamp, checksum, None
+            return url, stamp, checksum, fileMetadata(url, self.treename)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            listings = {key: pool.submit(files[0][1].list, key[2]) for key, files in directories.items()}
+            todo = {}
+            for key, files in directories.items():
+                try:
+                    stamps = listings[key].result()
+                except Exception as ex:
+                    failed.update((url, ex) for url, _, _ in files)
+                    continue
+                for url, storage, path in files:
+                    stamp = stamps.get(os.path.basename(path))
+                    if stamp is None:
+                        failed[url] = FileNotFoundError('not in the listing of %s' % key[2])
+                    elif url in self.files and self.files[url]['stamp'] == stamp:
+                        stats['unchanged'] += 1
+                    else:
+                        todo[pool.submit(index, url, storage, path, stamp)] = url
+            for future in as_completed(todo):
+                try:
+                    url, stamp, checksum, metadata = future.result()
+                except Exception as ex:
+                    failed[todo[future]] = ex
+                    continue
+                if metadata is None:
+                    self.files[url]['stamp'] = stamp
+                    stats['refreshed'] += 1
+                else:
+                    self._add(url, stamp, checksum, metadata)
+                    stats['indexed'] += 1
+        if stats['indexed'] or stats['refreshed']:
+            self.save()
+        return stats
+
+    def save(self):
+        '''Write the sidecar'''
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump({'treename': self.treename, 'branchsets': self.branchsets, 'files': self.files}, fout, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def loadFileIndex(filesetpath, samples=None, treename='Events', threads=8):
+    '''Index of a fileset, updated for the files of ``samples`` (default all)
+
+    Parameters
+    ----------
+        filesetpath : str
+            fileset json mapping dataset names to lists of files
+        samples : list, optional
+            datasets whose files must be in the index
+        treename : str
+            tree whose entries and branches are indexed
+        threads : int
+            passed to ``FileIndex.update``
+
+    Returns
+    -------
+        FileIndex
+    '''
+    with open(filesetpath) as fin:
+        fileset = json.load(fin)
+    index = FileIndex(filesetpath, treename)
+    urls = [url for sample in (fileset if samples is None else samples) for url in fileset.get(sample, [])]
+    stats = index.update(urls, threads)
+    if stats['indexed'] or stats['refreshed']:
+        logger.info('%s: %d files indexed, %d refreshed, %d unchanged', index.path, stats['indexed'], stats['refreshed'], stats['unchanged'])
+    if stats['failed']:
+        raise RuntimeError('Could not index %d files of %s:\n%s' % (len(stats['failed']), index.path, '\n'.join('%s: %s' % (k, v) for k, v in sorted(stats['failed'].items()))))
+    return index
+
+
+def packJobs(entries, target, maxfiles=None):
+    '''Split a list of files into contiguous jobs of about ``target`` entries
+
+    The number of jobs is the smallest one keeping the mean load at or below
+    ``target`` (and at most ``maxfiles`` files per job), and each job boundary
+    is put at the file boundary closest to an even share of the entries.
+
+    Parameters
+    ----------
+        entries : list
+            entries of every file, in fileset order
+        target : int
+            entries per job
+        maxfiles : int, optional
+            maximum number of files per job
+
+    Returns
+    -------
+        list of ``(start, stop)`` file index ranges covering all files
+    '''
+    nfiles = len(entries)
+    if nfiles == 0:
+        return []
+    cumsum = np.cumsum(entries)
+    total = cumsum[-1]
+    njobs = max(1, int(math.ceil(total / target)))
+    if maxfiles:
+        njobs = max(njobs, int(math.ceil(nfiles / maxfiles)))
+    njobs = min(njobs, nfiles)
+    goals = total * np.arange(1, njobs) / njobs
+    # stop after the file where the running sum crosses the goal, or before it, whichever is closer
+    after = np.minimum(np.searchsorted(cumsum, goals), nfiles - 1)
+    before = np.where(after > 0, cumsum[after - 1], 0)
+    stops = np.where(cumsum[after] - goals < goals - before, after + 1, after)
+    bounds = [0] + sorted(set(int(s) for s in stops if 0 < s < nfiles)) + [nfiles]
+    jobs = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        step = maxfiles or stop - start
+        # a job only exceeds maxfiles where a few files hold most of the entries, split it evenly
+        nsplit = int(math.ceil((stop - start) / step))
+        edges = np.linspace(start, stop, nsplit + 1).round().astype(int)
+        jobs.extend(zip(edges[:-1].tolist(), edges[1:].tolist()))
+    return jobs
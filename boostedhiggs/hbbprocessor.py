@@ -4,6 +4,9 @@ from coffea import processor, hist
 from .common import (
     getBosons,
     matchedBosonFlavor,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -114,7 +117,7 @@ class HbbProcessor(processor.ProcessorABC):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
@@ -165,11 +168,10 @@ class HbbProcessor(processor.ProcessorABC):
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :4]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_opposite = jets[(dphi > np.pi / 2).all()]
+        dphi = PairMatcher(jets, candidatejet).min('dphi')
+        ak4_opposite = jets[dphi > np.pi / 2]
         selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
-        ak4_away = jets[(dphi > 0.8).all()]
+        ak4_away = jets[dphi > 0.8]
         selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
 
         selection.add('met', events.MET.pt < 140.)
@@ -182,7 +184,7 @@ class HbbProcessor(processor.ProcessorABC):
         )
         nmuons = goodmuon.sum()
         leadingmuon = events.Muon[goodmuon][:, 0:1]
-        muon_ak8_pair = leadingmuon.cross(candidatejet, nested=True)
+        muon_ak8_dphi = PairMatcher(leadingmuon, candidatejet).min('dphi')
 
         nelectrons = (
             (events.Electron.pt > 10)
@@ -203,8 +205,8 @@ class HbbProcessor(processor.ProcessorABC):
             & (abs(leadingmuon.eta) < 2.1)
         ).all())
         selection.add('muonDphiAK8', (
-            abs(muon_ak8_pair.i0.delta_phi(muon_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            muon_ak8_dphi > 2*np.pi/3
+        ).all())
 
         if isRealData:
             genflavor = candidatejet.pt.zeros_like()
@@ -224,11 +226,10 @@ class HbbProcessor(processor.ProcessorABC):
             'noselection': [],
         }
 
-        allcuts = set()
-        output['cutflow'][dataset]['none'] += float(weights.weight().sum())
-        for cut in regions['signal']:
-            allcuts.add(cut)
-            output['cutflow'][dataset][cut] += float(weights.weight()[selection.all(*allcuts)].sum())
+        cutflow = CutflowAccumulator(regions, selection, dict.fromkeys(regions, weights))
+        cutflow.fill(output, dataset, {
+            'cutflow': 'signal',
+        })
 
         systematics = [
             None,
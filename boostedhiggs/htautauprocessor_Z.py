@@ -2,7 +2,6 @@ from functools import partial
 import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
-import awkward
 from copy import deepcopy
 from .common import (
     getBosons,
@@ -10,7 +9,17 @@ from .common import (
     matchedBosonFlavor,
     matchedBosonFlavorLep,
     getHTauTauDecayInfo,
-    isOverlap,
+    TriggerMask,
+    singletonJagged,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    RegionFiller,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -31,8 +40,11 @@ collection_methods['CustomAK8PuppiSubjet'] = FatJet
 FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 class HtautauProcessor_Z(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -266,9 +278,14 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         bos_pt_bin = hist.Bin('bos_pt', r'Boson $p_{T}$ [GeV]', [0,200,250,300,350,400,450,500,1500])
         bos_m_bin = hist.Bin('bos_m', r'Boson mass [GeV]', 12, 60., 120.)
 
+        self._triggerMask = TriggerMask({
+            'hadmu': self._hadmu_triggers[year],
+        }, flags=self._metFilters[year], year=year)
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             'cutflow_mumu': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
             'cutflow_mumu_nodr': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
@@ -303,28 +320,46 @@ class HtautauProcessor_Z(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'PuppiMET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'charge', 'looseId'],
+            'IN': ['hadhad_v4p1'],
+            'GRU': ['hadel_v6p1', 'hadmu_v6p1'],
+            'MassReg': ['hadhad_mass', 'hadel_mass', 'hadmu_mass', 'hadhad_pt', 'hadel_pt', 'hadmu_pt'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns)
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        trigger_hadmu = np.zeros(events.size, dtype='bool')
-        for t in self._hadmu_triggers[self._year]:
-            trigger_hadmu = trigger_hadmu | events.HLT[t]
-
-        if (isRealData): overlap_removal = isOverlap(events,dataset,self._hadmu_triggers[self._year])
-        else: overlap_removal = np.ones(events.size, dtype='bool')
-
-        met_filters = np.ones(events.size, dtype='bool')
-        for t in self._metFilters[self._year]:
-            met_filters = met_filters & events.Flag[t]
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events, dataset if isRealData else None)
+        trigger_hadmu = trigmask['hadmu']
+        overlap_removal = trigmask['overlap']
+        met_filters = trigmask['met_filters']
 
         selection.add('hadmu_trigger',  trigger_hadmu  & overlap_removal & met_filters)
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -340,10 +375,9 @@ class HtautauProcessor_Z(processor.ProcessorABC):
             #& (abs(fatjets.eta) < 2.5)
             #& (fatjets.isTight)
         ]#[:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.PuppiMET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.PuppiMET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        met_nopup_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        ak8_met_pair = candidatejets.cross(met_p4)
-        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        met_p4 = metP4(events.PuppiMET.pt, events.PuppiMET.phi)
+        met_nopup_p4 = metP4(events.MET.pt, events.MET.phi)
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
         #aligned_jet = ak8_met_dphi == ak8_met_dphi.min()
         #best_jet_idx = (ak8_met_pair.i0 + aligned_jet * ak8_met_pair.i1).pt.argmax()
         best_jet_idx = ak8_met_dphi.argmin()
@@ -351,19 +385,17 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         candidatejet = candidatejets[best_jet_idx]
         jetmet_dphi_ak8 = ak8_met_dphi[best_jet_idx]
 
-        mt_jetmet = np.sqrt(2.*ak8_met_pair.i0.pt.fillna(0)*ak8_met_pair.i1.pt*(ak8_met_pair.i1.pt.ones_like()-np.cos(ak8_met_dphi)))
-
-        nn_disc_hadhad = awkward.JaggedArray.fromiter([[v] for v in events.IN.hadhad_v4p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        nn_disc_hadel  = awkward.JaggedArray.fromiter([[v] for v in events.GRU.hadel_v6p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        nn_disc_hadmu  = awkward.JaggedArray.fromiter([[v] for v in events.GRU.hadmu_v6p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        nn_disc_hadhad = singletonJagged(events.IN.hadhad_v4p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        nn_disc_hadel  = singletonJagged(events.GRU.hadel_v6p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        nn_disc_hadmu  = singletonJagged(events.GRU.hadmu_v6p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
 
-        massreg_hadhad = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadhad_mass])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        massreg_hadel  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadel_mass])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        massreg_hadmu  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadmu_mass])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadhad = singletonJagged(events.MassReg.hadhad_mass)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadel  = singletonJagged(events.MassReg.hadel_mass)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadmu  = singletonJagged(events.MassReg.hadmu_mass)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
 
-        ptreg_hadhad = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadhad_pt])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        ptreg_hadel  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadel_pt])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        ptreg_hadmu  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadmu_pt])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        ptreg_hadhad = singletonJagged(events.MassReg.hadhad_pt)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        ptreg_hadel  = singletonJagged(events.MassReg.hadel_pt)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        ptreg_hadmu  = singletonJagged(events.MassReg.hadmu_pt)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
 
         candidatejet_rho = 2 * np.log(candidatejet.msdcorr / candidatejet.pt)
         selection.add('jetacceptance', (
@@ -399,6 +431,7 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         selection.add('n2ddt', (candidatejet.n2ddt < 0.).any())
         #print(np.histogram(candidatejet.pt.fillna(0).flatten()))
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (abs(events.Jet.eta) < 2.5)
@@ -406,11 +439,9 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :5]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        ak4_ak8_dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_ak8_dr = ak4_ak8_pair.i0.delta_r(ak4_ak8_pair.i1)
-        #ak4_opposite = jets[(ak4_ak8_dphi > np.pi / 2).all()]
-        ak4_away = jets[(ak4_ak8_dr > 0.8).all()]
+        ak4_ak8 = PairMatcher(jets, candidatejet)
+        #ak4_opposite = jets[ak4_ak8.min('dphi') > np.pi / 2]
+        ak4_away = jets[ak4_ak8.min('dr') > 0.8]
         #selection.add('antiak4btagMediumOppHem', ak4_away.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
         #selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('antiak4btagMediumOppHem', ak4_away.btagDeepB.max() < self._btagWPs['medium'][self._year])
@@ -438,14 +469,14 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         #    (candidatejet.lsf3 > 0.7).any()
         #))
 
-        mu0_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in themuons[:,0].pt]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,0].eta]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,0].phi]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,0].mass]))
-        mu1_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in themuons[:,1].pt]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,1].eta]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,1].phi]), awkward.JaggedArray.fromiter([[v] for v in themuons[:,1].mass]))
+        mu0_p4 = TLorentzVectorArray.from_ptetaphim(singletonJagged(themuons[:,0].pt), singletonJagged(themuons[:,0].eta), singletonJagged(themuons[:,0].phi), singletonJagged(themuons[:,0].mass))
+        mu1_p4 = TLorentzVectorArray.from_ptetaphim(singletonJagged(themuons[:,1].pt), singletonJagged(themuons[:,1].eta), singletonJagged(themuons[:,1].phi), singletonJagged(themuons[:,1].mass))
         Zcand = mu0_p4 + mu1_p4
 
-        mu_pair = mu0_p4.cross(mu1_p4)
-        mu_dr = mu_pair.i0.delta_r(mu_pair.i1)
+        mu_dr = PairMatcher(mu0_p4, mu1_p4).pairs('dr')
         selection.add('mu_dr', ((mu_dr < 0.8) & (mu_dr > 0.1)).any())
 
+        timer.stage('weights')
         if not isRealData:
             weights.add('genweight', events.genWeight)
             add_pileup_weight(weights, events.Pileup.nPU, self._year, dataset)
@@ -465,16 +496,12 @@ class HtautauProcessor_Z(processor.ProcessorABC):
             'mumu_nodr': weights,
         }
 
-        allcuts_mumu = set()
-        allcuts_mumu_nodr = set()
-        output['cutflow_mumu'][dataset]['none'] += float(w_dict['mumu_signal'].weight().sum())
-        output['cutflow_mumu_nodr'][dataset]['none'] += float(w_dict['mumu_nodr'].weight().sum())
-        for cut in regions['mumu_signal']:
-            allcuts_mumu.add(cut)
-            output['cutflow_mumu'][dataset][cut] += float(w_dict['mumu_signal'].weight()[selection.all(*allcuts_mumu)].sum())
-        for cut in regions['mumu_nodr']:
-            allcuts_mumu_nodr.add(cut)
-            output['cutflow_mumu_nodr'][dataset][cut] += float(w_dict['mumu_nodr'].weight()[selection.all(*allcuts_mumu_nodr)].sum())
+        timer.stage('cutflows')
+        cutflow = CutflowAccumulator(regions, selection, w_dict)
+        cutflow.fill(output, dataset, {
+            'cutflow_mumu': 'mumu_signal',
+            'cutflow_mumu_nodr': 'mumu_nodr',
+        })
 
         systematics = [
             None,
@@ -489,39 +516,22 @@ class HtautauProcessor_Z(processor.ProcessorABC):
         if isRealData:
             systematics = [None]
 
-        def fill(region, systematic, wmod=None, realData=False):
-            selections = regions[region]
-            cut = selection.all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                if not realData:
-                    weight = w_dict[region].weight(modifier=systematic)[cut]
-                else:
-                    weight = w_dict[region].weight(modifier=None)[cut]
-            else:
-                weight = w_dict[region].weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-            output['gen_nn_kin'].fill(
-                dataset=dataset,
-                region=region,
-                bos_pt=normalize(Zcand.pt),
-                bos_m=normalize(Zcand.mass),
-                weight=weight,
-            )
-
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic, realData=isRealData)
+        timer.stage('fills')
+        filler = RegionFiller(regions, selection, w_dict)
+        filler.fill(output['gen_nn_kin'], systematics,
+            dataset=dataset,
+            bos_pt=Zcand.pt,
+            bos_m=Zcand.mass,
+        )
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
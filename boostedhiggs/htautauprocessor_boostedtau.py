@@ -3,14 +3,25 @@ import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
 import awkward
-from copy import deepcopy
 from .common import (
     getBosons,
     getParticles,
     matchedBosonFlavor,
     matchedBosonFlavorLep,
     getHTauTauDecayInfo,
-    isOverlap,
+    TriggerMask,
+    singletonJagged,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    LayeredWeights,
+    RegionFiller,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    decode_vid_bitmap,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -31,8 +42,11 @@ collection_methods['CustomAK8PuppiSubjet'] = FatJet
 FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 class HtautauProcessor_BoostedTau(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -264,9 +278,17 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         gentau2had_bin = hist.Bin('gentau2had',r'1pr,1pr+pi0,3pr',4,-0.5,3.5)
         boostedsel_bin = hist.Bin('boostedsel',r'pass dr, charge',3,-1.5,1.5)
 
+        self._triggerMask = TriggerMask({
+            'met': self._met_triggers[year],
+            'hadhad': self._hadhad_triggers[year],
+            'hadmu': self._hadmu_triggers[year],
+            'hadel': self._hadel_triggers[year],
+        }, flags=self._metFilters[year], year=year)
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             'cutflow_hadhad': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
             'cutflow_hadhad_met': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
@@ -316,38 +338,49 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        tauAntiEle = 'idAntiEle2018' if self._year == '2018' else 'idAntiEle'
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'PuppiMET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'charge', 'looseId', 'mediumId', 'miniPFRelIso_all', 'pfRelIso04_all'],
+            'Electron': ['pt', 'eta', 'phi', 'mass', 'charge', 'cutBased', 'vidNestedWPBitmap', 'mvaFall17V2noIso_WP80', 'miniPFRelIso_all', 'pfRelIso03_all'],
+            'Tau': ['pt', 'eta', 'phi', 'mass', tauAntiEle, 'idAntiMu'],
+            'BoostedTau': ['pt', 'eta', 'phi', 'mass', 'charge', 'idMVAoldDM2017v2'],
+            'IN': ['hadhad_v4p1'],
+            'GRU': ['hadel_v6p1', 'hadmu_v6p1'],
+            'MassReg': ['hadhad', 'hadel', 'hadmu'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns, {'GenVisTau': ['pt', 'eta', 'phi', 'mass', 'status', 'genPartIdxMother']})
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        trigger_met = np.zeros(events.size, dtype='bool')
-        for t in self._met_triggers[self._year]:
-            trigger_met = trigger_met | events.HLT[t]
-
-        trigger_hadhad = np.zeros(events.size, dtype='bool')
-        for t in self._hadhad_triggers[self._year]:
-            trigger_hadhad = trigger_hadhad | events.HLT[t]
-
-        trigger_hadmu = np.zeros(events.size, dtype='bool')
-        for t in self._hadmu_triggers[self._year]:
-            trigger_hadmu = trigger_hadmu | events.HLT[t]
-
-        trigger_hadel = np.zeros(events.size, dtype='bool')
-        for t in self._hadel_triggers[self._year]:
-            trigger_hadel = trigger_hadel | events.HLT[t]
-        #print(np.histogram(trigger))
-
-        if (isRealData): overlap_removal = isOverlap(events,dataset,self._hadhad_triggers[self._year]+self._hadmu_triggers[self._year]+self._hadel_triggers[self._year]+self._met_triggers[self._year])
-        else: overlap_removal = np.ones(events.size, dtype='bool')
-
-        met_filters = np.ones(events.size, dtype='bool')
-        for t in self._metFilters[self._year]:
-            met_filters = met_filters & events.Flag[t]
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events, dataset if isRealData else None)
+        trigger_met = trigmask['met']
+        trigger_hadhad = trigmask['hadhad']
+        trigger_hadmu = trigmask['hadmu']
+        trigger_hadel = trigmask['hadel']
+        overlap_removal = trigmask['overlap']
+        met_filters = trigmask['met_filters']
 
 
         selection.add('met_trigger',    trigger_met    & overlap_removal & met_filters)
@@ -355,6 +388,7 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         selection.add('hadmu_trigger',  trigger_hadmu  & overlap_removal & met_filters)
         selection.add('hadel_trigger',  trigger_hadel  & overlap_removal & met_filters)
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -370,10 +404,9 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
             #& (abs(fatjets.eta) < 2.5)
             #& (fatjets.isTight)
         ]#[:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.PuppiMET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.PuppiMET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        met_nopup_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        ak8_met_pair = candidatejets.cross(met_p4)
-        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        met_p4 = metP4(events.PuppiMET.pt, events.PuppiMET.phi)
+        met_nopup_p4 = metP4(events.MET.pt, events.MET.phi)
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
         #aligned_jet = ak8_met_dphi == ak8_met_dphi.min()
         #best_jet_idx = (ak8_met_pair.i0 + aligned_jet * ak8_met_pair.i1).pt.argmax()
         best_jet_idx = ak8_met_dphi.argmin()
@@ -381,15 +414,13 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         candidatejet = candidatejets[best_jet_idx]
         jetmet_dphi_ak8 = ak8_met_dphi[best_jet_idx]
 
-        mt_jetmet = np.sqrt(2.*ak8_met_pair.i0.pt.fillna(0)*ak8_met_pair.i1.pt*(ak8_met_pair.i1.pt.ones_like()-np.cos(ak8_met_dphi)))
+        nn_disc_hadhad = singletonJagged(events.IN.hadhad_v4p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        nn_disc_hadel  = singletonJagged(events.GRU.hadel_v6p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        nn_disc_hadmu  = singletonJagged(events.GRU.hadmu_v6p1)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
 
-        nn_disc_hadhad = awkward.JaggedArray.fromiter([[v] for v in events.IN.hadhad_v4p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        nn_disc_hadel  = awkward.JaggedArray.fromiter([[v] for v in events.GRU.hadel_v6p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        nn_disc_hadmu  = awkward.JaggedArray.fromiter([[v] for v in events.GRU.hadmu_v6p1])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-
-        massreg_hadhad = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadhad])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        massreg_hadel  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadel])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
-        massreg_hadmu  = awkward.JaggedArray.fromiter([[v] for v in events.MassReg.hadmu])[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadhad = singletonJagged(events.MassReg.hadhad)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadel  = singletonJagged(events.MassReg.hadel)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
+        massreg_hadmu  = singletonJagged(events.MassReg.hadmu)[candidatejet.pt.pad(1, clip=True).fillna(0.)>200.]
 
         candidatejet_rho = 2 * np.log(candidatejet.msdcorr / candidatejet.pt)
         selection.add('jetacceptance', (
@@ -425,6 +456,7 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         selection.add('n2ddt', (candidatejet.n2ddt < 0.).any())
         #print(np.histogram(candidatejet.pt.fillna(0).flatten()))
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (abs(events.Jet.eta) < 2.5)
@@ -432,36 +464,24 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :5]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        ak4_ak8_dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_ak8_dr = ak4_ak8_pair.i0.delta_r(ak4_ak8_pair.i1)
-        #ak4_opposite = jets[(ak4_ak8_dphi > np.pi / 2).all()]
-        ak4_away = jets[(ak4_ak8_dr > 0.8).all()]
+        ak4_ak8 = PairMatcher(jets, candidatejet)
+        #ak4_opposite = jets[ak4_ak8.min('dphi') > np.pi / 2]
+        ak4_away = jets[ak4_ak8.min('dr') > 0.8]
         #selection.add('antiak4btagMediumOppHem', ak4_away.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
         #selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('antiak4btagMediumOppHem', ak4_away.btagDeepB.max() < self._btagWPs['medium'][self._year])
         selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > self._btagWPs['medium'][self._year])
 
-        ak4_met_pair = jets.cross(met_p4)
-        ak4_met_dphi = abs(ak4_met_pair.i0.delta_phi(ak4_met_pair.i1))
+        ak4_met_dphi = PairMatcher(jets, met_p4).min('dphi')
         jetmet_dphi = ak4_met_dphi[ak4_met_dphi.argmin()]
         selection.add('jetmet_dphi', (jetmet_dphi < np.pi / 2.).any())
 
         selection.add('met', events.PuppiMET.pt > 20.)
         selection.add('methard', events.PuppiMET.pt > 200.)
 
-        el_loose_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.LOOSE) for k in range(10) if k != 7]
-        el_tight_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.TIGHT) for k in range(10) if k != 7]
-        #el_veto_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.VETO) for k in range(10) if k != 7]
-        #                  (MinPtCut,GsfEleSCEtaMultiRangeCut,GsfEleDEtaInSeedCut,GsfEleDPhiInCut,GsfEleFull5x5SigmaIEtaIEtaCut,GsfEleHadronicOverEMEnergyScaledCut,GsfEleEInverseMinusPInverseCut,GsfEleRelPFIsoScaledCut,GsfEleConversionVetoCut,GsfEleMissingHitsCut)
-        #                   0       ,1                       ,2                  ,3              ,4                            ,5                                  ,6                             ,7                      ,8                      ,9
-
-        elmask_loose = el_loose_cuts[0].ones_like().astype(bool)
-        for m in el_loose_cuts: elmask_loose = elmask_loose & m
-        elmask_tight = el_tight_cuts[0].ones_like().astype(bool)
-        for m in el_tight_cuts: elmask_tight = elmask_tight & m
-        #elmask_veto = el_veto_cuts[0].ones_like().astype(bool)
-        #for m in el_veto_cuts: elmask_veto = elmask_veto & m
+        timer.stage('leptons')
+        elmask_loose, elmask_tight = decode_vid_bitmap(events.Electron.vidNestedWPBitmap, (events.Electron.LOOSE, events.Electron.TIGHT))
+        #elmask_veto = decode_vid_bitmap(events.Electron.vidNestedWPBitmap, events.Electron.VETO)
 
         goodmuon = (
             (events.Muon.pt > 25)
@@ -506,6 +526,7 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         )
         nelectrons = electrons.sum()
 
+        timer.stage('taus')
         if self._year=='2018':
           tauAntiEleId = events.Tau.idAntiEle2018
         else:
@@ -523,10 +544,8 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         )
         etaus_p4 = TLorentzVectorArray.from_ptetaphim(events.Tau[goodtaus_el].pt.fillna(0),events.Tau[goodtaus_el].eta.fillna(0),events.Tau[goodtaus_el].phi.fillna(0),events.Tau[goodtaus_el].mass.fillna(0))
         mtaus_p4 = TLorentzVectorArray.from_ptetaphim(events.Tau[goodtaus_mu].pt.fillna(0),events.Tau[goodtaus_mu].eta.fillna(0),events.Tau[goodtaus_mu].phi.fillna(0),events.Tau[goodtaus_mu].mass.fillna(0))
-        etau_ak8_pair = etaus_p4.cross(candidatejet)
-        etaus_dr = (etau_ak8_pair.i0.delta_r(etau_ak8_pair.i1) < 0.8)
-        mtau_ak8_pair = mtaus_p4.cross(candidatejet)
-        mtaus_dr = (mtau_ak8_pair.i0.delta_r(mtau_ak8_pair.i1) < 0.8)
+        etaus_dr = (PairMatcher(etaus_p4, candidatejet).pairs('dr') < 0.8)
+        mtaus_dr = (PairMatcher(mtaus_p4, candidatejet).pairs('dr') < 0.8)
 
         selection.add('antiElId',etaus_dr.any())
         selection.add('antiMuId',mtaus_dr.any())
@@ -540,9 +559,9 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
 
         lepsel = (((muons & ~goodmuon).sum() == 0) & (nelectrons == 0) & (ntaus == 0) & (ngoodelecs == 0) & (ngoodmuons == 1)) | ((nmuons == 0) & ((electrons & ~goodelec).sum() == 0) & (ntaus == 0) & (ngoodmuons == 0) & (ngoodelecs == 1))
         mu_p4 = TLorentzVectorArray.from_ptetaphim(leadingmuon.pt.fillna(0)*lepsel,leadingmuon.eta.fillna(0)*lepsel,leadingmuon.phi.fillna(0)*lepsel,leadingmuon.mass.fillna(0)*lepsel)
-        muon_ak8_pair = mu_p4.cross(candidatejet, nested=True)
+        muon_ak8_dphi = PairMatcher(mu_p4, candidatejet).min('dphi')
         el_p4 = TLorentzVectorArray.from_ptetaphim(leadingelec.pt.fillna(0)*lepsel,leadingelec.eta.fillna(0)*lepsel,leadingelec.phi.fillna(0)*lepsel,leadingelec.mass.fillna(0)*lepsel)
-        elec_ak8_pair = el_p4.cross(candidatejet, nested=True)
+        elec_ak8_dphi = PairMatcher(el_p4, candidatejet).min('dphi')
         #leadinglep = awkward.concatenate([mu_p4, el_p4], axis=1).pad(1, clip=True)
         leadinglep = mu_p4 + el_p4
 
@@ -558,8 +577,7 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         )
         boostedtaus = events.BoostedTau[goodboostedtaus]
         btaus_p4 = TLorentzVectorArray.from_ptetaphim(boostedtaus.pt.fillna(0),boostedtaus.eta.fillna(0),boostedtaus.phi.fillna(0),boostedtaus.mass.fillna(0))
-        btau_ak8_pair = btaus_p4.cross(candidatejet)
-        selboostedtaus = (btau_ak8_pair.i0.delta_r(btau_ak8_pair.i1) < 0.8)
+        selboostedtaus = (PairMatcher(btaus_p4, candidatejet).pairs('dr') < 0.8)
         mu_ch = leadingmuon.charge.fillna(0)*lepsel
         el_ch = leadingelec.charge.fillna(0)*lepsel
         leadinglep_ch = mu_ch + el_ch
@@ -577,22 +595,23 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
             & (abs(leadingmuon.eta) < 2.4)
         ).all())
         selection.add('muonDphiAK8', (
-            abs(muon_ak8_pair.i0.delta_phi(muon_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            muon_ak8_dphi > 2*np.pi/3
+        ).all())
         selection.add('eleckin', (
             (leadingelec.pt > 40.)
             & (abs(leadingelec.eta) < 2.4)
         ).all())
         selection.add('elecDphiAK8', (
-            abs(elec_ak8_pair.i0.delta_phi(elec_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            elec_ak8_dphi > 2*np.pi/3
+        ).all())
 
-        lep_ak8_pair = leadinglep.cross(candidatejet)#, nested=True)
+        timer.stage('lepton_jet')
+        lep_ak8_dr = PairMatcher(leadinglep, candidatejet).pairs('dr')
         selection.add('lepDrAK8', (
-            (lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1) < 0.8).all()
+            (lep_ak8_dr < 0.8).all()
         ))
         selection.add('lepDrAK8Inv', (
-            (lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1) > 0.8).all()
+            (lep_ak8_dr > 0.8).all()
         ))
 
         selection.add('muonIso', (
@@ -631,18 +650,14 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         #    (candidatejet.lsf3 > 0.7).any()
         #))
 
-        jet_lep_p4 = lep_ak8_pair.i0 + lep_ak8_pair.i1
-        met_jl_pair = met_p4.cross(jet_lep_p4)#, nested=True)
-        jet_lep_met_p4 = met_jl_pair.i0 + met_jl_pair.i1
-        jet_met_p4 = ak8_met_pair.i0[best_jet_idx] + ak8_met_pair.i1[best_jet_idx]
-
 
+        timer.stage('weights')
         if isRealData:
             genflavor = candidatejet.pt.zeros_like()
-            w_hadhad = deepcopy(weights)
-            w_hadhadmet = deepcopy(weights)
-            w_hadel = deepcopy(weights)
-            w_hadmu = deepcopy(weights)
+            w_hadhad = LayeredWeights(weights)
+            w_hadhadmet = LayeredWeights(weights)
+            w_hadel = LayeredWeights(weights)
+            w_hadmu = LayeredWeights(weights)
             genHTauTauDecay = candidatejet.pt.zeros_like()
             genHadTau1Decay = candidatejet.pt.zeros_like()
             genHadTau2Decay = candidatejet.pt.zeros_like()
@@ -659,11 +674,11 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
             genlepflavor = matchedBosonFlavorLep(candidatejet, bosons)
             genHTauTauDecay, genHadTau1Decay, genHadTau2Decay = getHTauTauDecayInfo(events,True)
             #genHTauTauDecay[(genHTauTauDecay == 0)] = -1.*(genlepflavor.pad(1, clip=True).fillna(0).flatten()[(genHTauTauDecay == 0)]).astype(float)
-            gentautaudecay = awkward.JaggedArray.fromiter([[v] for v in genHTauTauDecay])
-            w_hadhad = deepcopy(weights)
-            w_hadhadmet = deepcopy(weights)
-            w_hadel = deepcopy(weights)
-            w_hadmu = deepcopy(weights)
+            gentautaudecay = singletonJagged(genHTauTauDecay)
+            w_hadhad = LayeredWeights(weights)
+            w_hadhadmet = LayeredWeights(weights)
+            w_hadel = LayeredWeights(weights)
+            w_hadmu = LayeredWeights(weights)
             add_LeptonSFs(w_hadel, leadinglep.pt, leadinglep.eta, self._year, "elec")
             add_LeptonSFs(w_hadmu, leadinglep.pt, leadinglep.eta, self._year, "muon")
             add_TriggerWeight(w_hadhad, candidatejet.msdcorr, candidatejet.pt, leadinglep.pt, self._year, "hadhad")
@@ -707,86 +722,26 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
             'hadel_cr_w': w_hadel,
         }
 
-        allcuts_hadel = set()
-        allcuts_hadmu = set()
-        allcuts_hadel_cr_b = set()
-        allcuts_hadmu_cr_b = set()
-        allcuts_hadel_cr_w = set()
-        allcuts_hadmu_cr_w = set()
-        allcuts_hadel_cr_qcd = set()
-        allcuts_hadmu_cr_qcd = set()
-        allcuts_hadhad = set()
-        allcuts_hadhad_met = set()
-        allcuts_hadhad_cr_b = set()
-        allcuts_hadhad_cr_b_met = set()
-        allcuts_hadhad_cr_b_mu = set()
-        allcuts_hadhad_cr_b_mu_iso = set()
-        allcuts_hadhad_cr_mu = set()
-        allcuts_hadhad_cr_mu_iso = set()
-        output['cutflow_hadel'][dataset]['none'] += float(w_dict['hadel_signal'].weight().sum())
-        output['cutflow_hadmu'][dataset]['none'] += float(w_dict['hadmu_signal'].weight().sum())
-        output['cutflow_hadel_cr_b'][dataset]['none'] += float(w_dict['hadel_cr_b'].weight().sum())
-        output['cutflow_hadmu_cr_b'][dataset]['none'] += float(w_dict['hadmu_cr_b'].weight().sum())
-        output['cutflow_hadel_cr_w'][dataset]['none'] += float(w_dict['hadel_cr_w'].weight().sum())
-        output['cutflow_hadmu_cr_w'][dataset]['none'] += float(w_dict['hadmu_cr_w'].weight().sum())
-        output['cutflow_hadel_cr_qcd'][dataset]['none'] += float(w_dict['hadel_cr_qcd'].weight().sum())
-        output['cutflow_hadmu_cr_qcd'][dataset]['none'] += float(w_dict['hadmu_cr_qcd'].weight().sum())
-        output['cutflow_hadhad'][dataset]['none'] += float(w_dict['hadhad_signal'].weight().sum())
-        output['cutflow_hadhad_met'][dataset]['none'] += float(w_dict['hadhad_signal_met'].weight().sum())
-        output['cutflow_hadhad_cr_b'][dataset]['none'] += float(w_dict['hadhad_cr_b'].weight().sum())
-        output['cutflow_hadhad_cr_b_met'][dataset]['none'] += float(w_dict['hadhad_cr_b_met'].weight().sum())
-        output['cutflow_hadhad_cr_b_mu'][dataset]['none'] += float(w_dict['hadhad_cr_b_mu'].weight().sum())
-        output['cutflow_hadhad_cr_b_mu_iso'][dataset]['none'] += float(w_dict['hadhad_cr_b_mu_iso'].weight().sum())
-        output['cutflow_hadhad_cr_mu'][dataset]['none'] += float(w_dict['hadhad_cr_mu'].weight().sum())
-        output['cutflow_hadhad_cr_mu_iso'][dataset]['none'] += float(w_dict['hadhad_cr_mu_iso'].weight().sum())
-        for cut in regions['hadel_signal']:
-            allcuts_hadel.add(cut)
-            output['cutflow_hadel'][dataset][cut] += float(w_dict['hadel_signal'].weight()[selection.all(*allcuts_hadel)].sum())
-        for cut in regions['hadmu_signal']:
-            allcuts_hadmu.add(cut)
-            output['cutflow_hadmu'][dataset][cut] += float(w_dict['hadmu_signal'].weight()[selection.all(*allcuts_hadmu)].sum())
-        for cut in regions['hadel_cr_b']:
-            allcuts_hadel_cr_b.add(cut)
-            output['cutflow_hadel_cr_b'][dataset][cut] += float(w_dict['hadel_cr_b'].weight()[selection.all(*allcuts_hadel_cr_b)].sum())
-        for cut in regions['hadmu_cr_b']:
-            allcuts_hadmu_cr_b.add(cut)
-            output['cutflow_hadmu_cr_b'][dataset][cut] += float(w_dict['hadmu_cr_b'].weight()[selection.all(*allcuts_hadmu_cr_b)].sum())
-        for cut in regions['hadel_cr_w']:
-            allcuts_hadel_cr_w.add(cut)
-            output['cutflow_hadel_cr_w'][dataset][cut] += float(w_dict['hadel_cr_w'].weight()[selection.all(*allcuts_hadel_cr_w)].sum())
-        for cut in regions['hadmu_cr_w']:
-            allcuts_hadmu_cr_w.add(cut)
-            output['cutflow_hadmu_cr_w'][dataset][cut] += float(w_dict['hadmu_cr_w'].weight()[selection.all(*allcuts_hadmu_cr_w)].sum())
-        for cut in regions['hadel_cr_qcd']:
-            allcuts_hadel_cr_qcd.add(cut)
-            output['cutflow_hadel_cr_qcd'][dataset][cut] += float(w_dict['hadel_cr_qcd'].weight()[selection.all(*allcuts_hadel_cr_qcd)].sum())
-        for cut in regions['hadmu_cr_qcd']:
-            allcuts_hadmu_cr_qcd.add(cut)
-            output['cutflow_hadmu_cr_qcd'][dataset][cut] += float(w_dict['hadmu_cr_qcd'].weight()[selection.all(*allcuts_hadmu_cr_qcd)].sum())
-        for cut in regions['hadhad_signal']:
-            allcuts_hadhad.add(cut)
-            output['cutflow_hadhad'][dataset][cut] += float(w_dict['hadhad_signal'].weight()[selection.all(*allcuts_hadhad)].sum())
-        for cut in regions['hadhad_signal_met']:
-            allcuts_hadhad_met.add(cut)
-            output['cutflow_hadhad_met'][dataset][cut] += float(w_dict['hadhad_signal_met'].weight()[selection.all(*allcuts_hadhad_met)].sum())
-        for cut in regions['hadhad_cr_b']:
-            allcuts_hadhad_cr_b.add(cut)
-            output['cutflow_hadhad_cr_b'][dataset][cut] += float(w_dict['hadhad_cr_b'].weight()[selection.all(*allcuts_hadhad_cr_b)].sum())
-        for cut in regions['hadhad_cr_b_met']:
-            allcuts_hadhad_cr_b_met.add(cut)
-            output['cutflow_hadhad_cr_b_met'][dataset][cut] += float(w_dict['hadhad_cr_b_met'].weight()[selection.all(*allcuts_hadhad_cr_b_met)].sum())
-        for cut in regions['hadhad_cr_b_mu']:
-            allcuts_hadhad_cr_b_mu.add(cut)
-            output['cutflow_hadhad_cr_b_mu'][dataset][cut] += float(w_dict['hadhad_cr_b_mu'].weight()[selection.all(*allcuts_hadhad_cr_b_mu)].sum())
-        for cut in regions['hadhad_cr_b_mu_iso']:
-            allcuts_hadhad_cr_b_mu_iso.add(cut)
-            output['cutflow_hadhad_cr_b_mu_iso'][dataset][cut] += float(w_dict['hadhad_cr_b_mu_iso'].weight()[selection.all(*allcuts_hadhad_cr_b_mu_iso)].sum())
-        for cut in regions['hadhad_cr_mu']:
-            allcuts_hadhad_cr_mu.add(cut)
-            output['cutflow_hadhad_cr_mu'][dataset][cut] += float(w_dict['hadhad_cr_mu'].weight()[selection.all(*allcuts_hadhad_cr_mu)].sum())
-        for cut in regions['hadhad_cr_mu_iso']:
-            allcuts_hadhad_cr_mu_iso.add(cut)
-            output['cutflow_hadhad_cr_mu_iso'][dataset][cut] += float(w_dict['hadhad_cr_mu_iso'].weight()[selection.all(*allcuts_hadhad_cr_mu_iso)].sum())
+        timer.stage('cutflows')
+        cutflow = CutflowAccumulator(regions, selection, w_dict)
+        cutflow.fill(output, dataset, {
+            'cutflow_hadel': 'hadel_signal',
+            'cutflow_hadmu': 'hadmu_signal',
+            'cutflow_hadel_cr_b': 'hadel_cr_b',
+            'cutflow_hadmu_cr_b': 'hadmu_cr_b',
+            'cutflow_hadel_cr_w': 'hadel_cr_w',
+            'cutflow_hadmu_cr_w': 'hadmu_cr_w',
+            'cutflow_hadel_cr_qcd': 'hadel_cr_qcd',
+            'cutflow_hadmu_cr_qcd': 'hadmu_cr_qcd',
+            'cutflow_hadhad': 'hadhad_signal',
+            'cutflow_hadhad_met': 'hadhad_signal_met',
+            'cutflow_hadhad_cr_b': 'hadhad_cr_b',
+            'cutflow_hadhad_cr_b_met': 'hadhad_cr_b_met',
+            'cutflow_hadhad_cr_b_mu': 'hadhad_cr_b_mu',
+            'cutflow_hadhad_cr_b_mu_iso': 'hadhad_cr_b_mu_iso',
+            'cutflow_hadhad_cr_mu': 'hadhad_cr_mu',
+            'cutflow_hadhad_cr_mu_iso': 'hadhad_cr_mu_iso',
+        })
 
         systematics = [
             None,
@@ -800,91 +755,37 @@ class HtautauProcessor_BoostedTau(processor.ProcessorABC):
         if isRealData:
             systematics = [None]
 
-        def fill(region, systematic, wmod=None, realData=False):
-            selections = regions[region]
-            cut = selection.all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                if not realData:
-                    weight = w_dict[region].weight(modifier=systematic)[cut]
-                else:
-                    weight = w_dict[region].weight(modifier=None)[cut]
-            else:
-                weight = w_dict[region].weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-            if 'hadhad' in region:
-                nn_disc = nn_disc_hadhad
-                massreg = massreg_hadhad
-                antilep = mtaus_dr.astype(float)
-                boostedsel = awkward.JaggedArray.fromiter([[boostedtaus[ibt,0].charge * boostedtaus[ibt,1].charge * -1.] if selboostedtaus[ibt].sum()==2 else [0.] for ibt in range(len(selboostedtaus))])
-            if 'hadel' in region:
-                nn_disc = nn_disc_hadel
-                massreg = massreg_hadel
-                antilep = etaus_dr.astype(float)
-                boostedsel = awkward.JaggedArray.fromiter([[boostedtaus[ibt,0].charge * -1.] if selboostedtaus[ibt].sum()==1 else [0.] for ibt in range(len(selboostedtaus))]) * leadinglep_ch
-            if 'hadmu' in region:
-                nn_disc = nn_disc_hadmu
-                massreg = massreg_hadmu
-                antilep = mtaus_dr.astype(float)
-                boostedsel = awkward.JaggedArray.fromiter([[boostedtaus[ibt,0].charge * -1.] if selboostedtaus[ibt].sum()==1 else [0.] for ibt in range(len(selboostedtaus))]) * leadinglep_ch
-
-            bmaxind = ak4_away.btagDeepB.argmax()
-            #output['jet_nn_kin'].fill(
-            #    dataset=dataset,
-            #    region=region,
-            #    jet_pt=normalize(candidatejet.pt),
-            #    jet_msd=normalize(candidatejet.msdcorr),
-            #    massreg=normalize(massreg),
-            #    nn_disc=normalize(nn_disc),
-            #    #oppbtag=normalize(ak4_away[bmaxind].btagDeepB),
-            #    #mt_jetmet=normalize(mt_jetmet),
-            #    antilep=normalize(antilep),
-            #    weight=weight,
-            #)
-
-            #output['lep_nn_kin'].fill(
-            #    dataset=dataset,
-            #    region=region,
-            #    lep_pt=normalize(leadinglep.pt),
-            #    #jet_msd=normalize(candidatejet.msdcorr),
-            #    massreg=normalize(massreg),
-            #    nn_disc=normalize(nn_disc),
-            #    #miso=normalize(leadinglep_miso),
-            #    mt_lepmet=normalize(mt_lepmet),
-            #    antilep=normalize(antilep),
-            #    weight=weight,
-            #)
-
-            output['jet_nn_kin'].fill(
-                dataset=dataset,
-                region=region,
-                jet_pt=normalize(candidatejet.pt),
-                met_pt=normalize(met_p4.pt),
-                #jet_msd=normalize(candidatejet.msdcorr),
-                massreg=normalize(massreg),
-                nn_disc=normalize(nn_disc),
-                #met_nopup_pt=normalize(met_nopup_p4.pt),
-                #jetmet_dphi=normalize(jetmet_dphi_ak8),
-                #genhtt=normalize(gentautaudecay),
-                #n2ddt=normalize(candidatejet.n2ddt),
-                antilep=normalize(antilep),
-                boostedsel=normalize(boostedsel),
-                weight=weight,
-            )
-
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic, realData=isRealData)
+        timer.stage('fills')
+        filler = RegionFiller(regions, selection, w_dict, group=lambda region: region.split('_')[0])
+        boostedsel_lep = awkward.JaggedArray.fromiter([[boostedtaus[ibt,0].charge * -1.] if selboostedtaus[ibt].sum()==1 else [0.] for ibt in range(len(selboostedtaus))]) * leadinglep_ch
+
+        filler.fill(output['jet_nn_kin'], systematics,
+            dataset=dataset,
+            jet_pt=candidatejet.pt,
+            met_pt=met_p4.pt,
+            #jet_msd=candidatejet.msdcorr,
+            massreg={'hadhad': massreg_hadhad, 'hadel': massreg_hadel, 'hadmu': massreg_hadmu},
+            nn_disc={'hadhad': nn_disc_hadhad, 'hadel': nn_disc_hadel, 'hadmu': nn_disc_hadmu},
+            #met_nopup_pt=met_nopup_p4.pt,
+            #jetmet_dphi=jetmet_dphi_ak8,
+            #genhtt=gentautaudecay,
+            #n2ddt=candidatejet.n2ddt,
+            antilep={'hadhad': mtaus_dr.astype(float), 'hadel': etaus_dr.astype(float), 'hadmu': mtaus_dr.astype(float)},
+            boostedsel={
+                'hadhad': awkward.JaggedArray.fromiter([[boostedtaus[ibt,0].charge * boostedtaus[ibt,1].charge * -1.] if selboostedtaus[ibt].sum()==2 else [0.] for ibt in range(len(selboostedtaus))]),
+                'hadel': boostedsel_lep,
+                'hadmu': boostedsel_lep,
+            },
+        )
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
@@ -2,12 +2,22 @@ from functools import partial
 import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
-import awkward
 from .common import (
     getBosons,
     matchedBosonFlavor,
-    isOverlap,
+    TriggerMask,
     getHTauTauDecayInfo,
+    singletonJagged,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    RegionFiller,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    decode_vid_bitmap,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -26,8 +36,11 @@ collection_methods['CustomAK8PuppiSubjet'] = FatJet
 FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 class HtautauProcessor_LepID(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -228,9 +241,16 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
         genhtt_bin = hist.Bin('genhtt',r'hh,eh,mh,em,ee,mm (- for dr > 0.8)',13,-6.5,6.5)
 
 
+        self._triggerMask = TriggerMask({
+            'hadhad': self._hadhad_triggers[year],
+            'hadmu': self._hadmu_triggers[year],
+            'hadel': self._hadel_triggers[year],
+        }, flags=self._metFilters[year], year=year)
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             **{'cutflow_hadhad_%s%s_%s'%(muid,elid,vepre): processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)) for vepre in ['hv','ll','mm'] for muid in ['h','l','m','t'] for elid in ['v','l','m','t']},
             **{'cutflow_hadel_%s%s_%s'%(muid,elid,vepre): processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)) for vepre in ['hv','ll','mm'] for muid in ['h','l','m','t'] for elid in ['v','l','m','t']},
@@ -266,41 +286,49 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'looseId', 'mediumId', 'tightId', 'highPtId', 'miniPFRelIso_all'],
+            'Electron': ['pt', 'eta', 'phi', 'mass', 'cutBased', 'mvaFall17V2noIso_WP80', 'mvaFall17V2noIso_WP90', 'vidNestedWPBitmap', 'miniPFRelIso_all'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns, {'GenVisTau': ['pt', 'eta', 'phi', 'mass', 'status', 'genPartIdxMother']})
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = {
             '%s_%s'%(k,pre):processor.PackedSelection() for k in ['hadhad','hadel','hadmu'] for pre in ['hv','ll','mm','base']
         }
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        trigger_hadhad = np.zeros(events.size, dtype='bool')
-        for t in self._hadhad_triggers[self._year]:
-            trigger_hadhad = trigger_hadhad | events.HLT[t]
-
-        trigger_hadmu = np.zeros(events.size, dtype='bool')
-        for t in self._hadmu_triggers[self._year]:
-            trigger_hadmu = trigger_hadmu | events.HLT[t]
-
-        trigger_hadel = np.zeros(events.size, dtype='bool')
-        for t in self._hadel_triggers[self._year]:
-            trigger_hadel = trigger_hadel | events.HLT[t]
-        #print(np.histogram(trigger))
-
-        if (isRealData): overlap_removal = isOverlap(events,dataset,self._hadhad_triggers[self._year]+self._hadmu_triggers[self._year]+self._hadel_triggers[self._year])
-        else: overlap_removal = np.ones(events.size, dtype='bool')
-
-        met_filters = np.ones(events.size, dtype='bool')
-        for t in self._metFilters[self._year]:
-            met_filters = met_filters & events.Flag[t]
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events, dataset if isRealData else None)
+        trigger_hadhad = trigmask['hadhad']
+        trigger_hadmu = trigmask['hadmu']
+        trigger_hadel = trigmask['hadel']
+        overlap_removal = trigmask['overlap']
+        met_filters = trigmask['met_filters']
 
         for pre in ['hv','ll','mm','base']: selection['hadhad_%s'%pre].add('hadhad_trigger', trigger_hadhad & overlap_removal & met_filters)
         for pre in ['hv','ll','mm','base']: selection['hadmu_%s'%pre].add('hadmu_trigger', trigger_hadmu & overlap_removal & met_filters)
         for pre in ['hv','ll','mm','base']: selection['hadel_%s'%pre].add('hadel_trigger', trigger_hadel & overlap_removal & met_filters)
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -316,9 +344,8 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
             & (abs(fatjets.eta) < 2.5)
             & (fatjets.isTight)
         ]#[:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        ak8_met_pair = candidatejets.cross(met_p4)
-        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
         #aligned_jet = ak8_met_dphi == ak8_met_dphi.min()
         #best_jet_idx = (ak8_met_pair.i0 + aligned_jet * ak8_met_pair.i1).pt.argmax()
         best_jet_idx = ak8_met_dphi.argmin()
@@ -337,6 +364,7 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
             selection[k].add('n2ddt', (candidatejet.n2ddt < 0.).any())
         #print(np.histogram(candidatejet.pt.fillna(0).flatten()))
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (abs(events.Jet.eta) < 2.5)
@@ -344,34 +372,20 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :4]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_opposite = jets[(dphi > np.pi / 2).all()]
-        ak4_away = jets[(dphi > 0.8).all()]
+        dphi = PairMatcher(jets, candidatejet).min('dphi')
+        ak4_opposite = jets[dphi > np.pi / 2]
+        ak4_away = jets[dphi > 0.8]
         for k in selection:
             selection[k].add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < self._btagWPs['medium'][self._year])
             #selection[k].add('ak4btagMedium08', ak4_away.btagDeepB.max() > self._btagWPs['medium'][self._year])
 
             selection[k].add('met', events.MET.pt > 50.)
 
-        el_tight_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.TIGHT) for k in range(10) if k != 7]
-        el_medium_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.MEDIUM) for k in range(10) if k != 7]
-        el_loose_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.LOOSE) for k in range(10) if k != 7]
-        el_veto_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.VETO) for k in range(10) if k != 7]
-        #                  (MinPtCut,GsfEleSCEtaMultiRangeCut,GsfEleDEtaInSeedCut,GsfEleDPhiInCut,GsfEleFull5x5SigmaIEtaIEtaCut,GsfEleHadronicOverEMEnergyScaledCut,GsfEleEInverseMinusPInverseCut,GsfEleRelPFIsoScaledCut,GsfEleConversionVetoCut,GsfEleMissingHitsCut)
-        #                   0       ,1                       ,2                  ,3              ,4                            ,5                                  ,6                             ,7                      ,8                      ,9
+        timer.stage('leptons')
+        elmask_tight, elmask_medium, elmask_loose, elmask_veto = decode_vid_bitmap(events.Electron.vidNestedWPBitmap, (events.Electron.TIGHT, events.Electron.MEDIUM, events.Electron.LOOSE, events.Electron.VETO))
         elmask_wp90 = events.Electron.mvaFall17V2noIso_WP90
         elmask_wp80 = events.Electron.mvaFall17V2noIso_WP80
 
-        elmask_tight = el_tight_cuts[0].ones_like().astype(bool)
-        for m in el_tight_cuts: elmask_tight = elmask_tight & m
-        elmask_medium = el_medium_cuts[0].ones_like().astype(bool)
-        for m in el_medium_cuts: elmask_medium = elmask_medium & m
-        elmask_loose = el_loose_cuts[0].ones_like().astype(bool)
-        for m in el_loose_cuts: elmask_loose = elmask_loose & m
-        elmask_veto = el_veto_cuts[0].ones_like().astype(bool)
-        for m in el_veto_cuts: elmask_veto = elmask_veto & m
-
         goodmuon_highpt = (
             (events.Muon.pt > 25)
             & (np.abs(events.Muon.eta) < 2.4)
@@ -524,28 +538,13 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
         ntaus = np.zeros(events.size, dtype='bool')
 
         mu_p4_highpt = TLorentzVectorArray.from_ptetaphim(leadingmuon_highpt.pt.fillna(0),leadingmuon_highpt.eta.fillna(0),leadingmuon_highpt.phi.fillna(0),leadingmuon_highpt.mass.fillna(0))
-        muon_ak8_pair_highpt = mu_p4_highpt.cross(candidatejet, nested=True)
-
         mu_p4_loose = TLorentzVectorArray.from_ptetaphim(leadingmuon_loose.pt.fillna(0),leadingmuon_loose.eta.fillna(0),leadingmuon_loose.phi.fillna(0),leadingmuon_loose.mass.fillna(0))
-        muon_ak8_pair_loose = mu_p4_loose.cross(candidatejet, nested=True)
-
         mu_p4_medium = TLorentzVectorArray.from_ptetaphim(leadingmuon_medium.pt.fillna(0),leadingmuon_medium.eta.fillna(0),leadingmuon_medium.phi.fillna(0),leadingmuon_medium.mass.fillna(0))
-        muon_ak8_pair_medium = mu_p4_medium.cross(candidatejet, nested=True)
-
         mu_p4_tight = TLorentzVectorArray.from_ptetaphim(leadingmuon_tight.pt.fillna(0),leadingmuon_tight.eta.fillna(0),leadingmuon_tight.phi.fillna(0),leadingmuon_tight.mass.fillna(0))
-        muon_ak8_pair_tight = mu_p4_tight.cross(candidatejet, nested=True)
-
         el_p4_veto = TLorentzVectorArray.from_ptetaphim(leadingelec_veto.pt.fillna(0),leadingelec_veto.eta.fillna(0),leadingelec_veto.phi.fillna(0),leadingelec_veto.mass.fillna(0))
-        elec_ak8_pair_veto = el_p4_veto.cross(candidatejet, nested=True)
-
         el_p4_loose = TLorentzVectorArray.from_ptetaphim(leadingelec_loose.pt.fillna(0),leadingelec_loose.eta.fillna(0),leadingelec_loose.phi.fillna(0),leadingelec_loose.mass.fillna(0))
-        elec_ak8_pair_loose = el_p4_loose.cross(candidatejet, nested=True)
-
         el_p4_medium = TLorentzVectorArray.from_ptetaphim(leadingelec_medium.pt.fillna(0),leadingelec_medium.eta.fillna(0),leadingelec_medium.phi.fillna(0),leadingelec_medium.mass.fillna(0))
-        elec_ak8_pair_medium = el_p4_medium.cross(candidatejet, nested=True)
-
         el_p4_tight = TLorentzVectorArray.from_ptetaphim(leadingelec_tight.pt.fillna(0),leadingelec_tight.eta.fillna(0),leadingelec_tight.phi.fillna(0),leadingelec_tight.mass.fillna(0))
-        elec_ak8_pair_tight = el_p4_tight.cross(candidatejet, nested=True)
 
         leadinglep = {}
 
@@ -797,12 +796,13 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
         selection['hadmu_mm'].add('onemuon_tt_mm', (nmuons_medium <= 1) & (nelectrons_medium == 0) & (ntaus == 0) & (ngoodelecs_tight == 0) & (ngoodmuons_tight == 1))
         selection['hadel_mm'].add('oneelec_tt_mm', (nmuons_medium == 0) & (nelectrons_medium <= 1) & (ntaus == 0) & (ngoodmuons_tight == 0) & (ngoodelecs_tight == 1))
 
-        lep_ak8_pair = {}
+        timer.stage('lepton_jet')
+        lep_ak8_dr = {}
 
         for k in selection:
-            lep_ak8_pair['hv'] = leadinglep['hv'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['hv'] = PairMatcher(leadinglep['hv'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_hv', (
-                (lep_ak8_pair['hv'].i0.delta_r(lep_ak8_pair['hv'].i1) < 0.8).all()
+                (lep_ak8_dr['hv'] < 0.8).all()
             ))
             #selection.add('miniIso_hv', (
                 #(leadinglep_miso['hv'] < 0.1).any()
@@ -811,9 +811,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['hv'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['lv'] = leadinglep['lv'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['lv'] = PairMatcher(leadinglep['lv'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_lv', (
-                (lep_ak8_pair['lv'].i0.delta_r(lep_ak8_pair['lv'].i1) < 0.8).all()
+                (lep_ak8_dr['lv'] < 0.8).all()
             ))
             #selection.add('miniIso_lv', (
                 #(leadinglep_miso['lv'] < 0.1).any()
@@ -822,9 +822,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['lv'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['mv'] = leadinglep['mv'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['mv'] = PairMatcher(leadinglep['mv'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_mv', (
-                (lep_ak8_pair['mv'].i0.delta_r(lep_ak8_pair['mv'].i1) < 0.8).all()
+                (lep_ak8_dr['mv'] < 0.8).all()
             ))
             #selection.add('miniIso_mv', (
                 #(leadinglep_miso['mv'] < 0.1).any()
@@ -833,9 +833,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['mv'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['tv'] = leadinglep['tv'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['tv'] = PairMatcher(leadinglep['tv'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_tv', (
-                (lep_ak8_pair['tv'].i0.delta_r(lep_ak8_pair['tv'].i1) < 0.8).all()
+                (lep_ak8_dr['tv'] < 0.8).all()
             ))
             #selection.add('miniIso_tv', (
                 #(leadinglep_miso['tv'] < 0.1).any()
@@ -844,9 +844,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['tv'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['hl'] = leadinglep['hl'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['hl'] = PairMatcher(leadinglep['hl'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_hl', (
-                (lep_ak8_pair['hl'].i0.delta_r(lep_ak8_pair['hl'].i1) < 0.8).all()
+                (lep_ak8_dr['hl'] < 0.8).all()
             ))
             #selection.add('miniIso_hl', (
                 #(leadinglep_miso['hl'] < 0.1).any()
@@ -855,9 +855,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['hl'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['ll'] = leadinglep['ll'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['ll'] = PairMatcher(leadinglep['ll'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_ll', (
-                (lep_ak8_pair['ll'].i0.delta_r(lep_ak8_pair['ll'].i1) < 0.8).all()
+                (lep_ak8_dr['ll'] < 0.8).all()
             ))
             #selection.add('miniIso_ll', (
                 #(leadinglep_miso['ll'] < 0.1).any()
@@ -866,9 +866,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['ll'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['ml'] = leadinglep['ml'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['ml'] = PairMatcher(leadinglep['ml'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_ml', (
-                (lep_ak8_pair['ml'].i0.delta_r(lep_ak8_pair['ml'].i1) < 0.8).all()
+                (lep_ak8_dr['ml'] < 0.8).all()
             ))
             #selection.add('miniIso_ml', (
                 #(leadinglep_miso['ml'] < 0.1).any()
@@ -877,9 +877,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['ml'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['tl'] = leadinglep['tl'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['tl'] = PairMatcher(leadinglep['tl'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_tl', (
-                (lep_ak8_pair['tl'].i0.delta_r(lep_ak8_pair['tl'].i1) < 0.8).all()
+                (lep_ak8_dr['tl'] < 0.8).all()
             ))
             #selection.add('miniIso_tl', (
                 #(leadinglep_miso['tl'] < 0.1).any()
@@ -888,9 +888,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['tl'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['hm'] = leadinglep['hm'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['hm'] = PairMatcher(leadinglep['hm'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_hm', (
-                (lep_ak8_pair['hm'].i0.delta_r(lep_ak8_pair['hm'].i1) < 0.8).all()
+                (lep_ak8_dr['hm'] < 0.8).all()
             ))
             #selection.add('miniIso_hm', (
                 #(leadinglep_miso['hm'] < 0.1).any()
@@ -899,9 +899,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['hm'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['lm'] = leadinglep['lm'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['lm'] = PairMatcher(leadinglep['lm'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_lm', (
-                (lep_ak8_pair['lm'].i0.delta_r(lep_ak8_pair['lm'].i1) < 0.8).all()
+                (lep_ak8_dr['lm'] < 0.8).all()
             ))
             #selection.add('miniIso_lm', (
                 #(leadinglep_miso['lm'] < 0.1).any()
@@ -910,9 +910,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['lm'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['mm'] = leadinglep['mm'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['mm'] = PairMatcher(leadinglep['mm'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_mm', (
-                (lep_ak8_pair['mm'].i0.delta_r(lep_ak8_pair['mm'].i1) < 0.8).all()
+                (lep_ak8_dr['mm'] < 0.8).all()
             ))
             #selection.add('miniIso_mm', (
                 #(leadinglep_miso['mm'] < 0.1).any()
@@ -921,9 +921,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['mm'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['tm'] = leadinglep['tm'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['tm'] = PairMatcher(leadinglep['tm'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_tm', (
-                (lep_ak8_pair['tm'].i0.delta_r(lep_ak8_pair['tm'].i1) < 0.8).all()
+                (lep_ak8_dr['tm'] < 0.8).all()
             ))
             #selection.add('miniIso_tm', (
                 #(leadinglep_miso['tm'] < 0.1).any()
@@ -932,9 +932,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['tm'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['ht'] = leadinglep['ht'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['ht'] = PairMatcher(leadinglep['ht'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_ht', (
-                (lep_ak8_pair['ht'].i0.delta_r(lep_ak8_pair['ht'].i1) < 0.8).all()
+                (lep_ak8_dr['ht'] < 0.8).all()
             ))
             #selection.add('miniIso_ht', (
                 #(leadinglep_miso['ht'] < 0.1).any()
@@ -943,9 +943,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['ht'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['lt'] = leadinglep['lt'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['lt'] = PairMatcher(leadinglep['lt'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_lt', (
-                (lep_ak8_pair['lt'].i0.delta_r(lep_ak8_pair['lt'].i1) < 0.8).all()
+                (lep_ak8_dr['lt'] < 0.8).all()
             ))
             #selection.add('miniIso_lt', (
                 #(leadinglep_miso['lt'] < 0.1).any()
@@ -954,9 +954,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['lt'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['mt'] = leadinglep['mt'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['mt'] = PairMatcher(leadinglep['mt'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_mt', (
-                (lep_ak8_pair['mt'].i0.delta_r(lep_ak8_pair['mt'].i1) < 0.8).all()
+                (lep_ak8_dr['mt'] < 0.8).all()
             ))
             #selection.add('miniIso_mt', (
                 #(leadinglep_miso['mt'] < 0.1).any()
@@ -965,9 +965,9 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['mt'] >= 0.1).any()
             #))
     
-            lep_ak8_pair['tt'] = leadinglep['tt'].cross(candidatejet)#, nested=True)
+            lep_ak8_dr['tt'] = PairMatcher(leadinglep['tt'], candidatejet).pairs('dr')
             selection[k].add('lepDrAK8_tt', (
-                (lep_ak8_pair['tt'].i0.delta_r(lep_ak8_pair['tt'].i1) < 0.8).all()
+                (lep_ak8_dr['tt'] < 0.8).all()
             ))
             #selection.add('miniIso_tt', (
                 #(leadinglep_miso['tt'] < 0.1).any()
@@ -976,6 +976,7 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
                 #(leadinglep_miso['tt'] >= 0.1).any()
             #))
 
+        timer.stage('weights')
         if isRealData:
             #genflavor = candidatejet.pt.zeros_like()
             w_hadhad = weights
@@ -991,7 +992,7 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
             bosons = getBosons(events).pad(1, clip=True)
             genBosonPt = bosons.pt.fillna(0)
             genHTauTauDecay, genHadTau1Decay, genHadTau2Decay = getHTauTauDecayInfo(events)
-            gentautaudecay = awkward.JaggedArray.fromiter([[v] for v in genHTauTauDecay])
+            gentautaudecay = singletonJagged(genHTauTauDecay)
             add_VJets_NLOkFactor(weights, genBosonPt, self._year, dataset)
             #genflavor = matchedBosonFlavor(candidatejet, bosons)
             w_hadhad = weights
@@ -1019,24 +1020,13 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
             'hadmu_base': w_hadmu,
         }
 
-        for vepre in ['hv','ll','mm']: 
-            for muid in ['h','l','m','t']:
-                for elid in ['v','l','m','t']:
-                    output['cutflow_hadel_%s%s_%s'%(muid,elid,vepre)][dataset]['none'] += float(w_dict['hadel_%s%s_%s'%(muid,elid,vepre)].weight().sum())
-                    output['cutflow_hadmu_%s%s_%s'%(muid,elid,vepre)][dataset]['none'] += float(w_dict['hadmu_%s%s_%s'%(muid,elid,vepre)].weight().sum())
-                    output['cutflow_hadhad_%s%s_%s'%(muid,elid,vepre)][dataset]['none'] += float(w_dict['hadhad_%s%s_%s'%(muid,elid,vepre)].weight().sum())
-                    for cut in regions['hadel_%s%s_%s'%(muid,elid,vepre)]:
-                        allcuts = set()
-                        allcuts.add(cut)
-                        output['cutflow_hadel_%s%s_%s'%(muid,elid,vepre)][dataset][cut] += float(w_dict['hadel_%s%s_%s'%(muid,elid,vepre)].weight()[selection['hadel_%s'%vepre].all(*allcuts)].sum())
-                    for cut in regions['hadmu_%s%s_%s'%(muid,elid,vepre)]:
-                        allcuts = set()
-                        allcuts.add(cut)
-                        output['cutflow_hadmu_%s%s_%s'%(muid,elid,vepre)][dataset][cut] += float(w_dict['hadmu_%s%s_%s'%(muid,elid,vepre)].weight()[selection['hadmu_%s'%vepre].all(*allcuts)].sum())
-                    for cut in regions['hadhad_%s%s_%s'%(muid,elid,vepre)]:
-                        allcuts = set()
-                        allcuts.add(cut)
-                        output['cutflow_hadhad_%s%s_%s'%(muid,elid,vepre)][dataset][cut] += float(w_dict['hadhad_%s%s_%s'%(muid,elid,vepre)].weight()[selection['hadhad_%s'%vepre].all(*allcuts)].sum())
+        timer.stage('cutflows')
+        for vepre in ['hv','ll','mm']:
+            for channel in ['hadel','hadmu','hadhad']:
+                cutflow = CutflowAccumulator(regions, selection['%s_%s'%(channel,vepre)], w_dict, cumulative=False)
+                cutflow.fill(output, dataset, {
+                    'cutflow_%s_%s%s_%s'%(channel,muid,elid,vepre): '%s_%s%s_%s'%(channel,muid,elid,vepre) for muid in ['h','l','m','t'] for elid in ['v','l','m','t']
+                })
 
         systematics = [
             None,
@@ -1048,109 +1038,60 @@ class HtautauProcessor_LepID(processor.ProcessorABC):
             #'btagEffStatDown',
         ]
 
-        def fill(region, systematic, wmod=None):
-            if region.startswith('hadhad'):
-                chan = 'hadhad'
-            elif region.startswith('hadel'):
-                chan = 'hadel'
-            elif region.startswith('hadmu'):
-                chan = 'hadmu'
-            if region.endswith('hv'):
-                prefix = 'hv'
-            elif region.endswith('ll'):
-                prefix = 'll'
-            elif region.endswith('mm'):
-                prefix = 'mm'
-            else:
-                prefix = 'base'
-            if (prefix != 'base'): 
-                lepid = region.split('_')[1]
-            else:
-                lepid = 'base'
-            selections = regions[region]
-            cut = selection['%s_%s'%(chan,prefix)].all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                weight = w_dict[region].weight(modifier=systematic)[cut]
-            else:
-                weight = w_dict[region].weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-
-            #print(dataset)
-            #print(region)
-            #print("TRIG")
-            #print(np.histogram(trigger_hadel[cut]))
-            #print("BOSPT")
-            #print(np.histogram(normalize(genBosonPt)))
-            #print("JETPT")
-            #print(np.histogram(normalize(candidatejet.pt)))
-            #print("LEPPT")
-            #print(np.histogram(normalize(leadinglep.pt)))
-            #print("JLDR")
-            #print(np.histogram(normalize(lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1))))
-            #print("LSF3")
-            #print(np.histogram(normalize(candidatejet.lsf3)))
-            #print("WEIGHT")
-            #print(np.histogram(weight))
-            #print("CUTFLOW")
-            #print(output['cutflow_hadhad'][dataset])
-
-            output['jet_kin'].fill(
-                dataset=dataset,
-                region=region,
-                jet_pt=normalize(candidatejet.pt),
-                #jet_eta=normalize(candidatejet.eta),
-                jet_msd=normalize(candidatejet.msdcorr),
-                genhtt=normalize(gentautaudecay),
-                #weight=weight,
-            )
-
-            output['lep_kin'].fill(
-                dataset=dataset,
-                region=region,
-                lep_pt=normalize(leadinglep[lepid].pt),
-                #lep_eta=normalize(leadinglep[lepid].eta),
-                #lsf3=normalize(candidatejet.lsf3),
-                #lep_jet_dr=normalize(lep_ak8_pair[lepid].i0.delta_r(lep_ak8_pair[lepid].i1)),
-                miso=normalize(leadinglep_miso[lepid]),
-                genhtt=normalize(gentautaudecay),
-                #weight=weight,
-            )
-
-            output['pt_kin'].fill(
-                dataset=dataset,
-                region=region,
-                #met_pt=normalize(met_p4.pt),
-                lep_pt=normalize(leadinglep[lepid].pt),
-                jet_pt=normalize(candidatejet.pt),
-                #h_pt=normalize(bosons[events.GenPart.pdgId==25].pt),
-                genhtt=normalize(gentautaudecay),
-                #weight=weight,
-            )
-
-            output['eta_kin'].fill(
-                dataset=dataset,
-                region=region,
-                #met_pt=normalize(met_p4.pt),
-                lep_eta=normalize(leadinglep[lepid].eta),
-                jet_eta=normalize(candidatejet.eta),
-                #h_pt=normalize(bosons[events.GenPart.pdgId==25].pt),
-                genhtt=normalize(gentautaudecay),
-                #weight=weight,
-            )
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic)
+        lepids = ['%s%s'%(muid,elid) for muid in ['h','l','m','t'] for elid in ['v','l','m','t']] + ['base']
+        lep_pt = {lepid: leadinglep[lepid].pt for lepid in lepids}
+        timer.stage('fills')
+        for chan in ['hadhad','hadel','hadmu']:
+            for prefix in ['hv','ll','mm','base']:
+                chanregions = {region: cuts for region, cuts in regions.items() if region.startswith(chan) and region.endswith(prefix)}
+                if not chanregions:
+                    continue
+                filler = RegionFiller(chanregions, selection['%s_%s'%(chan,prefix)], group=lambda region: region.split('_')[1])
+
+                filler.fill(output['jet_kin'], systematics,
+                    dataset=dataset,
+                    jet_pt=candidatejet.pt,
+                    #jet_eta=candidatejet.eta,
+                    jet_msd=candidatejet.msdcorr,
+                    genhtt=gentautaudecay,
+                )
+
+                filler.fill(output['lep_kin'], systematics,
+                    dataset=dataset,
+                    lep_pt=lep_pt,
+                    #lep_eta={lepid: leadinglep[lepid].eta for lepid in lepids},
+                    #lsf3=candidatejet.lsf3,
+                    #lep_jet_dr=lep_ak8_dr,
+                    miso={lepid: leadinglep_miso[lepid] for lepid in lepids},
+                    genhtt=gentautaudecay,
+                )
+
+                filler.fill(output['pt_kin'], systematics,
+                    dataset=dataset,
+                    #met_pt=met_p4.pt,
+                    lep_pt=lep_pt,
+                    jet_pt=candidatejet.pt,
+                    #h_pt=bosons[events.GenPart.pdgId==25].pt,
+                    genhtt=gentautaudecay,
+                )
+
+                filler.fill(output['eta_kin'], systematics,
+                    dataset=dataset,
+                    #met_pt=met_p4.pt,
+                    lep_eta={lepid: leadinglep[lepid].eta for lepid in lepids},
+                    jet_eta=candidatejet.eta,
+                    #h_pt=bosons[events.GenPart.pdgId==25].pt,
+                    genhtt=gentautaudecay,
+                )
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
@@ -2,11 +2,20 @@ from functools import partial
 import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
-import awkward
 from .common import (
     getBosons,
     matchedBosonFlavor,
-    isOverlap,
+    TriggerMask,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    RegionFiller,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    decode_vid_bitmap,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -26,8 +35,11 @@ FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 
 class HtautauProcessor_Trigger(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -269,9 +281,17 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
         lep_miso_bin = hist.Bin('lep_miso', r'Lepton miniIso', 10, 0., 1.)
         n2ddt_bin = hist.Bin('n2ddt',r'$N_{2}^{DDT}$',10,-0.25,0.25)
 
+        self._triggerMask = TriggerMask({
+            'hadhad': self._hadhad_triggers[year],
+            'hadmu': self._hadmu_triggers[year],
+            'hadel': self._hadel_triggers[year],
+            **{'ref_%s' % c: self._ref_triggers[year][c] for c in ['hadhad','hadel','hadmu']},
+        }, flags=self._metFilters[year])
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             'cutflow_hadhad': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
             'cutflow_hadel': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
@@ -317,62 +337,66 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'looseId', 'mediumId', 'miniPFRelIso_all'],
+            'Electron': ['pt', 'eta', 'phi', 'mass', 'cutBased', 'vidNestedWPBitmap', 'mvaFall17V2noIso_WP80', 'miniPFRelIso_all'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns)
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        met_filters = np.ones(events.size, dtype='bool')
-        for t in self._metFilters[self._year]:
-            met_filters = met_filters & events.Flag[t]
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events)
+        met_filters = trigmask['met_filters']
 
         selection.add('met_filters', met_filters)
 
-        trigger_ref = {}
-        trigger_ref["hadhad"] = np.zeros(events.size, dtype='bool')
-        trigger_ref["hadel"] = np.zeros(events.size, dtype='bool')
-        trigger_ref["hadmu"] = np.zeros(events.size, dtype='bool')
-
-        for t in self._ref_triggers[self._year]["hadhad"]:
-            trigger_ref["hadhad"] = trigger_ref["hadhad"] | events.HLT[t]
-        for t in self._ref_triggers[self._year]["hadel"]:
-            trigger_ref["hadel"] = trigger_ref["hadel"] | events.HLT[t]
-        for t in self._ref_triggers[self._year]["hadmu"]:
-            trigger_ref["hadmu"] = trigger_ref["hadmu"] | events.HLT[t]
+        trigger_ref = {c: trigmask['ref_%s' % c] for c in ["hadhad","hadel","hadmu"]}
 
         #if (isRealData): overlap_removal = isOverlap(events,dataset,self._ref_triggers[self._year]["hadhad"]+self._ref_triggers[self._year]["hadel"]+self._ref_triggers[self._year]["hadmu"])
         #else: overlap_removal = np.ones(events.size, dtype='bool')
         overlap_removal = np.ones(events.size, dtype='bool')
 
-        trigger_hadhad = np.zeros(events.size, dtype='bool')
-        for t in self._hadhad_triggers[self._year]:
-            trigger_hadhad = trigger_hadhad | events.HLT[t]
+        trigger_hadhad = trigmask['hadhad']
         if isRealData:
             selection.add('hadhad_trigger', overlap_removal & trigger_ref["hadhad"])
         else:
             selection.add('hadhad_trigger', np.ones(events.size, dtype='bool'))
 
-        trigger_hadmu = np.zeros(events.size, dtype='bool')
-        for t in self._hadmu_triggers[self._year]:
-            trigger_hadmu = trigger_hadmu | events.HLT[t]
+        trigger_hadmu = trigmask['hadmu']
         if isRealData:
             selection.add('hadmu_trigger', overlap_removal & trigger_ref["hadmu"])
         else:
             selection.add('hadmu_trigger', np.ones(events.size, dtype='bool'))
 
-        trigger_hadel = np.zeros(events.size, dtype='bool')
-        for t in self._hadel_triggers[self._year]:
-            trigger_hadel = trigger_hadel | events.HLT[t]
+        trigger_hadel = trigmask['hadel']
         if isRealData:
             selection.add('hadel_trigger', overlap_removal & trigger_ref["hadel"])
         else:
             selection.add('hadel_trigger', np.ones(events.size, dtype='bool'))
         #print(np.histogram(trigger))
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -388,9 +412,8 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
             & (abs(fatjets.eta) < 2.5)
             & (fatjets.isTight)
         ]#[:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.pt]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        ak8_met_pair = candidatejets.cross(met_p4)
-        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
         #aligned_jet = ak8_met_dphi == ak8_met_dphi.min()
         #best_jet_idx = (ak8_met_pair.i0 + aligned_jet * ak8_met_pair.i1).pt.argmax()
         best_jet_idx = ak8_met_dphi.argmin()
@@ -411,6 +434,7 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
 
         selection.add('jet_msd', (candidatejet.msdcorr > 50.).any())
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (abs(events.Jet.eta) < 2.5)
@@ -418,13 +442,11 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :4]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        ak4_ak8_dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_ak8_dr = ak4_ak8_pair.i0.delta_r(ak4_ak8_pair.i1)
-        ak4_opposite = jets[(ak4_ak8_dphi > np.pi / 2).all()]
+        ak4_ak8 = PairMatcher(jets, candidatejet)
+        ak4_opposite = jets[ak4_ak8.min('dphi') > np.pi / 2]
         #selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < self._btagWPs['medium'][self._year])
-        ak4_away = jets[(ak4_ak8_dr > 0.8).all()]
+        ak4_away = jets[ak4_ak8.min('dr') > 0.8]
         #selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > self._btagWPs['medium'][self._year])
 
@@ -434,16 +456,8 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
         selection.add('met150', events.MET.pt > 150.)
         selection.add('met200', events.MET.pt > 200.)
 
-        el_loose_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.LOOSE) for k in range(10) if k != 7]
-        el_tight_cuts = [(np.bitwise_and(np.right_shift(events.Electron.vidNestedWPBitmap,events.Electron.vidNestedWPBitmap.ones_like()*(3*k)),events.Electron.vidNestedWPBitmap.ones_like()*7) >= events.Electron.TIGHT) for k in range(10) if k != 7]
-        #                  (MinPtCut,GsfEleSCEtaMultiRangeCut,GsfEleDEtaInSeedCut,GsfEleDPhiInCut,GsfEleFull5x5SigmaIEtaIEtaCut,GsfEleHadronicOverEMEnergyScaledCut,GsfEleEInverseMinusPInverseCut,GsfEleRelPFIsoScaledCut,GsfEleConversionVetoCut,GsfEleMissingHitsCut)
-        #                   0       ,1                       ,2                  ,3              ,4                            ,5                                  ,6                             ,7                      ,8                      ,9
-
-        elmask_loose = el_loose_cuts[0].ones_like().astype(bool)
-        for m in el_loose_cuts: elmask_loose = elmask_loose & m
-
-        elmask_tight = el_tight_cuts[0].ones_like().astype(bool)
-        for m in el_tight_cuts: elmask_tight = elmask_tight & m
+        timer.stage('leptons')
+        elmask_loose, elmask_tight = decode_vid_bitmap(events.Electron.vidNestedWPBitmap, (events.Electron.LOOSE, events.Electron.TIGHT))
 
         goodmuon = (
             (events.Muon.pt > 20)
@@ -516,10 +530,10 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
         #lepsel = ((nmuons <= 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1) & (ngoodelecs == 0)) | ((nmuons == 0) & (nelectrons <= 1) & (ntaus == 0) & (ngoodmuons == 0) & (ngoodelecs == 1))
         mu_p4 = TLorentzVectorArray.from_ptetaphim(leadingmuon.pt.fillna(0),leadingmuon.eta.fillna(0),leadingmuon.phi.fillna(0),leadingmuon.mass.fillna(0))
 #[(goodmuon & ((nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1)))]
-        muon_ak8_pair = mu_p4.cross(candidatejet, nested=True)
+        muon_ak8_dphi = PairMatcher(mu_p4, candidatejet).min('dphi')
         el_p4 = TLorentzVectorArray.from_ptetaphim(leadingelec.pt.fillna(0),leadingelec.eta.fillna(0),leadingelec.phi.fillna(0),leadingelec.mass.fillna(0))
 #[(goodelec & ((nmuons == 0) & (nelectrons == 1) & (ntaus == 0) & (ngoodelecs == 1)))]
-        elec_ak8_pair = el_p4.cross(candidatejet, nested=True)
+        elec_ak8_dphi = PairMatcher(el_p4, candidatejet).min('dphi')
         #leadinglep = awkward.concatenate([mu_p4, el_p4], axis=1).pad(1, clip=True)
         leadinglep = {}
         leadinglep["hadhad"] = mu_p4
@@ -546,19 +560,20 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
             & (abs(leadingmuon.eta) < 2.1)
         ).all())
         selection.add('muonDphiAK8', (
-            abs(muon_ak8_pair.i0.delta_phi(muon_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            muon_ak8_dphi > 2*np.pi/3
+        ).all())
         selection.add('eleckin', (
             (leadingelec.pt > 20.)
             & (abs(leadingelec.eta) < 2.4)
         ).all())
         selection.add('elecDphiAK8', (
-            abs(elec_ak8_pair.i0.delta_phi(elec_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            elec_ak8_dphi > 2*np.pi/3
+        ).all())
 
-        lep_ak8_pair = {c:leadinglep[c].cross(candidatejet) for c in ["hadhad","hadel","hadmu"]}
+        timer.stage('lepton_jet')
+        lep_ak8_dr = {c: PairMatcher(leadinglep[c], candidatejet).pairs('dr') for c in ["hadhad","hadel","hadmu"]}
         #selection.add('lepDrAK8', (
-        #    (lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1) < 0.8).all()
+        #    (lep_ak8_dr < 0.8).all()
         #))
 
         #jet_lep_p4 = lep_ak8_pair.i0 + lep_ak8_pair.i1
@@ -566,6 +581,7 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
         #jet_lep_met_p4 = met_jl_pair.i0 + met_jl_pair.i1
         #jet_met_p4 = ak8_met_pair.i0[best_jet_idx] + ak8_met_pair.i1[best_jet_idx]
 
+        timer.stage('weights')
         if isRealData:
             genflavor = candidatejet.pt.zeros_like()
             genBosonPt = candidatejet.pt.zeros_like()
@@ -596,21 +612,13 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
             #'noselection': [],
         }
 
-        allcuts_hadel = set()
-        allcuts_hadmu = set()
-        allcuts_hadhad = set()
-        output['cutflow_hadel'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadmu'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadhad'][dataset]['none'] += float(weights.weight().sum())
-        for cut in regions['hadel_signal_50']:
-            allcuts_hadel.add(cut)
-            output['cutflow_hadel'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadel)].sum())
-        for cut in regions['hadmu_signal_50']:
-            allcuts_hadmu.add(cut)
-            output['cutflow_hadmu'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadmu)].sum())
-        for cut in regions['hadhad_signal_50']:
-            allcuts_hadhad.add(cut)
-            output['cutflow_hadhad'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadhad)].sum())
+        timer.stage('cutflows')
+        cutflow = CutflowAccumulator(regions, selection, dict.fromkeys(regions, weights))
+        cutflow.fill(output, dataset, {
+            'cutflow_hadel': 'hadel_signal_50',
+            'cutflow_hadmu': 'hadmu_signal_50',
+            'cutflow_hadhad': 'hadhad_signal_50',
+        })
 
         systematics = [
             None,
@@ -622,85 +630,60 @@ class HtautauProcessor_Trigger(processor.ProcessorABC):
             #'btagEffStatDown',
         ]
 
-        def fill(region, systematic, wmod=None):
-            if (region.startswith("hadhad")): 
-                 chan = "hadhad"
-                 trigger_chan = trigger_hadhad
-            elif (region.startswith("hadel")): 
-                 chan = "hadel"
-                 trigger_chan = trigger_hadel
-            elif (region.startswith("hadmu")): 
-                 chan = "hadmu"
-                 trigger_chan = trigger_hadmu
-            else: chan = ""
-            selections = regions[region]
-            cut = selection.all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                weight = weights.weight(modifier=systematic)[cut]
-            else:
-                weight = weights.weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-            output['trigeff_h'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass=trigger_chan[cut],
-                trig_pass_ref=trigger_ref[chan][cut],
-                h_pt=normalize(genBosonPt),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep[chan].pt),
-                #weight=weight,
-            )
-
-            output['trigeff_m'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass=trigger_chan[cut],
-                trig_pass_ref=trigger_ref[chan][cut],
-                jet_msd=normalize(candidatejet.msdcorr),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep[chan].pt),
-                lepdr=normalize(lep_ak8_pair[chan].i0.delta_r(lep_ak8_pair[chan].i1)),
-                #n2ddt=normalize(candidatejet.n2ddt),
-                #weight=weight,
-            )
-
-            output['trigeff_dr'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass=trigger_chan[cut],
-                trig_pass_ref=trigger_ref[chan][cut],
-                jet_lep_dr=normalize(lep_ak8_pair[chan].i0.delta_r(lep_ak8_pair[chan].i1)),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep[chan].pt),
-#                #weight=weight,
-            )
-
-#            output['trigeff_miso'].fill(
-#            #    dataset=dataset,
-#                region=region,
-#                trig_pass_hadhad=trigger_hadhad[cut],
-#                trig_pass_hadel=trigger_hadel[cut],
-#                trig_pass_hadmu=trigger_hadmu[cut],
-#                trig_pass_ref=trigger_ref[chan][cut],
-#                lep_miso=normalize(leadinglep_miso[chan]),
-#                jet_pt=normalize(candidatejet.pt),
-#                lep_pt=normalize(leadinglep[chan].pt),
-##                #weight=weight,
-#            )
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic)
+        timer.stage('fills')
+        filler = RegionFiller(regions, selection, group=lambda region: region.split('_')[0])
+        trigger_chan = {'hadhad': trigger_hadhad, 'hadel': trigger_hadel, 'hadmu': trigger_hadmu}
+        lep_pt = {chan: leadinglep[chan].pt for chan in trigger_chan}
+        lep_jet_dr = {chan: lep_ak8_dr[chan] for chan in trigger_chan}
+
+        filler.fill(output['trigeff_h'], systematics,
+            dataset=dataset,
+            trig_pass=trigger_chan,
+            trig_pass_ref=trigger_ref,
+            h_pt=genBosonPt,
+            jet_pt=candidatejet.pt,
+            lep_pt=lep_pt,
+        )
+
+        filler.fill(output['trigeff_m'], systematics,
+            dataset=dataset,
+            trig_pass=trigger_chan,
+            trig_pass_ref=trigger_ref,
+            jet_msd=candidatejet.msdcorr,
+            jet_pt=candidatejet.pt,
+            lep_pt=lep_pt,
+            lepdr=lep_jet_dr,
+            #n2ddt=candidatejet.n2ddt,
+        )
+
+        filler.fill(output['trigeff_dr'], systematics,
+            dataset=dataset,
+            trig_pass=trigger_chan,
+            trig_pass_ref=trigger_ref,
+            jet_lep_dr=lep_jet_dr,
+            jet_pt=candidatejet.pt,
+            lep_pt=lep_pt,
+        )
+
+#        filler.fill(output['trigeff_miso'], systematics,
+#            dataset=dataset,
+#            trig_pass_hadhad=trigger_hadhad,
+#            trig_pass_hadel=trigger_hadel,
+#            trig_pass_hadmu=trigger_hadmu,
+#            trig_pass_ref=trigger_ref,
+#            lep_miso={chan: leadinglep_miso[chan] for chan in trigger_chan},
+#            jet_pt=candidatejet.pt,
+#            lep_pt=lep_pt,
+#        )
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
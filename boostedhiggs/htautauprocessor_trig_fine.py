@@ -2,10 +2,19 @@ from functools import partial
 import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
-import awkward
 from .common import (
     getBosons,
     matchedBosonFlavor,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    RegionFiller,
+    TriggerMask,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -24,8 +33,11 @@ FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 
 class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -163,9 +175,12 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
             ],
         }
 
+        self._triggerMask = TriggerMask({t: [t] for t in self._all_triggers[year]})
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             'cutflow_hadhad': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
             'cutflow_hadel': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
@@ -201,19 +216,39 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'looseId', 'mediumId', 'dxy', 'dz', 'sip3d'],
+            'Electron': ['pt', 'eta', 'phi', 'mass', 'cutBased'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns)
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        trigger_pass = []
-        for t in self._all_triggers[self._year]:
-            trigger_pass.append(events.HLT[t])
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events)
+        trigger_pass = [trigmask[t] for t in self._all_triggers[self._year]]
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -229,7 +264,7 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
             & (abs(fatjets.eta) < 2.5)
             & (fatjets.jetId & 2)
         ][:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
         ak8_met_pair = candidatejets.cross(met_p4)
         ak8_met_dphi = ak8_met_pair.i0.delta_phi(ak8_met_pair.i1)
         candidatejet = candidatejets[ak8_met_dphi.argmin()]
@@ -242,23 +277,24 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
         selection.add('n2ddt', (candidatejet.n2ddt < 0.).any())
         #print(np.histogram(candidatejet.pt.fillna(0).flatten()))
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (events.Jet.jetId & 2)
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :4]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_opposite = jets[(dphi > np.pi / 2).all()]
+        dphi = PairMatcher(jets, candidatejet).min('dphi')
+        ak4_opposite = jets[dphi > np.pi / 2]
         #selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < self._btagWPs['medium'][self._year])
-        ak4_away = jets[(dphi > 0.8).all()]
+        ak4_away = jets[dphi > 0.8]
         #selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > self._btagWPs['medium'][self._year])
 
         selection.add('met', events.MET.pt > 25.)
 
+        timer.stage('leptons')
         goodmuon = (
             (events.Muon.pt > 25)
             & (np.abs(events.Muon.eta) < 2.4)
@@ -301,13 +337,14 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
         lepsel = ((nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1)) | ((nmuons == 0) & (nelectrons == 1) & (ntaus == 0) & (ngoodelecs == 1))
         mu_p4 = TLorentzVectorArray.from_ptetaphim(leadingmuon.pt.fillna(0)*lepsel,leadingmuon.eta.fillna(0)*lepsel,leadingmuon.phi.fillna(0)*lepsel,leadingmuon.mass.fillna(0)*lepsel)
 #[(goodmuon & ((nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1)))]
-        muon_ak8_pair = mu_p4.cross(candidatejet, nested=True)
+        muon_ak8_dphi = PairMatcher(mu_p4, candidatejet).min('dphi')
         el_p4 = TLorentzVectorArray.from_ptetaphim(leadingelec.pt.fillna(0)*lepsel,leadingelec.eta.fillna(0)*lepsel,leadingelec.phi.fillna(0)*lepsel,leadingelec.mass.fillna(0)*lepsel)
 #[(goodelec & ((nmuons == 0) & (nelectrons == 1) & (ntaus == 0) & (ngoodelecs == 1)))]
-        elec_ak8_pair = el_p4.cross(candidatejet, nested=True)
+        elec_ak8_dphi = PairMatcher(el_p4, candidatejet).min('dphi')
         #leadinglep = awkward.concatenate([mu_p4, el_p4], axis=1).pad(1, clip=True)
         leadinglep = mu_p4 + el_p4
-        lep_ak8_pair = leadinglep.cross(candidatejet)#, nested=True)
+        timer.stage('lepton_jet')
+        lep_ak8_dr = PairMatcher(leadinglep, candidatejet).pairs('dr')
 
         selection.add('noleptons', (nmuons == 0) & (nelectrons == 0) & (ntaus == 0))
         selection.add('onemuon', (nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1))
@@ -317,20 +354,21 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
             & (abs(leadingmuon.eta) < 2.1)
         ).all())
         selection.add('muonDphiAK8', (
-            abs(muon_ak8_pair.i0.delta_phi(muon_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            muon_ak8_dphi > 2*np.pi/3
+        ).all())
         selection.add('eleckin', (
             (leadingelec.pt > 35.)
             & (abs(leadingelec.eta) < 2.4)
         ).all())
         selection.add('elecDphiAK8', (
-            abs(elec_ak8_pair.i0.delta_phi(elec_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            elec_ak8_dphi > 2*np.pi/3
+        ).all())
 
         selection.add('lepDrAK8', (
-            (lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1) < 0.8).all()
+            (lep_ak8_dr < 0.8).all()
         ))
 
+        timer.stage('weights')
         if isRealData:
             genflavor = candidatejet.pt.zeros_like()
         else:
@@ -350,21 +388,13 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
             #'noselection': [],
         }
 
-        allcuts_hadel = set()
-        allcuts_hadmu = set()
-        allcuts_hadhad = set()
-        output['cutflow_hadel'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadmu'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadhad'][dataset]['none'] += float(weights.weight().sum())
-        for cut in regions['hadel_signal']:
-            allcuts_hadel.add(cut)
-            output['cutflow_hadel'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadel)].sum())
-        for cut in regions['hadmu_signal']:
-            allcuts_hadmu.add(cut)
-            output['cutflow_hadmu'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadmu)].sum())
-        for cut in regions['hadhad_signal']:
-            allcuts_hadhad.add(cut)
-            output['cutflow_hadhad'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadhad)].sum())
+        timer.stage('cutflows')
+        cutflow = CutflowAccumulator(regions, selection, dict.fromkeys(regions, weights))
+        cutflow.fill(output, dataset, {
+            'cutflow_hadel': 'hadel_signal',
+            'cutflow_hadmu': 'hadmu_signal',
+            'cutflow_hadhad': 'hadhad_signal',
+        })
 
         systematics = [
             None,
@@ -376,59 +406,42 @@ class HtautauProcessor_Trigger_Fine(processor.ProcessorABC):
             #'btagEffStatDown',
         ]
 
-        def fill(region, systematic, wmod=None):
-            selections = regions[region]
-            cut = selection.all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                weight = weights.weight(modifier=systematic)[cut]
-            else:
-                weight = weights.weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-            tdict = {}
-            for it,t in enumerate(self._all_triggers[self._year]):
-                tdict['trig_pass_'+t] = trigger_pass[it][cut]
-
-            #output['trigeff_h_pt'].fill(
-            output['trigeff'].fill(
-                dataset=dataset,
-                region=region,
-                **tdict,
-                h_pt=normalize(genBosonPt),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep.pt),
-                #lsf3=normalize(candidatejet.lsf3),
-                #weight=weight,
-            )
-            #output['trigeff_jet_pt'].fill(
-            #    dataset=dataset,
-            #    region=region,
-            #    **tdict,
-            #    jet_pt=normalize(candidatejet.pt),
-            #    #lsf3=normalize(candidatejet.lsf3),
-            #    #weight=weight,
-            #)
-            #output['trigeff_lep_pt'].fill(
-            #    dataset=dataset,
-            #    region=region,
-            #    **tdict,
-            #    lep_pt=normalize(leadinglep.pt),
-            #    #lsf3=normalize(candidatejet.lsf3),
-            #    #weight=weight,
-            #)
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic)
+        timer.stage('fills')
+        filler = RegionFiller(regions, selection)
+        tdict = {}
+        for it,t in enumerate(self._all_triggers[self._year]):
+            tdict['trig_pass_'+t] = trigger_pass[it]
+
+        #filler.fill(output['trigeff_h_pt'], systematics,
+        filler.fill(output['trigeff'], systematics,
+            dataset=dataset,
+            **tdict,
+            h_pt=genBosonPt,
+            jet_pt=candidatejet.pt,
+            lep_pt=leadinglep.pt,
+            #lsf3=candidatejet.lsf3,
+        )
+        #filler.fill(output['trigeff_jet_pt'], systematics,
+        #    dataset=dataset,
+        #    **tdict,
+        #    jet_pt=candidatejet.pt,
+        #    #lsf3=candidatejet.lsf3,
+        #)
+        #filler.fill(output['trigeff_lep_pt'], systematics,
+        #    dataset=dataset,
+        #    **tdict,
+        #    lep_pt=leadinglep.pt,
+        #    #lsf3=candidatejet.lsf3,
+        #)
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
@@ -2,12 +2,21 @@ from functools import partial
 import numpy as np
 from coffea import processor, hist
 from uproot_methods import TLorentzVectorArray
-import awkward
 from .common import (
     getParticles,
     getBosons,
     matchedBosonFlavor,
     getHTauTauDecayInfo,
+    metP4,
+    PairMatcher,
+    CutflowAccumulator,
+    CachedWeights,
+    RegionFiller,
+    TriggerMask,
+    nanoColumns,
+    mc_columns,
+    prereadColumns,
+    StageTimer,
 )
 from .corrections import (
     corrected_msoftdrop,
@@ -26,8 +35,11 @@ FatJet.subjetmap['CustomAK8Puppi'] = 'CustomAK8PuppiSubjet'
 
 
 class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
-    def __init__(self, year='2017'):
+    def __init__(self, year='2017', preread=False, chunkcache=None, timing=False):
         self._year = year
+        self._preread = preread
+        self._chunkcache = chunkcache
+        self._timing = timing
 
         #self._btagSF = BTagCorrector(year, 'medium')
         self._btagWPs = {
@@ -183,9 +195,17 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
         gentau1had_bin = hist.Bin('gentau1had',r'1pr,1pr+pi0,3pr',4,-0.5,3.5)
         gentau2had_bin = hist.Bin('gentau2had',r'1pr,1pr+pi0,3pr',4,-0.5,3.5)
 
+        self._triggerMask = TriggerMask({
+            'ref': self._ref_triggers[year],
+            'hadhad': self._hadhad_triggers[year],
+            'hadmu': self._hadmu_triggers[year],
+            'hadel': self._hadel_triggers[year],
+        })
+
         self._accumulator = processor.dict_accumulator({
             # dataset -> sumw
             'sumw': processor.defaultdict_accumulator(float),
+            'timing': processor.defaultdict_accumulator(float),
             # dataset -> cut -> count
             'cutflow_hadhad': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
             'cutflow_hadel': processor.defaultdict_accumulator(partial(processor.defaultdict_accumulator, float)),
@@ -242,44 +262,58 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
+    def columns(self, isRealData):
+        '''NanoAOD branches read by ``process`` for this year and data/MC mode'''
+        columns = nanoColumns({
+            'FatJet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'n2b1', 'subJetIdx1', 'subJetIdx2'],
+            'SubJet': ['pt', 'eta', 'phi', 'mass', 'rawFactor'],
+            'Jet': ['pt', 'eta', 'phi', 'mass', 'jetId', 'btagDeepB'],
+            'MET': ['pt', 'phi'],
+            'Muon': ['pt', 'eta', 'phi', 'mass', 'looseId', 'highPtId', 'miniPFRelIso_all'],
+            'Electron': ['pt', 'eta', 'phi', 'mass', 'cutBased', 'cutBased_HEEP', 'miniPFRelIso_all'],
+        })
+        if not isRealData:
+            columns += nanoColumns(mc_columns, {'GenVisTau': ['pt', 'eta', 'phi', 'mass', 'status', 'genPartIdxMother']})
+        return columns + self._triggerMask.columns()
+
     def process(self, events):
         dataset = events.metadata['dataset']
         isRealData = 'genWeight' not in events.columns
+        if self._chunkcache is not None:
+            self._chunkcache.load(events)
+        if self._preread:
+            prereadColumns(events, self.columns(isRealData))
         selection = processor.PackedSelection()
-        weights = processor.Weights(len(events))
+        weights = CachedWeights(len(events))
         output = self.accumulator.identity()
+        timer = StageTimer(output['timing'] if self._timing else None, dataset)
         if not isRealData:
             output['sumw'][dataset] += events.genWeight.sum()
 
-        trigger_ref = np.zeros(events.size, dtype='bool')
-        for t in self._ref_triggers[self._year]:
-            trigger_ref = trigger_ref | events.HLT[t]
+        timer.stage('triggers')
+        trigmask = self._triggerMask(events)
+        trigger_ref = trigmask['ref']
 
-        trigger_hadhad = np.zeros(events.size, dtype='bool')
-        for t in self._hadhad_triggers[self._year]:
-            trigger_hadhad = trigger_hadhad | events.HLT[t]
+        trigger_hadhad = trigmask['hadhad']
         if isRealData:
             selection.add('hadhad_trigger', trigger_ref)
         else:
             selection.add('hadhad_trigger', np.ones(events.size, dtype='bool'))
 
-        trigger_hadmu = np.zeros(events.size, dtype='bool')
-        for t in self._hadmu_triggers[self._year]:
-            trigger_hadmu = trigger_hadmu | events.HLT[t]
+        trigger_hadmu = trigmask['hadmu']
         if isRealData:
             selection.add('hadmu_trigger', trigger_ref)
         else:
             selection.add('hadmu_trigger', np.ones(events.size, dtype='bool'))
 
-        trigger_hadel = np.zeros(events.size, dtype='bool')
-        for t in self._hadel_triggers[self._year]:
-            trigger_hadel = trigger_hadel | events.HLT[t]
+        trigger_hadel = trigmask['hadel']
         if isRealData:
             selection.add('hadel_trigger', trigger_ref)
         else:
             selection.add('hadel_trigger', np.ones(events.size, dtype='bool'))
         #print(np.histogram(trigger))
 
+        timer.stage('fatjets')
         try:
             fatjets = events.FatJet
         except AttributeError:
@@ -295,9 +329,8 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
             & (abs(fatjets.eta) < 2.5)
             & (fatjets.isTight)
         ][:, :2]
-        met_p4 = TLorentzVectorArray.from_ptetaphim(awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]), awkward.JaggedArray.fromiter([[v] for v in events.MET.phi]), awkward.JaggedArray.fromiter([[v] for v in np.zeros(events.size)]))
-        ak8_met_pair = candidatejets.cross(met_p4)
-        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
         candidatejet = candidatejets[ak8_met_dphi.argmin()]
         selection.add('jetacceptance', (
             (candidatejet.pt > 200)
@@ -308,23 +341,24 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
         selection.add('n2ddt', (candidatejet.n2ddt < 0.).any())
         #print(np.histogram(candidatejet.pt.fillna(0).flatten()))
 
+        timer.stage('jets')
         jets = events.Jet[
             (events.Jet.pt > 30.)
             & (events.Jet.isTight)
         ]
         # only consider first 4 jets to be consistent with old framework
         jets = jets[:, :4]
-        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
-        dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
-        ak4_opposite = jets[(dphi > np.pi / 2).all()]
+        dphi = PairMatcher(jets, candidatejet).min('dphi')
+        ak4_opposite = jets[dphi > np.pi / 2]
         #selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('antiak4btagMediumOppHem', ak4_opposite.btagDeepB.max() < self._btagWPs['medium'][self._year])
-        ak4_away = jets[(dphi > 0.8).all()]
+        ak4_away = jets[dphi > 0.8]
         #selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > BTagEfficiency.btagWPs[self._year]['medium'])
         selection.add('ak4btagMedium08', ak4_away.btagDeepB.max() > self._btagWPs['medium'][self._year])
 
         selection.add('met', events.MET.pt > 50.)
 
+        timer.stage('leptons')
         goodmuon = (
             (events.Muon.pt > 20)
             & (np.abs(events.Muon.eta) < 2.4)
@@ -375,13 +409,14 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
         lepsel = ((nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1)) | ((nmuons == 0) & (nelectrons == 1) & (ntaus == 0) & (ngoodelecs == 1))
         mu_p4 = TLorentzVectorArray.from_ptetaphim(leadingmuon.pt.fillna(0)*lepsel,leadingmuon.eta.fillna(0)*lepsel,leadingmuon.phi.fillna(0)*lepsel,leadingmuon.mass.fillna(0)*lepsel)
 #[(goodmuon & ((nmuons == 1) & (nelectrons == 0) & (ntaus == 0) & (ngoodmuons == 1)))]
-        muon_ak8_pair = mu_p4.cross(candidatejet, nested=True)
+        muon_ak8_dphi = PairMatcher(mu_p4, candidatejet).min('dphi')
         el_p4 = TLorentzVectorArray.from_ptetaphim(leadingelec.pt.fillna(0)*lepsel,leadingelec.eta.fillna(0)*lepsel,leadingelec.phi.fillna(0)*lepsel,leadingelec.mass.fillna(0)*lepsel)
 #[(goodelec & ((nmuons == 0) & (nelectrons == 1) & (ntaus == 0) & (ngoodelecs == 1)))]
-        elec_ak8_pair = el_p4.cross(candidatejet, nested=True)
+        elec_ak8_dphi = PairMatcher(el_p4, candidatejet).min('dphi')
         #leadinglep = awkward.concatenate([mu_p4, el_p4], axis=1).pad(1, clip=True)
         leadinglep = mu_p4 + el_p4
-        lep_ak8_pair = leadinglep.cross(candidatejet)#, nested=True)
+        timer.stage('lepton_jet')
+        lep_ak8_dr = PairMatcher(leadinglep, candidatejet).pairs('dr')
 
         mu_miso = leadingmuon.miniPFRelIso_all.fillna(0)*lepsel
         el_miso = leadingelec.miniPFRelIso_all.fillna(0)*lepsel
@@ -396,20 +431,21 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
             & (abs(leadingmuon.eta) < 2.1)
         ).all())
         selection.add('muonDphiAK8', (
-            abs(muon_ak8_pair.i0.delta_phi(muon_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            muon_ak8_dphi > 2*np.pi/3
+        ).all())
         selection.add('eleckin', (
             (leadingelec.pt > 20.)
             & (abs(leadingelec.eta) < 2.4)
         ).all())
         selection.add('elecDphiAK8', (
-            abs(elec_ak8_pair.i0.delta_phi(elec_ak8_pair.i1)) > 2*np.pi/3
-        ).all().all())
+            elec_ak8_dphi > 2*np.pi/3
+        ).all())
 
         selection.add('lepDrAK8', (
-            (lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1) < 0.8).all()
+            (lep_ak8_dr < 0.8).all()
         ))
 
+        timer.stage('weights')
         if isRealData:
             genHTauTauDecay = candidatejet.pt.zeros_like()
             genHadTau1Decay = candidatejet.pt.zeros_like()
@@ -437,21 +473,13 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
             #'noselection': [],
         }
 
-        allcuts_hadel = set()
-        allcuts_hadmu = set()
-        allcuts_hadhad = set()
-        output['cutflow_hadel'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadmu'][dataset]['none'] += float(weights.weight().sum())
-        output['cutflow_hadhad'][dataset]['none'] += float(weights.weight().sum())
-        for cut in regions['hadel_signal']:
-            allcuts_hadel.add(cut)
-            output['cutflow_hadel'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadel)].sum())
-        for cut in regions['hadmu_signal']:
-            allcuts_hadmu.add(cut)
-            output['cutflow_hadmu'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadmu)].sum())
-        for cut in regions['hadhad_signal']:
-            allcuts_hadhad.add(cut)
-            output['cutflow_hadhad'][dataset][cut] += float(weights.weight()[selection.all(*allcuts_hadhad)].sum())
+        timer.stage('cutflows')
+        cutflow = CutflowAccumulator(regions, selection, dict.fromkeys(regions, weights))
+        cutflow.fill(output, dataset, {
+            'cutflow_hadel': 'hadel_signal',
+            'cutflow_hadmu': 'hadmu_signal',
+            'cutflow_hadhad': 'hadhad_signal',
+        })
 
         systematics = [
             None,
@@ -463,94 +491,65 @@ class HtautauProcessor_Trigger_Gen(processor.ProcessorABC):
             #'btagEffStatDown',
         ]
 
-        def fill(region, systematic, wmod=None):
-            selections = regions[region]
-            cut = selection.all(*selections)
-            sname = 'nominal' if systematic is None else systematic
-            if wmod is None:
-                weight = weights.weight(modifier=systematic)[cut]
-            else:
-                weight = weights.weight()[cut] * wmod[cut]
-
-            def normalize(val):
-                return val[cut].pad(1, clip=True).fillna(0).flatten()
-
-            output['trigeff_h'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass_hadhad=trigger_hadhad[cut],
-                trig_pass_hadel=trigger_hadel[cut],
-                trig_pass_hadmu=trigger_hadmu[cut],
-                genhtt=genHTauTauDecay[cut],
-                h_pt=normalize(genBosonPt),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep.pt),
-                #weight=weight,
-            )
-
-            output['trigeff_m'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass_hadhad=trigger_hadhad[cut],
-                trig_pass_hadel=trigger_hadel[cut],
-                trig_pass_hadmu=trigger_hadmu[cut],
-                genhtt=genHTauTauDecay[cut],
-                jet_msd=normalize(candidatejet.msdcorr),
-                jet_pt=normalize(candidatejet.pt),
-                #lep_pt=normalize(leadinglep.pt),
-                n2ddt=normalize(candidatejet.n2ddt),
-                #weight=weight,
-            )
-
-            output['trigeff_dr'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass_hadhad=trigger_hadhad[cut],
-                trig_pass_hadel=trigger_hadel[cut],
-                trig_pass_hadmu=trigger_hadmu[cut],
-                genhtt=genHTauTauDecay[cut],
-                jet_lep_dr=normalize(lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1)),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep.pt),
-                #weight=weight,
-            )
-
-            output['trigeff_miso'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass_hadhad=trigger_hadhad[cut],
-                trig_pass_hadel=trigger_hadel[cut],
-                trig_pass_hadmu=trigger_hadmu[cut],
-                genhtt=genHTauTauDecay[cut],
-                lep_miso=normalize(leadinglep_miso),
-                jet_pt=normalize(candidatejet.pt),
-                lep_pt=normalize(leadinglep.pt),
-                #weight=weight,
-            )
-
-            output['trigeff_gen'].fill(
-                dataset=dataset,
-                region=region,
-                trig_pass_hadhad=trigger_hadhad[cut],
-                trig_pass_hadel=trigger_hadel[cut],
-                trig_pass_hadmu=trigger_hadmu[cut],
-                genhtt=genHTauTauDecay[cut],
-                gentau1had=genHadTau1Decay[cut],
-                gentau2had=genHadTau2Decay[cut],
-                jet_pt=normalize(candidatejet.pt),
-                #lep_pt=normalize(leadinglep.pt),
-                #weight=weight,
-            )
-
-        for region in regions:
-            for systematic in systematics:
-                fill(region, systematic)
+        timer.stage('fills')
+        filler = RegionFiller(regions, selection)
+        trig_pass = dict(
+            trig_pass_hadhad=trigger_hadhad,
+            trig_pass_hadel=trigger_hadel,
+            trig_pass_hadmu=trigger_hadmu,
+            genhtt=genHTauTauDecay,
+        )
+
+        filler.fill(output['trigeff_h'], systematics,
+            dataset=dataset,
+            **trig_pass,
+            h_pt=genBosonPt,
+            jet_pt=candidatejet.pt,
+            lep_pt=leadinglep.pt,
+        )
+
+        filler.fill(output['trigeff_m'], systematics,
+            dataset=dataset,
+            **trig_pass,
+            jet_msd=candidatejet.msdcorr,
+            jet_pt=candidatejet.pt,
+            #lep_pt=leadinglep.pt,
+            n2ddt=candidatejet.n2ddt,
+        )
+
+        filler.fill(output['trigeff_dr'], systematics,
+            dataset=dataset,
+            **trig_pass,
+            jet_lep_dr=lep_ak8_dr,
+            jet_pt=candidatejet.pt,
+            lep_pt=leadinglep.pt,
+        )
+
+        filler.fill(output['trigeff_miso'], systematics,
+            dataset=dataset,
+            **trig_pass,
+            lep_miso=leadinglep_miso,
+            jet_pt=candidatejet.pt,
+            lep_pt=leadinglep.pt,
+        )
+
+        filler.fill(output['trigeff_gen'], systematics,
+            dataset=dataset,
+            **trig_pass,
+            gentau1had=genHadTau1Decay,
+            gentau2had=genHadTau2Decay,
+            jet_pt=candidatejet.pt,
+            #lep_pt=leadinglep.pt,
+        )
         #    if 'GluGluHToTauTau' in dataset:
         #        for i in range(9):
         #            fill(region, 'LHEScale_%d' % i, events.LHEScaleWeight[:, i])
         #        for c in events.LHEWeight.columns[1:]:
         #            fill(region, 'LHEWeight_%s' % c, events.LHEWeight[c])
 
+        timer.stop()
+        if self._chunkcache is not None:
+            self._chunkcache.store(events)
         return output
 
     def postprocess(self, accumulator):
@@ -0,0 +1,475 @@
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import functools
+import itertools
+import shutil
+import subprocess
+import resource
+import logging
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+import lz4.frame
+import cloudpickle
+from coffea import util, hist
+from coffea.processor import AccumulatorABC
+
+
+logger = logging.getLogger(__name__)
+
+
+def addOutputs(total, other):
+    '''Add ``other`` into ``total`` and return the sum
+
+    Accumulators (``dict_accumulator``, ``hist.Hist``, ...) are added in place with their
+    own ``add``. Plain dicts are merged key by key, keys only present in ``other`` are
+    copied over.
+    '''
+    if isinstance(total, AccumulatorABC):
+        total.add(other)
+        return total
+    if isinstance(total, dict):
+        for key, value in other.items():
+            total[key] = addOutputs(total[key], value) if key in total else value
+        return total
+    return total + other
+
+
+def _dumps(output):
+    # stream through the compressor rather than holding the whole uncompressed pickle
+    buf = io.BytesIO()
+    with lz4.frame.open(buf, 'wb') as fout:
+        cloudpickle.dump(output, fout)
+    return buf.getvalue()
+
+
+def _loads(blob):
+    with lz4.frame.open(io.BytesIO(blob)) as fin:
+        return cloudpickle.load(fin)
+
+
+def _load(item):
+    # a file path or a partial sum sent back by another merge task
+    if isinstance(item, bytes):
+        return _loads(item)
+    try:
+        return util.load(item)
+    except Exception as ex:
+        raise RuntimeError('Could not load %s: %s' % (item, ex))
+
+
+def _sum(items):
+    # only the running sum and the output being added are in memory at any time
+    total = None
+    for item in items:
+        output = _load(item)
+        total = output if total is None else addOutputs(total, output)
+    return total
+
+
+def _mergeTask(items):
+    return _dumps(_sum(items))
+
+
+def _maxrss(who):
+    # ru_maxrss is in kB on linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def _stats(files, nbytes, tic, **extra):
+    stats = {
+        'files': files,
+        'bytes': nbytes,
+        'seconds': time.time() - tic,
+        'maxrss': _maxrss(resource.RUSAGE_SELF),
+        'maxrss_worker': _maxrss(resource.RUSAGE_CHILDREN),
+    }
+    stats.update(extra)
+    return stats
+
+
+def mergeOutputs(paths, workers=4, fanin=8):
+    '''Sum coffea output files with a parallel tree reduction
+
+    Each merge task loads at most ``fanin`` inputs (files or partial sums) one after the
+    other and adds them into a running sum, so a worker never holds more than two outputs.
+    Tasks are started as soon as a worker is free and enough inputs are available, and
+    their partial sums are fed back into the reduction until one output is left. Partial
+    sums travel between processes lz4-compressed and nothing is written to disk. Inputs
+    given as futures (e.g. transfers running in a thread pool) join the reduction when
+    they complete, so merging overlaps with the transfers.
+
+    Parameters
+    ----------
+        paths : list
+            coffea files to merge, or futures returning them
+        workers : int, optional
+            number of worker processes, 1 merges in the current process
+        fanin : int, optional
+            maximum number of inputs added by one merge task
+
+    Returns
+    -------
+        output, stats
+            the merged output and a dict with the number of files, bytes read,
+            wall time and peak RSS [MB] of this process and of the largest worker
+    '''
+    if not paths:
+        raise ValueError('No coffea files to merge')
+    if fanin < 2:
+        raise ValueError('fanin must be at least 2, got %d' % fanin)
+    tic = time.time()
+    fetching = set(path for path in paths if isinstance(path, Future))
+    ready = [path for path in paths if not isinstance(path, Future)]
+    nbytes = [sum(os.path.getsize(path) for path in ready)]
+
+    def arrived(future):
+        path = future.result()
+        nbytes[0] += os.path.getsize(path)
+        return path
+
+    if workers <= 1:
+        # the files already there first, then the transfers as they complete
+        output = _sum(itertools.chain(ready, (arrived(future) for future in as_completed(fetching))))
+    else:
+        pending = deque(ready)
+        running = set()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while len(pending) > 1 or running or fetching:
+                # below the fan-in, only start a task if the workers would be idle otherwise
+                while len(running) < workers and (len(pending) >= fanin or (len(pending) > 1 and not running)):
+                    items = [pending.popleft() for _ in range(min(fanin, len(pending)))]
+                    running.add(pool.submit(_mergeTask, items))
+                finished, _ = wait(running | fetching, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in fetching:
+                        fetching.remove(future)
+                        pending.append(arrived(future))
+                    else:
+                        # partial sums go first so the parent holds as few of them as possible
+                        running.remove(future)
+                        pending.appendleft(future.result())
+                logger.debug('%d inputs pending, %d transfers and %d merge tasks running', len(pending), len(fetching), len(running))
+        output = _load(pending[0])
+
+    return output, _stats(len(paths), nbytes[0], tic)
+
+
+def fileChecksum(path, blocksize=1 << 20):
+    '''adler32 of the content of ``path`` as a hex string'''
+    value = 1
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(blocksize), b''):
+            value = zlib.adler32(block, value)
+    return '%08x' % value
+
+
+def _localStamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+class MergeManifest(object):
+    '''Job outputs already added into a merged coffea file
+
+    The manifest is a json file next to the merged output (``<output>.manifest.json``).
+    For each job id it keeps the path, stamp (size, mtime) and checksum of the output
+    that was added. It also records the stamp of the merged file it was written with, so
+    a manifest that does not describe the merged file on disk (e.g. after a crash between
+    the two writes of a checkpoint) is discarded and the sum is rebuilt.
+    '''
+    def __init__(self, outpath):
+        self.outpath = outpath
+        self.path = outpath + '.manifest.json'
+        self.jobs = {}
+        if os.path.exists(self.path) and os.path.exists(outpath):
+            with open(self.path) as fin:
+                manifest = json.load(fin)
+            if manifest.get('output') == _localStamp(outpath):
+                self.jobs = manifest['jobs']
+            else:
+                logger.warning('%s does not match %s, rebuilding the sum', self.path, outpath)
+
+    def _write(self, outputstamp):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump({'output': outputstamp, 'jobs': self.jobs}, fout, indent=1, sort_keys=True)
+        return tmp
+
+    def update(self):
+        '''Write the manifest for the merged file currently on disk'''
+        os.replace(self._write(_localStamp(self.outpath)), self.path)
+
+    def checkpoint(self, output):
+        '''Write ``output`` as the merged file together with the manifest'''
+        tmp = self.outpath + '.tmp'
+        util.save(output, tmp)
+        manifest = self._write(_localStamp(tmp))
+        # os.replace keeps the mtime, the stamp recorded above stays valid
+        os.replace(tmp, self.outpath)
+        os.replace(manifest, self.path)
+
+
+def mergeIncremental(inputs, outpath, workers=4, fanin=8, checkpoint=100, stat=_localStamp, fetch=None, threads=8, checksum=None):
+    '''Add new or changed job outputs to an existing merged file
+
+    Job outputs whose stamp matches the ``MergeManifest`` of ``outpath`` are skipped. New
+    jobs are added to the existing sum. Merged jobs with a different stamp are checksummed
+    (with ``checksum`` where it is given, otherwise after fetching them): an identical
+    checksum only refreshes the stamp, while a job whose content changed cannot be taken
+    out of the sum again, so the sum is rebuilt from all ``inputs`` (replaced outputs are
+    detected before anything is merged). New outputs are merged with ``mergeOutputs`` in
+    batches of ``checkpoint`` jobs, and the merged file and manifest are written after each
+    batch, so an interrupted merge resumes from the last batch. Jobs in the manifest that
+    are absent from ``inputs`` stay in the sum, a rebuild reads them again from the path in
+    the manifest and fails if one of them is gone. Inputs are fetched in a pool of
+    ``threads`` threads, the next batch while the current one is merged.
+
+    Parameters
+    ----------
+        inputs : dict
+            job id -> path of the job output
+        outpath : str
+            merged coffea file, the manifest is written next to it
+        workers, fanin : int, optional
+            passed to ``mergeOutputs``
+        checkpoint : int, optional
+            number of jobs merged between two writes of the merged file
+        stat : callable, optional
+            path -> [size, mtime] stamp used to detect changed inputs without reading them
+        fetch : callable, optional
+            path -> local file, only called for the inputs that are checksummed and merged
+        threads : int, optional
+            maximum number of concurrent fetches
+        checksum : callable, optional
+            path -> adler32 hex string of an input without fetching it (e.g.
+            ``XRootDStorage.checksum``), used for the merged jobs whose stamp changed
+
+    Returns
+    -------
+        output, stats
+            the merged output and the ``mergeOutputs`` stats of this invocation, with the
+            number of ``skipped`` jobs and whether the sum was ``rebuilt``
+    '''
+    manifest = MergeManifest(outpath)
+    stamps = {jobid: list(stat(path)) for jobid, path in inputs.items()}
+    local, checksums = {}, {}
+
+    with ThreadPoolExecutor(max_workers=threads) as transfers:
+        def prefetch(jobids):
+            # each input is fetched at most once
+            for jobid in jobids:
+                if jobid not in local:
+                    local[jobid] = transfers.submit(fetch, inputs[jobid]) if fetch is not None else inputs[jobid]
+
+        def localChecksum(jobid):
+            if jobid not in checksums:
+                prefetch([jobid])
+                checksums[jobid] = fileChecksum(local[jobid].result() if isinstance(local[jobid], Future) else local[jobid])
+            return checksums[jobid]
+
+        def remoteChecksum(jobid):
+            # the storage computes it, the input is only fetched if it has to be merged
+            if jobid not in checksums:
+                checksums[jobid] = checksum(inputs[jobid])
+            return checksums[jobid]
+
+        todo, replaced = [], []
+        changed = sorted(jobid for jobid in inputs if jobid in manifest.jobs and manifest.jobs[jobid]['stamp'] != stamps[jobid])
+        if checksum is None:
+            prefetch(changed)
+        for jobid in sorted(inputs):
+            entry = manifest.jobs.get(jobid)
+            if entry is None:
+                todo.append(jobid)
+            elif entry['stamp'] == stamps[jobid]:
+                continue
+            elif entry['checksum'] == (localChecksum(jobid) if checksum is None else remoteChecksum(jobid)):
+                entry['stamp'] = stamps[jobid]
+            else:
+                replaced.append(jobid)
+        kept = {jobid: manifest.jobs[jobid]['path'] for jobid in sorted(set(manifest.jobs) - set(inputs))}
+        for jobid in kept:
+            logger.warning('%s is in %s but not in the inputs, keeping it in the sum', jobid, manifest.path)
+
+        if replaced:
+            logger.warning('Outputs of %s changed, rebuilding %s', ', '.join(replaced), outpath)
+            # the jobs kept in the sum have to be read again, the rebuild would drop them otherwise
+            for jobid, path in kept.items():
+                try:
+                    stamps[jobid] = list(stat(path))
+                except Exception as ex:
+                    raise RuntimeError('Cannot rebuild %s: %s is in %s but its output %s is gone' % (outpath, jobid, manifest.path, path)) from ex
+            inputs = dict(inputs)
+            inputs.update(kept)
+            manifest.jobs = {}
+            todo = sorted(inputs)
+        skipped = len(inputs) - len(todo)
+
+        if not todo:
+            if not manifest.jobs:
+                raise ValueError('No coffea files to merge')
+            manifest.update()
+            return util.load(outpath), _stats(0, 0, time.time(), skipped=skipped, rebuilt=False)
+
+        tic = time.time()
+        total = util.load(outpath) if manifest.jobs else None
+        nbytes = 0
+        batches = [todo[i:i + checkpoint] for i in range(0, len(todo), checkpoint)]
+        prefetch(batches[0])
+        for i, batch in enumerate(batches):
+            if i + 1 < len(batches):
+                prefetch(batches[i + 1])
+            output, stats = mergeOutputs([local[jobid] for jobid in batch], workers, fanin)
+            total = output if total is None else addOutputs(total, output)
+            nbytes += stats['bytes']
+            for jobid in batch:
+                manifest.jobs[jobid] = {'path': inputs[jobid], 'stamp': stamps[jobid], 'checksum': localChecksum(jobid)}
+            manifest.checkpoint(total)
+            logger.info('Checkpoint %s: %d/%d jobs merged', outpath, sum(len(b) for b in batches[:i + 1]), len(todo))
+
+    return total, _stats(len(todo), nbytes, tic, skipped=skipped, rebuilt=bool(replaced))
+
+
+@functools.lru_cache(maxsize=None)
+def loadXsecs(path):
+    '''Cross sections [pb] by dataset from a json file such as ``data/xsec.json``'''
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def scaleFactors(sumw, xsecs, lumi=1000.):
+    '''Dataset -> xsec * lumi / sumw, the weight normalizing MC to ``lumi`` [1/pb]
+
+    Datasets without a sum of weights (data) or without a cross section are not in the
+    table and are left unscaled.
+    '''
+    missing = sorted(dataset for dataset in sumw if dataset not in xsecs)
+    if missing:
+        logger.warning('No cross section for %s, not scaling them', ', '.join(missing))
+    return {dataset: xsecs[dataset] * lumi / w for dataset, w in sumw.items() if dataset in xsecs}
+
+
+def scaleOutput(output, factors):
+    '''Scale the histograms and cutflows of a merged output in place
+
+    Histograms with a ``dataset`` axis are scaled with one ``Hist.scale`` call restricted
+    to the datasets they contain, which does not add the other datasets of ``factors`` to
+    their axis. Cutflows (dataset -> cut -> value) are multiplied entry by entry. The
+    ``sumw`` and any other entry are left as they are.
+    '''
+    for key, value in output.items():
+        if key == 'sumw':
+            continue
+        if isinstance(value, hist.Hist):
+            if 'dataset' not in [ax.name for ax in value.sparse_axes()]:
+                continue
+            present = {ds.name: factors[ds.name] for ds in value.identifiers('dataset') if ds.name in factors}
+            if present:
+                value.scale(present, 'dataset')
+        elif isinstance(value, dict) and all(isinstance(v, dict) for v in value.values()):
+            for dataset, entries in value.items():
+                if dataset in factors:
+                    factor = factors[dataset]
+                    for cut in entries:
+                        entries[cut] *= factor
+    return output
+
+
+def loadOutput(path, xsecs=None, lumi=1000.):
+    '''Load a merged output, scaled with ``scaleOutput`` when ``xsecs`` is given
+
+    Scaling at read time lets the merge step write a single unscaled file (e.g. the
+    running sum of ``mergeIncremental``) instead of an unscaled and a scaled copy.
+
+    Parameters
+    ----------
+        path : str
+            unscaled coffea file
+        xsecs : str or dict, optional
+            cross section json file or dataset -> cross section [pb]
+        lumi : float, optional
+            luminosity [1/pb] the MC is normalized to
+    '''
+    output = util.load(path)
+    if xsecs is not None:
+        if isinstance(xsecs, str):
+            xsecs = loadXsecs(xsecs)
+        scaleOutput(output, scaleFactors(output['sumw'], xsecs, lumi))
+    return output
+
+
+class XRootDStorage(object):
+    '''Job outputs on an xrootd server (e.g. EOS), listed with ``xrdfs`` and copied with ``xrdcp``'''
+    def __init__(self, redirector='root://cmseos.fnal.gov/'):
+        self.redirector = redirector
+
+    def list(self, directory):
+        '''name -> [size, mtime] of the files in ``directory``, from a single listing'''
+        listing = subprocess.check_output(['xrdfs', self.redirector, 'ls', '-l', directory])
+        stamps = {}
+        lines = [line for line in listing.decode().splitlines() if line.strip()]
+        parsed = 0
+        for line in lines:
+            # -rw- 2020-09-21 14:03:12     123456 /store/user/.../name.coffea
+            # (some servers add owner and group columns after the flags, so read from the end)
+            fields = line.split()
+            if len(fields) < 5 or not fields[-2].isdigit():
+                continue
+            parsed += 1
+            if not fields[0].startswith('d'):
+                stamps[os.path.basename(fields[-1])] = [int(fields[-2]), '%s %s' % (fields[-4], fields[-3])]
+        if lines and not parsed:
+            raise RuntimeError('Could not parse the listing of %s%s:\n%s' % (self.redirector, directory, '\n'.join(lines[:5])))
+        return stamps
+
+    def fetch(self, path, destdir):
+        '''Copy ``path`` into ``destdir`` and return the local file'''
+        subprocess.check_call(['xrdcp', '-f', '-s', self.redirector + path, destdir + '/'])
+        return os.path.join(destdir, os.path.basename(path))
+
+    def checksum(self, path):
+        '''adler32 of ``path`` computed by the server, without transferring the file'''
+        # adler32 0a1b2c3d /store/user/.../name.root
+        # zero-padded like fileChecksum, some servers drop the leading zeros
+        return '%08x' % int(subprocess.check_output(['xrdfs', self.redirector, 'query', 'checksum', path]).decode().split()[1], 16)
+
+
+class LocalStorage(object):
+    '''Stand-in for ``XRootDStorage`` on the local filesystem'''
+    def list(self, directory):
+        '''name -> [size, mtime] of the files in ``directory``'''
+        stamps = {}
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                st = entry.stat()
+                stamps[entry.name] = [st.st_size, st.st_mtime]
+        return stamps
+
+    def fetch(self, path, destdir):
+        '''Copy ``path`` into ``destdir`` and return the local file'''
+        dest = os.path.join(destdir, os.path.basename(path))
+        if not (os.path.exists(dest) and os.path.samefile(path, dest)):
+            shutil.copyfile(path, dest)
+        return dest
+
+    def checksum(self, path):
+        '''adler32 of ``path``'''
+        return fileChecksum(path)
+
+
+def printMergeStats(stats):
+    '''Print the throughput and memory usage returned by ``mergeOutputs`` or ``mergeIncremental``'''
+    if 'skipped' in stats:
+        print('%d job outputs already merged%s' % (stats['skipped'], ', sum rebuilt' if stats['rebuilt'] else ''))
+    seconds = max(stats['seconds'], 1e-9)
+    print('Merged %d files (%.1f MB) in %.1f s: %.1f files/s, %.1f MB/s' % (
+        stats['files'], stats['bytes'] / 1024.**2, stats['seconds'],
+        stats['files'] / seconds, stats['bytes'] / 1024.**2 / seconds,
+    ))
+    print('Peak RSS: %.0f MB (main), %.0f MB (largest worker)' % (stats['maxrss'], stats['maxrss_worker']))
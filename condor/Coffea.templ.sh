@@ -25,7 +25,7 @@ export PYTHONPATH=${PWD}:${PYTHONPATH}
 mkdir test
 cd test
 xrdcp -f root://cmseos.fnal.gov//store/user/drankin/SCRIPTNAME .
-python SCRIPTNAME --year YEAR --starti STARTNUM --endi ENDNUM --selsamples SAMPLE --outname htt_test
+python SCRIPTNAME --processor PROCESSOR --year YEAR --starti STARTNUM --endi ENDNUM --selsamples SAMPLE --outname htt_test
 
 #move output to eos
 xrdcp -f htt_test.coffea EOSOUT
@@ -9,10 +9,18 @@ import fileinput
 import json
 import glob
 
+from boostedhiggs.fileindex import loadFileIndex, packJobs
+
 #python CoffeaSubmit.py Apr23 run_htt.py 50 1
+#python CoffeaSubmit.py Apr23 run_htt.py 50 1 --events 2000000 --dry-run
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('settings', metavar='tag script nfiles re-tar', type=str, nargs='+',
                    help='label scriptname (re-tar)')
+parser.add_argument('--processor', dest='processor', default='htt', help='processor run by the script (see test/run_htt.py)')
+parser.add_argument('--events',    dest='events',    default=None,  help='split the samples into jobs of about this many events, nfiles becomes the maximum number of files per job', type=int)
+parser.add_argument('--runtime',   dest='runtime',   default=None,  help='split the samples into jobs of about this many seconds, needs --rate', type=float)
+parser.add_argument('--rate',      dest='rate',      default=None,  help='events/s of one job with this processor (the events/s line printed by run_htt.py)', type=float)
+parser.add_argument('--dry-run',   dest='dryrun',    action='store_true', help='print the jobs and their expected load without submitting them')
 args = parser.parse_args()
 
 if (not ((len(args.settings) is 3) or (len(args.settings) is 4))):
@@ -28,6 +36,17 @@ if '_2016' in label or '_2017' in label or '_2018' in label:
 script = args.settings[1]
 files_per_job = int(args.settings[2])
 
+if args.runtime and not args.rate:
+    parser.error('--runtime needs the events/s of a job, pass --rate')
+target_events = args.events or (int(args.runtime * args.rate) if args.runtime else None)
+useindex = target_events or args.dryrun
+
+filesets = {
+    '2016': [],
+    '2017': ['fileset2017.json', 'fileset2017UL.json'],
+    '2018': ['fileset2018UL.json'],
+}
+
 loc_base = os.environ['PWD']
 
 samplelist = {
@@ -179,12 +198,24 @@ samplelist['2017'] = []
 #
 #################################################
 
-os.chdir('..')
-os.system('xrdcp -f test/%s root://cmseos.fnal.gov//store/user/drankin/'%script)
-if (len(args.settings) is 4):
-    os.system('tar -zcf dazsle_coffea.tgz . --exclude="*nano*.root" --exclude="*.pdf" --exclude="*.pyc" --exclude=tmp --exclude="*.tgz" --exclude-vcs --exclude-caches-all')
-    os.system('xrdcp -f dazsle_coffea.tgz root://cmseos.fnal.gov//store/user/drankin/dazsle_coffea.tgz')
-os.chdir(loc_base)
+if not args.dryrun:
+    os.chdir('..')
+    os.system('xrdcp -f test/%s root://cmseos.fnal.gov//store/user/drankin/'%script)
+    if (len(args.settings) is 4):
+        os.system('tar -zcf dazsle_coffea.tgz . --exclude="*nano*.root" --exclude="*.pdf" --exclude="*.pyc" --exclude=tmp --exclude="*.tgz" --exclude-vcs --exclude-caches-all')
+        os.system('xrdcp -f dazsle_coffea.tgz root://cmseos.fnal.gov//store/user/drankin/dazsle_coffea.tgz')
+    os.chdir(loc_base)
+
+
+def print_load(sample, jobs, entries):
+    load = [sum(entries[start:stop]) for start, stop in jobs]
+    mean = sum(load) / max(len(load), 1)
+    lo, hi = min(load, default=0), max(load, default=0)
+    line = '%-70s %5d %12d %12d %12d %8.2f' % (sample[:70], len(jobs), lo, mean, hi, hi / mean if mean else 0.)
+    if args.rate:
+        line += ' %10.0f' % (hi / args.rate)
+    print(line)
+    return load
 
 for year in ['2016','2017','2018']:
     if (len(samplelist[year])==0):
@@ -204,38 +235,57 @@ for year in ['2016','2017','2018']:
     ################################################
     print(label,' ',outdir)
     
-    print(str(files_per_job)+' files per job...')
+    if target_events:
+        print('%d events per job, at most %d files per job...' % (target_events, files_per_job))
+    else:
+        print(str(files_per_job)+' files per job...')
     
     #make local directory
     locdir = logdir
-    os.system('mkdir -p  %s' %locdir)
+    if not args.dryrun:
+        os.system('mkdir -p  %s' %locdir)
     
-    print('CONDOR work dir: '+outdir)
-    #os.system('rm -rf '+outdir+label)
-    os.system('mkdir -p /eos/uscms'+outdir)
+        print('CONDOR work dir: '+outdir)
+        #os.system('rm -rf '+outdir+label)
+        os.system('mkdir -p /eos/uscms'+outdir)
     
     totfiles = {}
+    index = {}
     
     if year=='2016':
         print('no 2016 files yet...')
 
-    elif year=='2017':
-        with open('../data/fileset2017.json', 'r') as f:
+    for name in filesets[year]:
+        with open('../data/'+name, 'r') as f:
             newfiles = json.load(f)
             totfiles.update(newfiles)
-        
-        with open('../data/fileset2017UL.json', 'r') as f:
-            newfiles = json.load(f)
-            totfiles.update(newfiles)
-    elif year=='2018':    
-        with open('../data/fileset2018UL.json', 'r') as f:
-            newfiles = json.load(f)
-            totfiles.update(newfiles)
-    else:
-        print('invalid year specified: %s'%year)
+        if useindex:
+            # entries and size of every file, only the files missing from the cached index are opened
+            index.update(loadFileIndex('../data/'+name, [s for s in samplelist[year] if s in newfiles]).files)
     
+    jobs = {}
+    entries = {}
     for sample in samplelist[year]:
-        totfiles[sample] = len(totfiles[sample])
+        nfiles = len(totfiles[sample])
+        if useindex:
+            entries[sample] = [index[url]['entries'] for url in totfiles[sample]]
+        if target_events:
+            # jobs over empty files only have nothing to run on
+            jobs[sample] = [(start, stop) for start, stop in packJobs(entries[sample], target_events, files_per_job) if sum(entries[sample][start:stop])]
+        else:
+            njobs = int(nfiles/files_per_job)+1
+            jobs[sample] = [(j*files_per_job, (j+1)*files_per_job) for j in range(njobs)]
+    
+    if useindex:
+        # expected load of the jobs, the slowest job of a sample sets when its output can be merged
+        print('%-70s %5s %12s %12s %12s %8s' % ('sample', 'jobs', 'min events', 'mean events', 'max events', 'max/mean') + (' %10s' % 'max time [s]' if args.rate else ''))
+        load = []
+        for sample in samplelist[year]:
+            load += print_load(sample, jobs[sample], entries[sample])
+        print_load('total '+year, [(i, i+1) for i in range(len(load))], load)
+    
+    if args.dryrun:
+        continue
     
     nsubmit = 0
     
@@ -244,10 +294,7 @@ for year in ['2016','2017','2018']:
         prefix = sample
         print('Submitting '+prefix)
     
-        njobs = int(totfiles[sample]/files_per_job)+1
-        remainder = totfiles[sample]-int(files_per_job*(njobs-1))
-    
-        for j in range(njobs):
+        for j, (start, stop) in enumerate(jobs[sample]):
     
             condor_templ_file = open(loc_base+"/Coffea.templ.condor")
             sh_templ_file    = open(loc_base+"/Coffea.templ.sh")
@@ -271,11 +318,12 @@ for year in ['2016','2017','2018']:
             sh_file = open(localsh,"w")
             for line in sh_templ_file:
                 line=line.replace('SCRIPTNAME',script)
+                line=line.replace('PROCESSOR',args.processor)
                 line=line.replace('FILENUM',str(j))
                 line=line.replace('YEAR',year)
                 line=line.replace('SAMPLE',sample)
-                line=line.replace('STARTNUM',str(j*files_per_job))
-                line=line.replace('ENDNUM',str((j+1)*files_per_job))
+                line=line.replace('STARTNUM',str(start))
+                line=line.replace('ENDNUM',str(stop))
                 line=line.replace('EOSOUT',eosoutput)
                 sh_file.write(line)
             sh_file.close()
@@ -1,15 +1,20 @@
 #!/usr/bin/python
-from coffea import util,hist
-import json
+from coffea import util
+from boostedhiggs.merging import mergeOutputs, mergeIncremental, printMergeStats, XRootDStorage, LocalStorage, loadXsecs, scaleFactors, scaleOutput
+from concurrent.futures import ThreadPoolExecutor
 import os
-import subprocess
 
 import argparse
 
 from os import listdir
 from os.path import isfile, join
 
-def run_hadd(indir, eosdir, samples, invert, ignore, outname, noscale, noresub, chunk_size):
+storages = {
+    'eos': XRootDStorage,
+    'local': LocalStorage,
+}
+
+def run_hadd(indir, eosdir, samples, invert, ignore, outname, noscale, noresub, workers, fanin, incremental, storage, threads):
 
     if not samples:
         onlyfiles = [f[:-7] for f in os.listdir("../condor/"+indir+"/") if os.path.isfile(os.path.join("../condor/"+indir+"/", f)) and f.endswith(".condor")]
@@ -22,98 +27,48 @@ def run_hadd(indir, eosdir, samples, invert, ignore, outname, noscale, noresub,
             samples = ['MET','SingleElectron','SingleMuon', 'JetHT','Tau','EGamma']
     
     print(len(onlyfiles))
-    os.system('eos root://cmseos.fnal.gov/ ls %s%s/ | wc -l'%(eosdir,indir))
+    # one listing of the output directory instead of one `eos ls` per job
+    listing = storage.list('%s%s/'%(eosdir,indir))
+    print(len(listing))
     
-    missing_files = []
-    for f in onlyfiles:
-        try: 
-            output = subprocess.check_output('eos root://cmseos.fnal.gov/ ls %s%s/%s.coffea'%(eosdir,indir,f), shell=True)
-        except:
-            missing_files.append(f)
-            onlyfiles.remove(f)
+    missing_files = [f for f in onlyfiles if '%s.coffea'%f not in listing]
+    onlyfiles = [f for f in onlyfiles if '%s.coffea'%f in listing]
  
     if not missing_files or ignore:
         if not not missing_files:
             print('Missing files (ignoring them):')
             print(missing_files)
-        chunk_names = []
-        for i in range(0,len(onlyfiles),chunk_size):
-          print('Chunk',i)
-          flist = []
-          if (i+chunk_size<len(onlyfiles)):
-            for fi in onlyfiles[i:i+chunk_size]:
-              x = "%s/%s.coffea"%(indir,fi)
-              os.system("xrdcp -f root://cmseos.fnal.gov/%s%s %s/"%(eosdir,x,indir))
-              flist.append(util.load(x))
-          else:
-            for fi in onlyfiles[i:]:
-              x = "%s/%s.coffea"%(indir,fi)
-              os.system("xrdcp -f root://cmseos.fnal.gov/%s%s %s/"%(eosdir,x,indir))
-              flist.append(util.load(x))
-        
-          for key in flist[0]:
-            if isinstance(flist[0][key], hist.Hist):
-              for fi in range(1,len(flist)):
-                flist[0][key].add(flist[fi][key])
-            else:
-              for fi in range(1,len(flist)):
-                flist[0][key] = flist[0][key] + flist[fi][key]
-          
-          util.save(flist[0],'%s/%s_%i.coffea' % (indir,outname,i))
-        
-          for f in flist:
-            del f
-          if (i+chunk_size<len(onlyfiles)):
-            for fi in onlyfiles[i:i+chunk_size]:
-              x = "%s/%s.coffea"%(indir,fi)
-              os.system("rm %s"%x)
-          else:
-            for fi in onlyfiles[i:]:
-              x = "%s/%s.coffea"%(indir,fi)
-              os.system("rm %s"%x)
-        
-          chunk_names.append('%s/%s_%i.coffea' % (indir,outname,i))
-        
-        print(chunk_names)
-        
-        flist = [ util.load(x) for x in chunk_names ]
+        copies = []
+        def fetch(remote):
+            x = storage.fetch(remote, indir)
+            if os.path.abspath(x) != os.path.abspath(remote):
+                copies.append(x)
+            return x
 
-        for key in flist[0]:
-          if isinstance(key, hist.Hist):
-            for fi in range(1,len(flist)):
-              flist[0][key].add(flist[fi][key])
-          else:
-            for fi in range(1,len(flist)):
-              flist[0][key] = flist[0][key] + flist[fi][key]
-          
-        xs = {}
-        with open('../data/xsec.json', 'r') as f:
-            xs = json.load(f)
-            
-        scale1fb = {k: xs[k] * 1000. / w for k, w in flist[0]['sumw'].items()}
-
-        print('sum weights  ',{k: w for k, w in flist[0]['sumw'].items()})
-        print('scaling using',scale1fb)
+        # the copies run in a thread pool and are merged as they arrive
+        remote = {fi: "%s%s/%s.coffea"%(eosdir,indir,fi) for fi in onlyfiles}
+        if incremental:
+            # only the new or changed outputs are copied, the running sum has to stay unscaled
+            sumname = outname if noscale else outname + '_unscaled'
+            out, stats = mergeIncremental(remote, '%s/%s.coffea' % (indir,sumname), workers, fanin,
+                                          stat=lambda x: listing[os.path.basename(x)], fetch=fetch, threads=threads,
+                                          checksum=storage.checksum)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as transfers:
+                out, stats = mergeOutputs([transfers.submit(fetch, x) for x in remote.values()], workers, fanin)
+        printMergeStats(stats)
+        for x in copies:
+            os.remove(x)
 
-        for s in samples:
-            if s not in scale1fb: scale1fb[s] = 1.
-        
+        print('sum weights  ',{k: w for k, w in out['sumw'].items()})
         print('noscale =',noscale)
         if not noscale:
-            for key in flist[0]:
-                if isinstance(flist[0][key], hist.Hist):
-                    flist[0][key].scale(scale1fb, 'dataset')
-                else:
-                    if key=='sumw':
-                        continue
-                    for samp in flist[0][key]:
-                        for x in flist[0][key][samp]:
-                            flist[0][key][samp][x] = flist[0][key][samp][x]*scale1fb[samp]
-            
-          
-        util.save(flist[0],'%s/%s.coffea' % (indir,outname))
-        for i,x in enumerate(chunk_names):
-          os.system("rm %s/%s_%i.coffea" % (indir,outname,i*chunk_size))
+            scale1fb = scaleFactors(out['sumw'], loadXsecs('../data/xsec.json'))
+            print('scaling using',scale1fb)
+            scaleOutput(out, scale1fb)
+
+        if not (incremental and noscale):
+            util.save(out,'%s/%s.coffea' % (indir,outname))
     
     else:
         for mf in missing_files:
@@ -304,16 +259,21 @@ parser.add_argument('--samples', metavar='samples', help='samples', nargs='+')
 parser.add_argument('-i', '--invert', action='store_true')
 parser.add_argument('--ignore', action='store_true')
 parser.add_argument('--outname', metavar='outname', default='hists_sum', help='outname', type=str)
-parser.add_argument('-n', '--noscale', action='store_true')
+parser.add_argument('-n', '--noscale', action='store_true', help='keep the output unscaled, the plotting scripts can scale it at read time with --xsec')
 parser.add_argument('--noresub', action='store_true')
 parser.add_argument('--sampsplit', action='store_true')
 parser.add_argument('--year', metavar='year', default='2017', help='year')
 parser.add_argument('--fullsplit', action='store_true')
-parser.add_argument('--chunk', metavar='chunk', help='chunk size', type=int, default=10)
+parser.add_argument('--fanin', '--chunk', dest='fanin', help='maximum number of files added by one merge task', type=int, default=10)
+parser.add_argument('--workers', dest='workers', help='number of merge processes', type=int, default=4)
+parser.add_argument('--incremental', action='store_true', help='only copy and add new or changed outputs to the sum of the previous run')
+parser.add_argument('--storage', dest='storage', default='eos', choices=sorted(storages), help='where the job outputs are (local: eosdir is a local directory)')
+parser.add_argument('--threads', dest='threads', help='number of concurrent copies', type=int, default=8)
 args = parser.parse_args()
+storage = storages[args.storage]()
 
 if not args.sampsplit:
-    run_hadd(args.indir, args.eosdir, args.samples, args.invert, args.ignore, args.outname, args.noscale, args.noresub, args.chunk)
+    run_hadd(args.indir, args.eosdir, args.samples, args.invert, args.ignore, args.outname, args.noscale, args.noresub, args.workers, args.fanin, args.incremental, storage, args.threads)
 
 else:
     if not args.samples:
@@ -335,8 +295,8 @@ else:
     
     for block in theblocks:
         if not args.fullsplit:
-            run_hadd(args.indir, args.eosdir, samp_dict[args.year][block], args.invert, args.ignore, "%s_%s"%(args.outname,block), True if block in datalist else args.noscale, args.noresub, args.chunk)
+            run_hadd(args.indir, args.eosdir, samp_dict[args.year][block], args.invert, args.ignore, "%s_%s"%(args.outname,block), True if block in datalist else args.noscale, args.noresub, args.workers, args.fanin, args.incremental, storage, args.threads)
         else:
             for bs in samp_dict[args.year][block]:
-                run_hadd(args.indir, args.eosdir, [bs], args.invert, args.ignore, "%s_%s"%(args.outname,bs), True if block in datalist else args.noscale, args.noresub, args.chunk)
+                run_hadd(args.indir, args.eosdir, [bs], args.invert, args.ignore, "%s_%s"%(args.outname,bs), True if block in datalist else args.noscale, args.noresub, args.workers, args.fanin, args.incremental, storage, args.threads)
 
@@ -0,0 +1,37 @@
+import os
+import glob
+import json
+
+from boostedhiggs.fileindex import FileIndex
+
+import argparse
+
+#python make_fileindex.py fileset2017UL.json fileset2018UL.json --threads 32
+parser = argparse.ArgumentParser(description='Index the entries, sizes, branches and checksums of the files of the filesets')
+parser.add_argument('filesets',   metavar='fileset',   default=None, help='fileset json files (default all fileset*.json next to this script)', nargs='*')
+parser.add_argument('--samples',  dest='samples',      default=None, help='only index these datasets', nargs='+')
+parser.add_argument('--tree',     dest='tree',         default='Events', help='tree name')
+parser.add_argument('--threads',  dest='threads',      default=16,   help='files opened at a time', type=int)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+filesets = args.filesets or sorted(glob.glob(os.path.join(here, 'fileset*.json')))
+for name in filesets:
+    if name.endswith('.index.json'):
+        continue
+    with open(name) as f:
+        fileset = json.load(f)
+    index = FileIndex(name, args.tree)
+    urls = [url for sample in (args.samples or fileset) for url in fileset.get(sample, [])]
+    stats = index.update(urls, args.threads)
+    print('%s: %d files indexed, %d refreshed, %d unchanged, %d failed' % (index.path, stats['indexed'], stats['refreshed'], stats['unchanged'], len(stats['failed'])))
+    for url, error in sorted(stats['failed'].items()):
+        print('  failed %s: %s' % (url, error))
+    for sample in sorted(s for s in fileset if args.samples is None or s in args.samples):
+        files = [index.files[url] for url in fileset[sample] if url in index.files]
+        empty = sum(1 for f in files if not f['entries'])
+        missing = len(fileset[sample]) - len(files)
+        print('  %-70s %6d files %12d events %8.1f GB%s%s' % (
+            sample[:70], len(files), sum(f['entries'] for f in files), sum(f['bytes'] for f in files) / 1024.**3,
+            ' (%d empty)' % empty if empty else '', ' (%d not indexed)' % missing if missing else '',
+        ))
@@ -30,7 +30,7 @@ setup(name="boostedhiggs",
       license="BSD 3-clause",
       test_suite="tests",
       install_requires=[
-          "coffea>=0.6.33",
+          "coffea>=0.6.33,<0.7",
           "rhalphalib",
           "pandas",
       ],
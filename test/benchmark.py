@@ -0,0 +1,800 @@
+import os
+import shutil
+import multiprocessing
+import tempfile
+import time
+import timeit
+import numpy as np
+import awkward
+import uproot
+
+from boostedhiggs.common import ChunkCache, singletonJagged, decode_vid_bitmap, getParticles, getHTauTauDecayInfo, getBosons, metP4, PairMatcher, match, matchedBosonFlavor, matchedBosonFlavorLep
+from boostedhiggs.corrections import corrections, lepton_sf_dict, lepton_sf_ptrange, add_LeptonSFs, corrected_msoftdrop, add_pileup_weight, add_VJets_NLOkFactor, notUL2017, puW2017_nonUL, Vpt_corr_bins, Vpt_corr_value
+from coffea.nanoaod import NanoEvents
+from uproot_methods import TLorentzVectorArray
+from coffea.processor import Weights
+from coffea import hist, util
+from boostedhiggs import HtautauProcessor_NN
+from boostedhiggs.btag import BTagCorrector, BTagScaleFactorTable
+from boostedhiggs.merging import mergeOutputs, mergeIncremental, fileChecksum, LocalStorage, loadXsecs, scaleFactors, scaleOutput
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+
+
+def _virtual(array):
+    return awkward.VirtualArray(lambda: array, type=awkward.type.ArrayType(len(array), array.dtype))
+
+
+def lazyEvents(arrays):
+    '''NanoEvents over lazy views of ``arrays`` (branch name -> flat array)
+
+    Build fresh events for every call under test, so that no implementation reuses
+    the columns materialized by another.
+    '''
+    return NanoEvents.from_arrays({k: _virtual(v) for k, v in arrays.items()})
+
+
+def bench_singleton(sizes, repeat):
+    print('%10s %14s %14s %10s' % ('chunk', 'fromiter [ms]', 'offsets [ms]', 'speed-up'))
+    for size in sizes:
+        values = np.random.uniform(0., 1., size).astype(np.float32)
+        ref = awkward.JaggedArray.fromiter([[v] for v in values])
+        new = singletonJagged(values)
+        assert (ref.counts == new.counts).all() and (ref.content == new.content).all()
+        t_ref = min(timeit.repeat(lambda: awkward.JaggedArray.fromiter([[v] for v in values]), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: singletonJagged(values), number=1, repeat=repeat))
+        print('%10d %14.3f %14.3f %10.1f' % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_vid(sizes, repeat):
+    def loop(bitmap, level):
+        cuts = [(np.bitwise_and(np.right_shift(bitmap, bitmap.ones_like()*(3*k)), bitmap.ones_like()*7) >= level) for k in range(10) if k != 7]
+        mask = cuts[0].ones_like().astype(bool)
+        for m in cuts: mask = mask & m
+        return mask
+    levels = (1, 2, 3, 4)
+    print('%10s %14s %14s %10s' % ('chunk', 'loop [ms]', 'decode [ms]', 'speed-up'))
+    for size in sizes:
+        counts = np.random.poisson(1.5, size)
+        fields = np.random.choice(5, size=(counts.sum(), 10), p=[0.05, 0.05, 0.1, 0.2, 0.6]).astype(np.int32)
+        bitmap = awkward.JaggedArray.fromcounts(counts, (fields << (3 * np.arange(10, dtype=np.int32))).sum(axis=1).astype(np.int32))
+        ref = [loop(bitmap, level) for level in levels]
+        new = decode_vid_bitmap(bitmap, levels)
+        assert all((r.flatten() == n.flatten()).all() for r, n in zip(ref, new))
+        t_ref = min(timeit.repeat(lambda: [loop(bitmap, level) for level in levels], number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: decode_vid_bitmap(bitmap, levels), number=1, repeat=repeat))
+        print('%10d %14.3f %14.3f %10.1f' % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_leptonsf(sizes, repeat):
+    # add_LeptonSFs before the batched evaluator, verbatim (nominal weights are unchanged)
+    lepsf_evaluator = corrections['lepton_sf']
+    def loop(weights, lep_pt, lep_eta, year, match):
+        lep_pt  = lep_pt.pad(1, clip=True).fillna(0).flatten()
+        lep_eta = lep_eta.pad(1, clip=True).fillna(0).flatten()
+        for sf in lepton_sf_dict:
+            if match in sf:
+                if lepton_sf_dict[sf][3]==0:
+                    nom = lepsf_evaluator['%s_value'%sf](lep_eta,lep_pt)
+                    err = lepsf_evaluator['%s_value'%sf](lep_eta,lep_pt)
+                elif lepton_sf_dict[sf][3]==1:
+                    nom = lepsf_evaluator['%s_value'%sf](np.abs(lep_eta),lep_pt)
+                    err = lepsf_evaluator['%s_value'%sf](np.abs(lep_eta),lep_pt)
+                elif lepton_sf_dict[sf][3]==2:
+                    nom = lepsf_evaluator['%s_value'%sf](lep_pt,np.abs(lep_eta))
+                    err = lepsf_evaluator['%s_value'%sf](lep_pt,np.abs(lep_eta))
+                else: 
+                    print('invalid type ordering for lepton SF %s'%sf)
+                    return
+                wname = sf
+                if "TRIG27" in sf:
+                    nom[lep_pt>55.] = 1.
+                    err[lep_pt>55.] = 0.
+                if "TRIG50" in sf:
+                    nom[lep_pt<55.] = 1.
+                    err[lep_pt<55.] = 0.
+                if "TRIG32" in sf:
+                    nom[lep_pt>120.] = 1.
+                    err[lep_pt>120.] = 0.
+                if "TRIG115" in sf:
+                    nom[lep_pt<120.] = 1.
+                    err[lep_pt<120.] = 0.
+                weights.add(sf, nom, nom+err, nom-err)
+    corrections['lepton_sf_batched']
+    print('%10s %6s %14s %14s %10s' % ('chunk', 'match', 'loop [ms]', 'batched [ms]', 'speed-up'))
+    for size in sizes:
+        counts = np.random.poisson(0.8, size)
+        pt = np.random.exponential(60., counts.sum()) + 10.
+        # leptons right at the trigger SF pt thresholds
+        pt[:4] = [55., 120., 55., 120.][:pt.size]
+        lep_pt = awkward.JaggedArray.fromcounts(counts, pt)
+        lep_eta = awkward.JaggedArray.fromcounts(counts, np.random.uniform(-2.5, 2.5, counts.sum()))
+        for pattern in ['elec', 'muon', 'muon_TRIG']:
+            ref, new = Weights(size), Weights(size)
+            loop(ref, lep_pt, lep_eta, '2017', pattern)
+            add_LeptonSFs(new, lep_pt, lep_eta, '2017', pattern)
+            assert ref.variations == new.variations
+            assert np.array_equal(ref.weight(), new.weight())
+            # the loop took the uncertainty from the *_value lookup, it now comes from the *_error one
+            pt, eta = lep_pt.pad(1, clip=True).fillna(0).flatten(), lep_eta.pad(1, clip=True).fillna(0).flatten()
+            names, nom, up, down = corrections['lepton_sf_batched'](pattern, pt, eta)
+            for sf, n, u, d in zip(names, nom, up, down):
+                x, y = [(eta, pt), (np.abs(eta), pt), (pt, np.abs(eta))][lepton_sf_dict[sf][3]]
+                ptmin, ptmax = lepton_sf_ptrange.get(sf, (None, None))
+                inside = ((pt >= ptmin) if ptmin is not None else True) & ((pt <= ptmax) if ptmax is not None else True)
+                err = np.where(inside, lepsf_evaluator['%s_error' % sf](x, y), 0.)
+                assert np.array_equal(u, n + err) and np.array_equal(d, n - err)
+            t_ref = min(timeit.repeat(lambda: loop(Weights(size), lep_pt, lep_eta, '2017', pattern), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: add_LeptonSFs(Weights(size), lep_pt, lep_eta, '2017', pattern), number=1, repeat=repeat))
+            print('%10d %6s %14.3f %14.3f %10.1f' % (size, pattern, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_btag(sizes, repeat):
+    # b-tag SFs and weights from the tabulated SFs (compiled) against the CSV formulas (compiled=False)
+    systematics = BTagScaleFactorTable.systematics
+    print('%6s %10s %10s %10s %14s %14s %10s' % ('year', 'chunk', 'max dSF', 'max dw', 'formulas [ms]', 'table [ms]', 'speed-up'))
+    for year in ('2016', '2017', '2018'):
+        ref, new = BTagCorrector(year, 'medium', compiled=False), BTagCorrector(year, 'medium')
+        # every flavour at the CSV pt and |eta| bin edges, just around them, and outside of their range
+        corrections = [ref.sf._corrections[syst] for syst in systematics]
+        etaedges = np.unique(np.concatenate([corr[0] for corr in corrections]))
+        ptedges = np.unique(np.concatenate([corr[1] for corr in corrections]))
+        pt = np.concatenate([ptedges, ptedges - 1e-3, ptedges + 1e-3, [1., ptedges[0] - 5., ptedges[-1] + 1., 5000.]])
+        abseta = np.concatenate([etaedges, np.maximum(etaedges - 1e-3, 0.), etaedges + 1e-3, [3.]])
+        flavor, abseta, pt = (x.ravel() for x in np.meshgrid([0, 4, 5], abseta, pt, indexing='ij'))
+        sf_ref = np.stack([ref.sf.eval(syst, flavor, abseta, pt) for syst in systematics])
+        sf_new = new.sf(flavor, abseta, pt)
+        dsf = np.max(np.abs(sf_new / sf_ref - 1))
+        assert dsf < 1e-6, (year, dsf)
+        for size in sizes:
+            counts = np.random.poisson(3., size).astype(np.int32)
+            njet = counts.sum()
+            arrays = {
+                'nJet': counts,
+                'Jet_pt': (np.random.exponential(80., njet) + 20.).astype(np.float32),
+                'Jet_eta': np.random.uniform(-2.5, 2.5, njet).astype(np.float32),
+                'Jet_phi': np.random.uniform(-np.pi, np.pi, njet).astype(np.float32),
+                'Jet_mass': np.random.uniform(0., 20., njet).astype(np.float32),
+                'Jet_hadronFlavour': np.random.choice([0, 4, 5], njet, p=[0.7, 0.15, 0.15]).astype(np.int32),
+                'Jet_btagDeepB': np.random.uniform(0., 1., njet).astype(np.float32),
+            }
+            jets = lazyEvents(arrays).Jet
+            w_ref, w_new = Weights(size), Weights(size)
+            ref.addBtagWeight(w_ref, jets)
+            new.addBtagWeight(w_new, jets)
+            assert w_ref.variations == w_new.variations
+            dw = max(np.max(np.abs(w_new.weight(v) / w_ref.weight(v) - 1)) for v in [None] + sorted(w_ref.variations))
+            assert dw < 1e-5, (year, dw)
+            t_ref = min(timeit.repeat(lambda: ref.addBtagWeight(Weights(size), jets), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: new.addBtagWeight(Weights(size), jets), number=1, repeat=repeat))
+            print('%6s %10d %10.1e %10.1e %14.3f %14.3f %10.1f' % (year, size, dsf, dw, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_msdcorr(sizes, repeat):
+    # corrected_msoftdrop before the flat subjet sums and Horner's scheme
+    def reference(fatjets):
+        gpar = np.array([1.00626, -1.06161, 0.0799900, 1.20454])
+        cpar = np.array([1.09302, -0.000150068, 3.44866e-07, -2.68100e-10, 8.67440e-14, -1.00114e-17])
+        fpar = np.array([1.27212, -0.000571640, 8.37289e-07, -5.20433e-10, 1.45375e-13, -1.50389e-17])
+        pt, eta = fatjets.pt.flatten(), fatjets.eta.flatten()
+        genw = gpar[0] + gpar[1]*np.power(pt*gpar[2], -gpar[3])
+        ptpow = np.power.outer(pt, np.arange(cpar.size))
+        weight = np.where(np.abs(eta) < 1.3, np.dot(ptpow, cpar), np.dot(ptpow, fpar))
+        sf_flat = np.maximum(1e-5, genw*weight)
+        dazsle = (fatjets.subjets * (1 - fatjets.subjets.rawFactor)).sum()
+        return dazsle.mass * awkward.JaggedArray.fromoffsets(fatjets.array.offsets, sf_flat), dazsle.t.flatten() * sf_flat
+
+    def columns(size):
+        nfatjet = np.random.poisson(1.5, size).astype(np.int32)
+        njet = nfatjet.sum()
+        nsubjet = np.random.poisson(2.2, size).astype(np.int32)
+        nsub = nsubjet.sum()
+        idx = np.random.randint(-1, 3, size=(2, njet))
+        idx[idx >= np.repeat(nsubjet, nfatjet)] = -1
+        arrays = {
+            'nFatJet': nfatjet,
+            'FatJet_pt': np.random.exponential(150., njet).astype(np.float32) + 200.,
+            'FatJet_eta': np.random.uniform(-2.5, 2.5, njet).astype(np.float32),
+            'FatJet_phi': np.random.uniform(-np.pi, np.pi, njet).astype(np.float32),
+            'FatJet_mass': np.random.uniform(10., 200., njet).astype(np.float32),
+            'FatJet_subJetIdx1': idx[0].astype(np.int32),
+            'FatJet_subJetIdx2': idx[1].astype(np.int32),
+            'nSubJet': nsubjet,
+            'SubJet_pt': np.random.exponential(80., nsub).astype(np.float32) + 30.,
+            'SubJet_eta': np.random.uniform(-2.5, 2.5, nsub).astype(np.float32),
+            'SubJet_phi': np.random.uniform(-np.pi, np.pi, nsub).astype(np.float32),
+            'SubJet_mass': np.random.uniform(0., 60., nsub).astype(np.float32),
+            'SubJet_rawFactor': np.random.uniform(0., 0.2, nsub).astype(np.float32),
+        }
+        return arrays
+
+    print('%10s %14s %14s %10s' % ('chunk', 'subjets [ms]', 'flat [ms]', 'speed-up'))
+    for size in sizes:
+        arrays = columns(size)
+        ref, energy = reference(lazyEvents(arrays).FatJet)
+        new = corrected_msoftdrop(lazyEvents(arrays).FatJet)
+        assert (ref.counts == new.counts).all()
+        # the reference sums float32 four-vectors, so its mass squared is only good to float32
+        # precision of the energy squared (and is NaN for some light subjet systems)
+        valid = ~np.isnan(ref.flatten())
+        assert (np.abs(ref.flatten()**2 - new.flatten()**2) <= 1e-6 * energy**2)[valid].all()
+        t_ref = min(timeit.repeat(lambda: reference(lazyEvents(arrays).FatJet), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: corrected_msoftdrop(lazyEvents(arrays).FatJet), number=1, repeat=repeat))
+        print('%10d %14.3f %14.3f %10.1f' % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_genhtt(sizes, repeat):
+    # getHTauTauDecayInfo before the flat columns, with its concatenate, pad and cross
+    def reference(events, mod):
+        genvistau_higgs = events.GenVisTau
+        ngenvistau_higgs = (genvistau_higgs.pt.fillna(0.)>0.).sum()
+        el_taus = getParticles(events,11,11,['isDirectTauDecayProduct'])
+        mu_taus = getParticles(events,13,13,['isDirectTauDecayProduct'])
+        nel_taus = (el_taus.pt.fillna(0.)>0.).sum()
+        nmu_taus = (mu_taus.pt.fillna(0.)>0.).sum()
+        tau_pt = awkward.concatenate([genvistau_higgs.pt, el_taus.pt, mu_taus.pt], axis=1).pad(2, clip=True)
+        tau_eta = awkward.concatenate([genvistau_higgs.eta, el_taus.eta, mu_taus.eta], axis=1).pad(2, clip=True)
+        tau_phi = awkward.concatenate([genvistau_higgs.phi, el_taus.phi, mu_taus.phi], axis=1).pad(2, clip=True)
+        tau_mass = awkward.concatenate([genvistau_higgs.mass, el_taus.mass, mu_taus.mass], axis=1).pad(2, clip=True)
+        tau_p4 = TLorentzVectorArray.from_ptetaphim(tau_pt.fillna(0),tau_eta.fillna(0),tau_phi.fillna(0),tau_mass.fillna(0))
+        tau_pair = tau_p4.cross(tau_p4)
+        tau_pair_dr = tau_pair.i0.delta_r(tau_pair.i1)
+        genvistau1_decay = genvistau_higgs[:,0:1].status.pad(1,clip=True).fillna(15).flatten()
+        genvistau2_decay = genvistau_higgs[:,1:2].status.pad(1,clip=True).fillna(15).flatten()
+        genHTauTauDecay = np.zeros_like(ngenvistau_higgs) + 1*np.array((ngenvistau_higgs==2) & (nel_taus==0) & (nmu_taus==0)).astype(int) + 2*np.array((ngenvistau_higgs==1) & (nel_taus==1) & (nmu_taus==0)).astype(int) + 3*np.array((ngenvistau_higgs==1) & (nel_taus==0) & (nmu_taus==1)).astype(int) + 4*np.array((ngenvistau_higgs==0) & (nel_taus==1) & (nmu_taus==1)).astype(int) + 5*np.array((ngenvistau_higgs==0) & (nel_taus==2) & (nmu_taus==0)).astype(int) + 6*np.array((ngenvistau_higgs==0) & (nel_taus==0) & (nmu_taus==2)).astype(int)
+        close = np.array(((tau_pair_dr<0.8) & (tau_pair_dr>0.)).any() & (tau_pt[:,:2]>25.).all()).astype(float)
+        genHTauTauDecay = genHTauTauDecay * (close if mod else 2*close-1)
+        genHadTau1Decay = np.zeros_like(genvistau1_decay) + 1*np.array((genvistau1_decay==0)).astype(int) + 2*np.array((genvistau1_decay==1)  | (genvistau1_decay==2)).astype(int) + 3*np.array((genvistau1_decay==10) | (genvistau1_decay==11)).astype(int)
+        genHadTau2Decay = np.zeros_like(genvistau2_decay) + 1*np.array((genvistau2_decay==0)).astype(int) + 2*np.array((genvistau2_decay==1)  | (genvistau2_decay==2)).astype(int) + 3*np.array((genvistau2_decay==10) | (genvistau2_decay==11)).astype(int)
+        return genHTauTauDecay, genHadTau1Decay, genHadTau2Decay
+
+    def columns(size):
+        ngenpart = np.random.poisson(4., size).astype(np.int32)
+        ngen = ngenpart.sum()
+        ngenvistau = np.random.choice(4, size=size, p=[0.3, 0.3, 0.3, 0.1]).astype(np.int32)
+        nvis = ngenvistau.sum()
+        # narrow angular ranges and a soft pt spectrum, so that all of the dR and pt requirements are exercised
+        return {
+            'nGenPart': ngenpart,
+            'GenPart_pt': np.random.choice([0., 10., 40.], ngen).astype(np.float32) + np.random.exponential(20., ngen).astype(np.float32),
+            'GenPart_eta': np.random.uniform(-1., 1., ngen).astype(np.float32),
+            'GenPart_phi': np.random.choice([-3.1, 0., 3.1], ngen).astype(np.float32) + np.random.uniform(-0.4, 0.4, ngen).astype(np.float32),
+            'GenPart_mass': np.zeros(ngen, dtype=np.float32),
+            'GenPart_pdgId': (np.random.choice([11, 13, 15, 22, 211], ngen) * np.random.choice([-1, 1], ngen)).astype(np.int32),
+            'GenPart_statusFlags': np.random.randint(0, 1 << 15, ngen).astype(np.int32),
+            'GenPart_genPartIdxMother': np.full(ngen, -1, dtype=np.int32),
+            'nGenVisTau': ngenvistau,
+            'GenVisTau_pt': np.random.exponential(30., nvis).astype(np.float32) * np.random.choice([0., 1.], nvis, p=[0.05, 0.95]).astype(np.float32),
+            'GenVisTau_eta': np.random.uniform(-1., 1., nvis).astype(np.float32),
+            'GenVisTau_phi': np.random.choice([-3.1, 0., 3.1], nvis).astype(np.float32) + np.random.uniform(-0.4, 0.4, nvis).astype(np.float32),
+            'GenVisTau_mass': np.random.uniform(0., 1.5, nvis).astype(np.float32),
+            'GenVisTau_status': np.random.choice([0, 1, 2, 5, 10, 11, 15], nvis).astype(np.int32),
+            'GenVisTau_genPartIdxMother': np.full(nvis, -1, dtype=np.int32),
+        }
+
+    # regression against the outputs of the old getHTauTauDecayInfo on the fixture written by make_genhtt_fixture.py
+    here = os.path.dirname(os.path.abspath(__file__))
+    stored = np.load(os.path.join(here, 'data', 'genhtt_reference.npz'))
+    for mod in (False, True):
+        new = getHTauTauDecayInfo(NanoEvents.from_file(os.path.join(here, 'data', 'genhtt_nano.root')), mod)
+        for name, n in zip(('genHTauTauDecay', 'genHadTau1Decay', 'genHadTau2Decay'), new):
+            r = stored['%s_mod%d' % (name, mod)]
+            assert r.dtype == n.dtype and np.array_equal(r, n), (name, mod)
+
+    print('%10s %5s %14s %14s %10s' % ('chunk', 'mod', 'cross [ms]', 'flat [ms]', 'speed-up'))
+    for size in sizes:
+        arrays = columns(size)
+        for mod in (False, True):
+            ref = reference(lazyEvents(arrays), mod)
+            new = getHTauTauDecayInfo(lazyEvents(arrays), mod)
+            assert all(r.dtype == n.dtype and np.array_equal(r, n) for r, n in zip(ref, new))
+            t_ref = min(timeit.repeat(lambda: reference(lazyEvents(arrays), mod), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: getHTauTauDecayInfo(lazyEvents(arrays), mod), number=1, repeat=repeat))
+            print('%10d %5s %14.3f %14.3f %10.1f' % (size, mod, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_matching(sizes, repeat):
+    # the cross product patterns of the processors and the matching helpers before PairMatcher
+    def flavor(candidates, bosons, maxdR=0.8):
+        matched = match(candidates, bosons, lambda a, b: a.delta_r(b), maxdR)
+        childid = abs(matched.children.pdgId)
+        return ((childid == 5).any() * 3 + (childid == 4).any() * 2 + (childid < 4).all() * 1).fillna(0)
+
+    def flavorLep(candidates, bosons, maxdR=0.8):
+        matched = match(candidates, bosons, lambda a, b: a.delta_r(b), maxdR)
+        childid = abs(matched.children.pdgId)
+        return ((childid == 13).any() * 3 + (childid == 11).any() * 2 + (childid == 15).any() * 1 + ((childid != 15) & (childid != 13) & (childid != 11)).all() * 0).fillna(0)
+
+    def reference(events):
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
+        candidatejets = events.FatJet[events.FatJet.pt > 300]
+        ak8_met_pair = candidatejets.cross(met_p4)
+        ak8_met_dphi = abs(ak8_met_pair.i0.delta_phi(ak8_met_pair.i1))
+        candidatejet = candidatejets[ak8_met_dphi.argmin()]
+        jets = events.Jet[:, :4]
+        ak4_ak8_pair = jets.cross(candidatejet, nested=True)
+        ak4_ak8_dphi = abs(ak4_ak8_pair.i0.delta_phi(ak4_ak8_pair.i1))
+        ak4_ak8_dr = ak4_ak8_pair.i0.delta_r(ak4_ak8_pair.i1)
+        tau_ak8_pair = events.Jet.cross(candidatejet)
+        lep_ak8_pair = events.Jet[:, :1].cross(candidatejet)
+        bosons = getBosons(events)
+        nearest = events.Jet.cross(events.FatJet, nested=True)
+        return [
+            ak8_met_dphi, (ak4_ak8_dphi > np.pi / 2).all(), (ak4_ak8_dr > 0.8).all(),
+            (tau_ak8_pair.i0.delta_r(tau_ak8_pair.i1) < 0.8).any(), lep_ak8_pair.i0.delta_r(lep_ak8_pair.i1),
+            nearest.i0.delta_r(nearest.i1).argmin(), flavor(candidatejet, bosons), flavorLep(candidatejet, bosons),
+        ]
+
+    def matched(events):
+        met_p4 = metP4(events.MET.pt, events.MET.phi)
+        candidatejets = events.FatJet[events.FatJet.pt > 300]
+        ak8_met_dphi = PairMatcher(candidatejets, met_p4).min('dphi')
+        candidatejet = candidatejets[ak8_met_dphi.argmin()]
+        ak4_ak8 = PairMatcher(events.Jet[:, :4], candidatejet)
+        bosons = getBosons(events)
+        return [
+            ak8_met_dphi, ak4_ak8.min('dphi') > np.pi / 2, ak4_ak8.min('dr') > 0.8,
+            PairMatcher(events.Jet, candidatejet).within(0.8).any(), PairMatcher(events.Jet[:, :1], candidatejet).pairs('dr'),
+            PairMatcher(events.Jet, events.FatJet).argmin(), matchedBosonFlavor(candidatejet, bosons), matchedBosonFlavorLep(candidatejet, bosons),
+        ]
+
+    def same(ref, new):
+        if isinstance(ref, np.ndarray):
+            return ref.dtype == new.dtype and np.array_equal(ref, new)
+        if isinstance(ref.content, awkward.JaggedArray):
+            # argmin of a nested cross product: one (empty or singleton) index list per left object
+            ref = ref.flatten()
+            return (new.flatten() == ref.pad(1).fillna(-1).flatten()).all()
+        return (ref.counts == new.counts).all() and ref.flatten().dtype == new.flatten().dtype and np.array_equal(ref.flatten(), new.flatten())
+
+    def columns(size):
+        nfatjet = np.random.poisson(1.5, size).astype(np.int32)
+        nfat = nfatjet.sum()
+        njet = np.random.poisson(5., size).astype(np.int32)
+        nj = njet.sum()
+        ngenpart = np.random.poisson(6., size).astype(np.int32)
+        ngen = ngenpart.sum()
+        # mothers are earlier particles of the same event
+        local = np.arange(ngen) - np.repeat(np.cumsum(ngenpart) - ngenpart, ngenpart)
+        mother = np.floor(np.random.uniform(-0.3, 1., ngen) * local).astype(np.int32)
+        mother[mother < 0] = -1
+        flags = (1 << 8) | (1 << 13)
+        arrays = {
+            'nFatJet': nfatjet,
+            'FatJet_pt': np.random.exponential(150., nfat).astype(np.float32) + 200.,
+            'FatJet_eta': np.random.uniform(-2., 2., nfat).astype(np.float32),
+            'FatJet_phi': np.random.uniform(-np.pi, np.pi, nfat).astype(np.float32),
+            'FatJet_mass': np.random.uniform(10., 200., nfat).astype(np.float32),
+            'nJet': njet,
+            'Jet_pt': np.random.exponential(50., nj).astype(np.float32) + 30.,
+            'Jet_eta': np.random.uniform(-2., 2., nj).astype(np.float32),
+            'Jet_phi': np.random.uniform(-np.pi, np.pi, nj).astype(np.float32),
+            'Jet_mass': np.random.uniform(0., 20., nj).astype(np.float32),
+            'MET_pt': np.random.exponential(50., size).astype(np.float32),
+            'MET_phi': np.random.uniform(-np.pi, np.pi, size).astype(np.float32),
+            'nGenPart': ngenpart,
+            'GenPart_pt': np.random.exponential(100., ngen).astype(np.float32),
+            'GenPart_eta': np.random.uniform(-2., 2., ngen).astype(np.float32),
+            'GenPart_phi': np.random.uniform(-np.pi, np.pi, ngen).astype(np.float32),
+            'GenPart_mass': np.zeros(ngen, dtype=np.float32),
+            'GenPart_pdgId': (np.random.choice([1, 4, 5, 11, 13, 15, 21, 22, 23, 24, 25], ngen) * np.random.choice([-1, 1], ngen)).astype(np.int32),
+            'GenPart_statusFlags': np.where(np.random.uniform(size=ngen) < 0.7, flags, 0).astype(np.int32),
+            'GenPart_genPartIdxMother': mother,
+        }
+        return arrays
+
+    print('%10s %14s %14s %10s' % ('chunk', 'cross [ms]', 'matcher [ms]', 'speed-up'))
+    for size in sizes:
+        arrays = columns(size)
+        ref = reference(lazyEvents(arrays))
+        new = matched(lazyEvents(arrays))
+        for i, (r, n) in enumerate(zip(ref, new)):
+            assert same(r, n), i
+        t_ref = min(timeit.repeat(lambda: reference(lazyEvents(arrays)), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: matched(lazyEvents(arrays)), number=1, repeat=repeat))
+        print('%10d %14.3f %14.3f %10.1f' % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_puweights(sizes, repeat):
+    # add_pileup_weight and add_VJets_NLOkFactor before the per-dataset tables
+    def pileup(weights, nPU, year, dataset):
+        if (year == '2017' or year == '2018') and dataset in notUL2017:
+            weights.add('pileup_weight', puW2017_nonUL[np.clip(nPU,0,len(puW2017_nonUL)-1)])
+        elif year == '2017' and dataset in corrections['compiled']['2017_pileupweight_dataset']:
+            weights.add(
+                'pileup_weight',
+                corrections['compiled']['2017_pileupweight_dataset'][dataset](nPU),
+                corrections['compiled']['2017_pileupweight_dataset_puUp'][dataset](nPU),
+                corrections['compiled']['2017_pileupweight_dataset_puDown'][dataset](nPU),
+            )
+        else:
+            weights.add(
+                'pileup_weight',
+                corrections['compiled'][f'{year}_pileupweight'](nPU),
+                corrections['compiled'][f'{year}_pileupweight_puUp'](nPU),
+                corrections['compiled'][f'{year}_pileupweight_puDown'](nPU),
+            )
+
+    def kfactor(weights, genBosonPt, year, dataset):
+        if (year == '2017' or year == '2018') and 'ZJetsToQQ_HT' in dataset:
+            nlo_over_lo_qcd = corrections['compiled']['2017_Z_nlo_qcd'](genBosonPt)
+            nlo_over_lo_ewk = corrections['compiled']['Z_nlo_over_lo_ewk'](genBosonPt)
+        elif (year == '2017' or year == '2018') and 'WJetsToQQ_HT' in dataset:
+            nlo_over_lo_qcd = corrections['compiled']['2017_W_nlo_qcd'](genBosonPt)
+            nlo_over_lo_ewk = corrections['compiled']['W_nlo_over_lo_ewk'](genBosonPt)
+        elif year == '2016' and 'DYJetsToQQ' in dataset:
+            nlo_over_lo_qcd = corrections['compiled']['2016_Z_nlo_qcd'](genBosonPt)
+            nlo_over_lo_ewk = corrections['compiled']['Z_nlo_over_lo_ewk'](genBosonPt)
+        elif year == '2016' and 'WJetsToQQ' in dataset:
+            nlo_over_lo_qcd = corrections['compiled']['2016_W_nlo_qcd'](genBosonPt)
+            nlo_over_lo_ewk = corrections['compiled']['W_nlo_over_lo_ewk'](genBosonPt)
+        elif 'DYJetsToLL_Pt' in dataset:
+            nlo_over_lo_qcd = np.ones_like(genBosonPt)
+            nlo_over_lo_ewk = Vpt_corr_value[np.digitize(np.clip(genBosonPt,Vpt_corr_bins[0], Vpt_corr_bins[-1]), Vpt_corr_bins)-1]
+        else:
+            return
+        weights.add('VJets_NLOkFactor', nlo_over_lo_qcd * nlo_over_lo_ewk)
+
+    def reference(nPU, genBosonPt, year, dataset):
+        weights = Weights(len(nPU))
+        pileup(weights, nPU, year, dataset)
+        kfactor(weights, genBosonPt, year, dataset)
+        return weights
+
+    def tables(nPU, genBosonPt, year, dataset):
+        weights = Weights(len(nPU))
+        add_pileup_weight(weights, nPU, year, dataset)
+        add_VJets_NLOkFactor(weights, genBosonPt, year, dataset)
+        return weights
+
+    datasets = [
+        ('2017', sorted(corrections['compiled']['2017_pileupweight_dataset'])[0]),
+        ('2017', 'ZJetsToQQ_HT400to600_qc19_4j_TuneCP5_13TeV-madgraphMLM-pythia8'),
+        ('2018', 'WJetsToQQ_HT-800toInf_TuneCP5_13TeV-madgraphMLM-pythia8'),
+        ('2018', 'DYJetsToLL_Pt-400To650_TuneCP5_13TeV-amcatnloFXFX-pythia8'),
+        ('2016', 'DYJetsToQQ_HT180_13TeV-madgraphMLM-pythia8'),
+        ('2016', 'WJetsToQQ_HT180_13TeV-madgraphMLM-pythia8'),
+        ('2017', 'QCD_HT1000to1500_TuneCP5_13TeV-madgraphMLM-pythia8'),
+    ]
+    print('%10s %5s %-30s %14s %14s %10s' % ('chunk', 'year', 'dataset', 'lookups [ms]', 'tables [ms]', 'speed-up'))
+    for size in sizes:
+        # the sample tail of the boson pt stays below the last k-factor edge, where the old DY lookup overflows
+        nPU = np.random.randint(-2, 110, size).astype(np.int32)
+        genBosonPt = np.random.exponential(300., size)
+        genBosonPt[genBosonPt > 6000.] = 0.
+        for year, dataset in datasets:
+            ref = reference(nPU, genBosonPt, year, dataset)
+            new = tables(nPU, genBosonPt, year, dataset)
+            assert sorted(ref.variations) == sorted(new.variations)
+            assert all(np.array_equal(ref.weight(v), new.weight(v)) for v in [None] + sorted(ref.variations))
+            t_ref = min(timeit.repeat(lambda: reference(nPU, genBosonPt, year, dataset), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: tables(nPU, genBosonPt, year, dataset), number=1, repeat=repeat))
+            print('%10d %5s %-30s %14.3f %14.3f %10.1f' % (size, year, dataset[:30], t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def bench_merge(sizes, repeat):
+    # hadd_coffea.py before the tree reduction: add chunks of 5 files, save them, reload and add the partial sums
+    def serial(paths, tmpdir, chunk_size=5):
+        chunk_names = []
+        for i in range(0, len(paths), chunk_size):
+            flist = [util.load(x) for x in paths[i:i + chunk_size]]
+            for key in flist[0]:
+                if isinstance(flist[0][key], hist.Hist):
+                    for fi in range(1, len(flist)):
+                        flist[0][key].add(flist[fi][key])
+                else:
+                    for fi in range(1, len(flist)):
+                        flist[0][key] = flist[0][key] + flist[fi][key]
+            util.save(flist[0], os.path.join(tmpdir, 'partial_%i.coffea' % i))
+            chunk_names.append(os.path.join(tmpdir, 'partial_%i.coffea' % i))
+        flist = [util.load(x) for x in chunk_names]
+        for key in flist[0]:
+            for fi in range(1, len(flist)):
+                flist[0][key] = flist[0][key] + flist[fi][key]
+        for x in chunk_names:
+            os.remove(x)
+        return flist[0]
+
+    def job_output(processor, i, nevents=2000):
+        # one condor job of HtautauProcessor_NN: a single dataset, a few regions and systematics
+        out = processor.accumulator.identity()
+        dataset = 'dataset%d' % (i % 3)
+        out['sumw'][dataset] += nevents
+        for name in out:
+            if name.startswith('cutflow'):
+                for cut in ['none', 'trigger', 'jetkin', 'met', 'nn_disc']:
+                    out[name][dataset][cut] += float(np.random.randint(nevents))
+        for systematic in ['nominal', 'jet_triggerUp']:
+            for region in ['hadhad_signal_met', 'hadmu_signal', 'hadel_signal']:
+                out['met_nn_kin'].fill(
+                    dataset=dataset, systematic=systematic, region=region,
+                    met_pt=np.random.exponential(100., nevents),
+                    massreg=np.random.uniform(0., 210., nevents),
+                    nn_disc=np.random.uniform(0., 1., nevents),
+                    jetmet_dphi=np.random.uniform(0., 3.2, nevents),
+                    h_pt=np.random.uniform(250., 1200., nevents),
+                    antilep=np.random.randint(-1, 2, nevents),
+                    weight=np.random.uniform(0.5, 1.5, nevents),
+                )
+        return out
+
+    def same(a, b):
+        ha, hb = a['met_nn_kin'].values(sumw2=True), b['met_nn_kin'].values(sumw2=True)
+        return (
+            ha.keys() == hb.keys()
+            and all(np.allclose(ha[k][0], hb[k][0], rtol=1e-12) and np.allclose(ha[k][1], hb[k][1], rtol=1e-12) for k in ha)
+            and all(np.isclose(a['sumw'][d], b['sumw'][d], rtol=1e-12) for d in a['sumw'])
+            and all(np.isclose(a[n][d][c], b[n][d][c], rtol=1e-12) for n in a if n.startswith('cutflow') for d in a[n] for c in a[n][d])
+        )
+
+    processor = HtautauProcessor_NN(year='2017')
+    workers = max(2, min(4, os.cpu_count()))
+    print('%10s %10s %14s %14s %10s %10s %10s %12s' % ('files', 'MB', 'serial [s]', 'tree [s]', 'speed-up', 'files/s', 'MB/s', 'worker RSS'))
+    for size in sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmpdir, 'job_%d.coffea' % i) for i in range(size)]
+            for i, path in enumerate(paths):
+                util.save(job_output(processor, i), path)
+            ref = serial(paths, tmpdir)
+            new, stats = mergeOutputs(paths, workers=workers, fanin=8)
+            assert same(ref, new)
+
+            # incremental merge: the first half, then everything, then with a touched and a replaced output
+            # and the first job gone from the inputs, which a rebuild has to read back from the manifest
+            outpath = os.path.join(tmpdir, 'sum.coffea')
+            jobs = {'job_%d' % i: path for i, path in enumerate(paths)}
+            checked = []
+
+            def checksum(path):
+                checked.append(path)
+                return fileChecksum(path)
+            half = dict(list(jobs.items())[:max(1, size // 2)])
+            mergeIncremental(half, outpath, workers, checkpoint=3)
+            new, stats = mergeIncremental(jobs, outpath, workers, checkpoint=3)
+            assert same(ref, new) and stats['skipped'] == len(half) and not stats['rebuilt']
+            if size > 2:
+                os.utime(paths[1], (time.time() + 10, time.time() + 10))
+                new, stats = mergeIncremental(jobs, outpath, workers, checksum=checksum)
+                assert same(ref, new) and checked == [paths[1]] and not stats['rebuilt']
+                replaced = job_output(processor, 2)
+                util.save(replaced, paths[2])
+                rest = {k: v for k, v in jobs.items() if k != 'job_0'}
+                new, stats = mergeIncremental(rest, outpath, workers, checksum=checksum)
+                assert stats['rebuilt'] and stats['files'] == size
+                assert same(serial(paths, tmpdir), new) and same(new, util.load(outpath))
+                os.remove(paths[0])
+                util.save(job_output(processor, 2), paths[2])
+                try:
+                    mergeIncremental(rest, outpath, workers, checksum=checksum)
+                    raise AssertionError('rebuilt the sum without job_0')
+                except RuntimeError:
+                    pass
+                util.save(job_output(processor, 0), paths[0])
+                util.save(job_output(processor, 2), paths[2])
+            t_ref = min(timeit.repeat(lambda: serial(paths, tmpdir), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: mergeOutputs(paths, workers=workers, fanin=8), number=1, repeat=repeat))
+            mb = stats['bytes'] / 1024.**2
+            print('%10d %10.1f %14.3f %14.3f %10.1f %10.1f %10.1f %9.0f MB' % (size, mb, t_ref, t_new, t_ref / t_new, size / t_new, mb / t_new, stats['maxrss_worker']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def bench_transfer(sizes, repeat, latency=0.05):
+    # the old EOS merge: one existence check per job, then copy and merge the files one after the other
+    class SlowStorage(LocalStorage):
+        # stand-in for xrootd with a fixed round-trip time per request
+        def list(self, directory):
+            time.sleep(latency)
+            return super().list(directory)
+
+        def fetch(self, path, destdir):
+            time.sleep(latency)
+            return super().fetch(path, destdir)
+
+    def serial(storage, remotedir, localdir, names):
+        listed = [name for name in names if name in storage.list(remotedir)]
+        return mergeOutputs([storage.fetch(os.path.join(remotedir, name), localdir) for name in listed], workers=1)[0]
+
+    def concurrent(storage, remotedir, localdir, names, threads=8):
+        listing = storage.list(remotedir)
+        with ThreadPoolExecutor(max_workers=threads) as transfers:
+            paths = [transfers.submit(storage.fetch, os.path.join(remotedir, name), localdir) for name in names if name in listing]
+            return mergeOutputs(paths, workers=1)[0]
+
+    storage = SlowStorage()
+    processor = HtautauProcessor_NN(year='2017')
+    print('%10s %14s %14s %10s' % ('files', 'serial [s]', 'threads [s]', 'speed-up'))
+    for size in sizes:
+        remotedir, localdir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            names = ['job_%d.coffea' % i for i in range(size)]
+            for i, name in enumerate(names):
+                out = processor.accumulator.identity()
+                out['sumw']['dataset%d' % (i % 3)] += float(i)
+                util.save(out, os.path.join(remotedir, name))
+            ref = serial(storage, remotedir, localdir, names)
+            new = concurrent(storage, remotedir, localdir, names)
+            assert dict(ref['sumw']) == dict(new['sumw'])
+            t_ref = min(timeit.repeat(lambda: serial(storage, remotedir, localdir, names), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(lambda: concurrent(storage, remotedir, localdir, names), number=1, repeat=repeat))
+            print('%10d %14.3f %14.3f %10.1f' % (size, t_ref, t_new, t_ref / t_new))
+        finally:
+            shutil.rmtree(remotedir)
+            shutil.rmtree(localdir)
+
+
+def bench_scale(sizes, repeat):
+    # the scaling loop of the hadd scripts: data datasets padded with 1, Hist.scale and every cutflow entry in python
+    def loop(out, xs, samples):
+        scale1fb = {k: xs[k] * 1000. / w for k, w in out['sumw'].items()}
+        for s in samples:
+            if s not in scale1fb: scale1fb[s] = 1.
+        for key in out:
+            if isinstance(out[key], hist.Hist):
+                out[key].scale(scale1fb, 'dataset')
+            else:
+                if key in ('sumw', 'timing'):
+                    continue
+                for samp in out[key]:
+                    for x in out[key][samp]:
+                        out[key][samp][x] = out[key][samp][x]*scale1fb[samp]
+        return out
+
+    def table(out, xs):
+        return scaleOutput(out, scaleFactors(out['sumw'], xs))
+
+    xs = loadXsecs('../data/xsec.json')
+    processor = HtautauProcessor_NN(year='2017')
+    print('%10s %14s %14s %10s' % ('datasets', 'loop [ms]', 'table [ms]', 'speed-up'))
+    for size in sizes:
+        # size MC datasets and one data dataset, a few regions each
+        mc = sorted(xs)[:size]
+        out = processor.accumulator.identity()
+        for dataset in mc + ['SingleMuon_Run2017B']:
+            if dataset in mc:
+                out['sumw'][dataset] += np.random.uniform(1e3, 1e6)
+            for name in out:
+                if name.startswith('cutflow'):
+                    for cut in ['none', 'trigger', 'jetkin', 'met', 'nn_disc']:
+                        out[name][dataset][cut] += np.random.uniform(0., 1e3)
+            for region in ['hadhad_signal_met', 'hadmu_signal']:
+                out['met_nn_kin'].fill(
+                    dataset=dataset, systematic='nominal', region=region,
+                    met_pt=np.random.exponential(100., 100), massreg=np.random.uniform(0., 210., 100),
+                    nn_disc=np.random.uniform(0., 1., 100), jetmet_dphi=np.random.uniform(0., 3.2, 100),
+                    h_pt=np.random.uniform(250., 1200., 100), antilep=np.random.randint(-1, 2, 100),
+                )
+        ref = loop(copy.deepcopy(out), xs, ['SingleMuon_Run2017B'])
+        new = table(copy.deepcopy(out), xs)
+        hr, hn = ref['met_nn_kin'].values(sumw2=True), new['met_nn_kin'].values(sumw2=True)
+        assert hr.keys() == hn.keys() and all(np.array_equal(hr[k][0], hn[k][0]) and np.array_equal(hr[k][1], hn[k][1]) for k in hr)
+        assert all(ref[n][d][c] == new[n][d][c] for n in out if n.startswith('cutflow') for d in out[n] for c in out[n][d])
+        copies = [copy.deepcopy(out) for _ in range(2 * repeat)]
+        t_ref = min(timeit.repeat(lambda: loop(copies.pop(), xs, ['SingleMuon_Run2017B']), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: table(copies.pop(), xs), number=1, repeat=repeat))
+        print('%10d %14.3f %14.3f %10.1f' % (size + 1, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+def _writeNano(fname, size):
+    # local stand-in for a remote NanoAOD file: run, MET_pt and a jagged Jet collection
+    counts = np.random.poisson(4., size)
+    jets = awkward.JaggedArray.fromcounts(counts, np.random.exponential(50., counts.sum()).astype(np.float32))
+    with uproot.recreate(fname) as f:
+        f['Events'] = uproot.newtree({
+            'run': 'int32', 'MET_pt': 'float32',
+            'Jet_pt': uproot.newbranch(np.dtype('f4'), size='nJet'), 'Jet_eta': uproot.newbranch(np.dtype('f4'), size='nJet'),
+        })
+        f['Events'].extend({
+            'run': np.arange(size, dtype=np.int32), 'MET_pt': np.random.exponential(80., size).astype(np.float32),
+            'nJet': counts.astype(np.int32), 'Jet_pt': jets, 'Jet_eta': jets * np.float32(0.01),
+        })
+
+
+def _readNano(events):
+    return [np.asarray(x) for x in (events.run, events.MET.pt, events.Jet.pt.counts, events.Jet.pt.content, events.Jet.eta.content)]
+
+
+def _cachedRead(args):
+    # one worker process: load what the cache has, read the rest from the file and store it
+    fname, directory, maxsize, repeat = args
+    cache = ChunkCache(directory, maxsize)
+    out = []
+    for _ in range(repeat):
+        events = NanoEvents.from_file(fname)
+        cache.load(events)
+        out.append(_readNano(events))
+        cache.store(events)
+    return out
+
+
+def _cacheSize(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names if name.endswith('.npy'))
+
+
+def bench_chunkcache(sizes, repeat):
+    # round trip through ChunkCache: store the branches read from a local file, reload them into a fresh NanoEvents
+    columns = ['run', 'MET_pt', 'nJet', 'Jet_pt', 'Jet_eta']
+
+    def same(ref, new):
+        return all(a.dtype == b.dtype and np.array_equal(a, b) for a, b in zip(ref, new))
+
+    print('%10s %14s %14s %10s' % ('chunk', 'root [ms]', 'cache [ms]', 'speed-up'))
+    for size in sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'nano.root')
+            _writeNano(fname, size)
+            cache = ChunkCache(os.path.join(tmpdir, 'cache'))
+            events = NanoEvents.from_file(fname)
+            ref = _readNano(events)
+            chunkbytes = cache.store(events)
+            assert chunkbytes > 0 and cache.store(events) == 0
+            cached = NanoEvents.from_file(fname)
+            assert sorted(cache.load(cached)) == sorted(columns)
+            keys = set(cached._cache)
+            new = _readNano(cached)
+            # everything came from the cache, nothing was read from the file
+            assert set(cached._cache) == keys
+            assert same(ref, new)
+
+            # a cap below one chunk: the arrays are evicted right after being stored, the rest is read from the file
+            small = ChunkCache(os.path.join(tmpdir, 'small'), chunkbytes // 2)
+            for _ in range(3):
+                events = NanoEvents.from_file(fname)
+                found = small.load(events)
+                assert len(found) < len(columns)
+                assert same(ref, _readNano(events))
+                assert small.store(events) > 0
+                assert _cacheSize(os.path.join(tmpdir, 'small')) <= chunkbytes // 2
+
+            # two worker processes storing and loading the same chunk, with and without eviction
+            for name, maxsize in (('shared', 10 * chunkbytes), ('sharedsmall', chunkbytes // 2)):
+                directory = os.path.join(tmpdir, name)
+                with multiprocessing.Pool(2) as pool:
+                    results = pool.map(_cachedRead, [(fname, directory, maxsize, 5)] * 2)
+                assert all(same(ref, new) for out in results for new in out)
+                assert _cacheSize(directory) <= maxsize
+                assert not [n for _, _, names in os.walk(directory) for n in names if n.endswith('.tmp')]
+            events = NanoEvents.from_file(fname)
+            assert sorted(ChunkCache(os.path.join(tmpdir, 'shared')).load(events)) == sorted(columns)
+            assert same(ref, _readNano(events))
+
+            def fromcache():
+                events = NanoEvents.from_file(fname)
+                cache.load(events)
+                return _readNano(events)
+            t_ref = min(timeit.repeat(lambda: _readNano(NanoEvents.from_file(fname)), number=1, repeat=repeat))
+            t_new = min(timeit.repeat(fromcache, number=1, repeat=repeat))
+            print('%10d %14.3f %14.3f %10.1f' % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+benchmarks = {
+    'singleton': bench_singleton,
+    'vid': bench_vid,
+    'leptonsf': bench_leptonsf,
+    'btag': bench_btag,
+    'msdcorr': bench_msdcorr,
+    'genhtt': bench_genhtt,
+    'matching': bench_matching,
+    'puweights': bench_puweights,
+    'merge': bench_merge,
+    'transfer': bench_transfer,
+    'scale': bench_scale,
+    'chunkcache': bench_chunkcache,
+}
+
+
+if __name__ == "__main__":
+    #ex. python benchmark.py singleton --sizes 1000 10000 200000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench',     choices=sorted(benchmarks),                 help="benchmark to run")
+    parser.add_argument('--sizes',   dest='sizes',  default=[1000, 10000, 200000], help="chunk sizes", type=int, nargs='+')
+    parser.add_argument('--repeat',  dest='repeat', default=3,                      help="repetitions", type=int)
+    args = parser.parse_args()
+
+    benchmarks[args.bench](args.sizes, args.repeat)
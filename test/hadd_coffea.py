@@ -1,8 +1,7 @@
 #!/usr/bin/python
 from coffea import util,hist
+from boostedhiggs.merging import mergeOutputs, mergeIncremental, printMergeStats, loadXsecs, scaleFactors, scaleOutput
 import json
-import os
-import subprocess
 from collections import defaultdict
 
 import argparse
@@ -13,100 +12,43 @@ parser.add_argument('--indir', metavar='indir', default='./', help='indir')
 parser.add_argument('--prefix', metavar='prefix', default='', type=str, help='prefix')
 parser.add_argument('--samples', metavar='samples', help='samples', nargs='+')
 parser.add_argument('--outname', metavar='outname', default='hists_sum', help='outname', type=str)
-parser.add_argument('-n', '--noscale', action='store_true')
+parser.add_argument('-n', '--noscale', action='store_true', help='keep the output unscaled, the plotting scripts can scale it at read time with --xsec')
 parser.add_argument('-j', '--json', action='store_true')
+parser.add_argument('--fanin', dest='fanin', default=8, type=int, help='maximum number of files added by one merge task')
+parser.add_argument('--workers', dest='workers', default=4, type=int, help='number of merge processes')
+parser.add_argument('--incremental', action='store_true', help='only add new or changed files to the sum of the previous run')
 args = parser.parse_args()
 
 indir = args.indir
 
-chunk_size = 40
-
 onlyfiles = ["%s%s"%(args.prefix,s) for s in args.samples]
 
-chunk_names = []
-for i in range(0,len(onlyfiles),chunk_size):
-  print('Chunk',i)
-  flist = []
-  if (i+chunk_size<len(onlyfiles)):
-    for fi in onlyfiles[i:i+chunk_size]:
-      x = "%s/%s.coffea"%(indir,fi)
-      flist.append(util.load(x))
-  else:
-    for fi in onlyfiles[i:]:
-      x = "%s/%s.coffea"%(indir,fi)
-      flist.append(util.load(x))
-
-  try: 
-    for key in flist[0]:
-      if isinstance(flist[0][key], hist.Hist):
-        for fi in range(1,len(flist)):
-          flist[0][key].add(flist[fi][key])
-      else:
-        for fi in range(1,len(flist)):
-          flist[0][key] = flist[0][key] + flist[fi][key]
-  except:
-    for fi in range(1,len(flist)):
-      flist[0].update(flist[fi])
-  
-  print(flist[0])
-  
-  util.save(flist[0],'%s/%s_%i.coffea' % (indir,args.outname,i))
-
-  for f in flist:
-    del f
-
-  chunk_names.append('%s/%s_%i.coffea' % (indir,args.outname,i))
-
-print(chunk_names)
-
-flist = [ util.load(x) for x in chunk_names ]
-
-try:
-  for key in flist[0]:
-    if isinstance(key, hist.Hist):
-      for fi in range(1,len(flist)):
-        flist[0][key].add(flist[fi][key])
-    else:
-      for fi in range(1,len(flist)):
-        flist[0][key] = flist[0][key] + flist[fi][key]
-except: 
-  for fi in range(1,len(flist)):
-    flist[0].update(flist[fi])
-  
-print(flist[0])
-
-xs = {}
-with open('../data/xsec.json', 'r') as f:
-    xs = json.load(f)
+paths = {fi: "%s/%s.coffea"%(indir,fi) for fi in onlyfiles}
+sumname = None
+if args.incremental:
+    # the running sum has to stay unscaled, keep it next to the final output
+    sumname = args.outname if args.noscale and not args.json else args.outname + '_unscaled'
+    out, stats = mergeIncremental(paths, '%s/%s.coffea' % (indir,sumname), args.workers, args.fanin)
+else:
+    out, stats = mergeOutputs(list(paths.values()), args.workers, args.fanin)
+printMergeStats(stats)
 
 print('noscale =',args.noscale)
 if not args.noscale:
-    scale1fb = {k: xs[k] * 1000. / w for k, w in flist[0]['sumw'].items()}
-    for s in args.samples:
-        if s not in scale1fb: scale1fb[s] = 1.
-    for key in flist[0]:
-        if isinstance(flist[0][key], hist.Hist):
-            #out[key].scale(scale(scale1fb, 'dataset'))
-            flist[0][key].scale(scale1fb, 'dataset')
-        else:
-            print(key,flist[0][key])
-            if key=='sumw':
-                continue
-            for samp in flist[0][key]:
-                for x in flist[0][key][samp]:
-                    flist[0][key][samp][x] = flist[0][key][samp][x]*scale1fb[samp]
-        print(key,flist[0][key])
+    scale1fb = scaleFactors(out['sumw'], loadXsecs('../data/xsec.json'))
+    print('scaling using',scale1fb)
+    scaleOutput(out, scale1fb)
 
 def makehash():
     return defaultdict(makehash)
 
 if args.json:
     the_dict = makehash()
-    for key in flist[0]:
-        if isinstance(flist[0][key], hist.Hist):
-            the_arr = flist[0][key].values()[()]
+    for key in out:
+        if isinstance(out[key], hist.Hist):
+            the_arr = out[key].values()[()]
             the_axes = []
-            for ax in flist[0][key].axes():
+            for ax in out[key].axes():
                 the_axes.append([ax.name, ax.edges()])
             for i1 in range(len(the_axes[0][1])-1):
                 for i2 in range(len(the_axes[1][1])-1):
@@ -114,8 +56,5 @@ if args.json:
     with open('%s/%s.json'% (indir,args.outname), 'w') as fp:
         json.dump(the_dict, fp,indent=4)
   
-else:
-    util.save(flist[0],'%s/%s.coffea' % (indir,args.outname))
-
-for i,x in enumerate(chunk_names):
-  os.system("rm %s/%s_%i.coffea" % (indir,args.outname,i*chunk_size))
+elif sumname != args.outname:
+    util.save(out,'%s/%s.coffea' % (indir,args.outname))
@@ -11,7 +11,7 @@ plt.style.use(hep.styles.ROOT)
 import numpy as np
 
 from coffea import hist
-from coffea.util import load
+from boostedhiggs.merging import loadOutput
 
 import pickle
 import gzip
@@ -1448,7 +1448,7 @@ def makeCards(args):
     for h in mcSamples + dataSamples:
         #print(h)
         # open hists
-        hists_unmapped = load('%s%s.coffea'%(args.hist,h))
+        hists_unmapped = loadOutput('%s%s.coffea'%(args.hist,h), args.xsec)
         # map to hists
         for key, val in hists_unmapped.items():
             if isinstance(val, hist.Hist):
@@ -1585,6 +1585,7 @@ if __name__ == "__main__":
     parser.add_argument('--hist',        dest='hist',        default="hists_sum_",   help="hists pickle prefix")
     parser.add_argument('--year',        dest='year',        default="2017",         help="year")
     parser.add_argument('--lumi',        dest='lumi',        default=50.,            help="lumi",       type=float)
+    parser.add_argument('--xsec',        dest='xsec',        default=None,           help='cross section json, scales unscaled (merged with -n) outputs at read time')
     parser.add_argument('--tag',         dest='tag',         default="",             help="tag")
     parser.add_argument('--label',       dest='label',       default="",             help="label")
     parser.add_argument('--sigscale',    dest='sigscale',    default=1.,             help="sigscale",   type=float)
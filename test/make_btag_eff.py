@@ -0,0 +1,94 @@
+import os
+import time
+import json
+from coffea import processor, util
+
+from boostedhiggs import BTagEfficiency
+from boostedhiggs.btag import saveEfficiencyMap
+from run_htt import executors, index_files
+
+import argparse
+
+default_filesets = {
+    '2017': ['fileset2017UL.json'],
+    '2018': ['fileset2018UL.json'],
+}
+default_samples = ['QCD_HT', 'TTTo']
+
+
+def select_files(filesetnames, samples, starti, endi):
+    files = {}
+    for name in filesetnames:
+        with open(os.path.join('../data', name), 'r') as f:
+            files.update(json.load(f))
+    return {k: v[starti:endi] for k, v in files.items() if any(s in k for s in samples)}
+
+
+def batches(selfiles, nfiles):
+    # up to nfiles files of every dataset per batch
+    for i in range(0, max(len(v) for v in selfiles.values()), nfiles):
+        yield {k: v[i:i + nfiles] for k, v in selfiles.items() if v[i:i + nfiles]}
+
+
+def make_map(year, selfiles, outdir, executor='processes', workers=1, chunksize=100000, maxchunks=None, nfiles=10, metadata_cache=None):
+    p = BTagEfficiency(year=year)
+    executor, executor_args = executors[executor]
+    checkpoint = 'btagQCD%s_partial.coffea' % year
+    total = p.accumulator.identity()
+    done = set()
+    # the files of the run and the chunks read of each, a checkpoint is only resumed by the same selection
+    selection = {'files': sorted((k, fn) for k, v in selfiles.items() for fn in v), 'maxchunks': maxchunks}
+    if os.path.exists(checkpoint):
+        # resume an interrupted run, the files already in the checkpoint are not run again
+        saved = util.load(checkpoint)
+        if saved.get('selection') != selection:
+            raise RuntimeError('%s was written for a different selection of files, remove it or rerun with the same options' % checkpoint)
+        total, done = saved['output'], saved['done']
+        print('%s: resuming from %s (%d files merged)' % (year, checkpoint, len(done)))
+    nbatches = -(-max(len(v) for v in selfiles.values()) // nfiles)
+    tic = time.time()
+    for i, batch in enumerate(batches(selfiles, nfiles)):
+        batch = {k: [fn for fn in v if (k, fn) not in done] for k, v in batch.items()}
+        batch = {k: v for k, v in batch.items() if v}
+        if not batch:
+            continue
+        # run_uproot_job consumes some of the executor arguments, pass a fresh copy every time
+        args = dict(executor_args, nano=True, workers=workers)
+        out = processor.run_uproot_job(batch, 'Events', p, executor, args, chunksize=chunksize, maxchunks=maxchunks, metadata_cache=metadata_cache)
+        # merge as we go and keep the running sum on disk, a crash only loses the current batch
+        total.add(out)
+        done.update((k, fn) for k, v in batch.items() for fn in v)
+        util.save({'output': total, 'done': done, 'selection': selection}, checkpoint + '.tmp')
+        os.replace(checkpoint + '.tmp', checkpoint)
+        print('%s: batch %d/%d (%d files) merged after %.0f s' % (year, i + 1, nbatches, sum(len(v) for v in batch.values()), time.time() - tic))
+    histfile, mapfile = saveEfficiencyMap(total, year, outdir)
+    os.remove(checkpoint)
+    print('%s: wrote %s and %s' % (year, histfile, mapfile))
+
+
+if __name__ == "__main__":
+    #ex. python make_btag_eff.py --year 2017 2018 --workers 8 --endi 20
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year',       dest='year',       default=sorted(default_filesets), help="years", nargs='+')
+    parser.add_argument('--fileset',    dest='fileset',    default=None,          help='fileset json files in data/ (default depends on the year)', nargs='+')
+    parser.add_argument('--samples',    dest='samples',    default=default_samples, help='dataset name patterns', nargs='+')
+    parser.add_argument('--starti',     dest='starti',     default=0,             help="start index", type=int)
+    parser.add_argument('--endi',       dest='endi',       default=None,          help="end index",   type=int)
+    parser.add_argument('--nfiles',     dest='nfiles',     default=10,            help='files per dataset merged at a time', type=int)
+    parser.add_argument('--outdir',     dest='outdir',     default='../boostedhiggs/data', help='output directory')
+    parser.add_argument('--executor',   dest='executor',   default='processes',   help='executor',    choices=sorted(executors))
+    parser.add_argument('--workers',    dest='workers',    default=1,             help='number of workers', type=int)
+    parser.add_argument('--chunksize',  dest='chunksize',  default=100000,        help='events per chunk',  type=int)
+    parser.add_argument('--maxchunks',  dest='maxchunks',  default=None,          help='maximum number of chunks per dataset', type=int)
+    args = parser.parse_args()
+
+    for year in args.year:
+        if not args.fileset and year not in default_filesets:
+            parser.error('no default fileset for %s, pass --fileset' % year)
+    for year in args.year:
+        filesetnames = args.fileset or default_filesets[year]
+        selfiles = select_files(filesetnames, args.samples, args.starti, args.endi)
+        if not selfiles:
+            raise ValueError('No dataset matching %s for %s' % (' '.join(args.samples), year))
+        selfiles, metadata_cache = index_files(filesetnames, selfiles)
+        make_map(year, selfiles, args.outdir, args.executor, args.workers, args.chunksize, args.maxchunks, args.nfiles, metadata_cache)
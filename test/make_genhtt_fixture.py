@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import awkward
+import uproot
+
+import argparse
+
+# statusFlags bits of NanoAOD GenPart
+isPrompt = 1 << 0
+isTauDecayProduct = 1 << 2
+isPromptTauDecayProduct = 1 << 3
+isDirectTauDecayProduct = 1 << 4
+isDirectPromptTauDecayProduct = 1 << 5
+isHardProcess = 1 << 7
+fromHardProcess = 1 << 8
+isHardProcessTauDecayProduct = 1 << 9
+isDirectHardProcessTauDecayProduct = 1 << 10
+isLastCopy = 1 << 13
+
+hardprocess = isPrompt | isHardProcess | fromHardProcess | isLastCopy
+taudecay = (isTauDecayProduct | isPromptTauDecayProduct | isDirectTauDecayProduct | isDirectPromptTauDecayProduct
+            | fromHardProcess | isHardProcessTauDecayProduct | isDirectHardProcessTauDecayProduct | isLastCopy)
+
+# GenVisTau status: 0 (1 prong), 1-2 (1 prong + pi0s), 10-11 (3 prongs), 5 and 15 (other)
+vistau_status = [0, 1, 2, 10, 11, 5, 15]
+
+
+def dphi(a, b):
+    return (a - b + np.pi) % (2*np.pi) - np.pi
+
+
+def htautau_event(rng):
+    '''GenPart and GenVisTau rows of one event: H->tautau in most events, Z->mumu or no boson in the others'''
+    genpart = []
+    vistau = []
+
+    def add(pdgid, pt, eta, phi, mass, flags, mother):
+        genpart.append((pt, eta, phi, mass, pdgid, 1 if mother >= 0 else 62, flags, mother))
+        return len(genpart) - 1
+
+    kind = rng.choice(['htautau', 'zmumu', 'none'], p=[0.85, 0.1, 0.05])
+    bosonpt = rng.exponential(200.) + 150.
+    eta, phi = rng.uniform(-2.4, 2.4), rng.uniform(-np.pi, np.pi)
+    if kind == 'none':
+        for _ in range(rng.randint(1, 4)):
+            add(int(rng.choice([1, 2, 21])), rng.exponential(80.) + 20., rng.uniform(-2.4, 2.4), rng.uniform(-np.pi, np.pi), 0., hardprocess, -1)
+        return genpart, vistau
+    boson = add(25 if kind == 'htautau' else 23, bosonpt, eta, phi, 125. if kind == 'htautau' else 91.2, hardprocess, -1)
+    # boosted decay: the daughters are separated by about 2 m / pt
+    opening = 2. * genpart[boson][3] / bosonpt * rng.uniform(0.5, 1.8)
+    angle = rng.uniform(-np.pi, np.pi)
+    x = rng.uniform(0.15, 0.85)
+    daughters = []
+    for sign, frac, side in ((1, x, 1 - x), (-1, 1 - x, -x)):
+        deta = side * opening * np.cos(angle)
+        dph = side * opening * np.sin(angle)
+        daughters.append((sign, bosonpt * frac, eta + deta, dphi(phi + dph, 0.)))
+    if kind == 'zmumu':
+        for sign, pt, deta, dph in daughters:
+            add(13 * sign, pt, deta, dph, 0.106, hardprocess, boson)
+        return genpart, vistau
+    for sign, pt, taueta, tauphi in daughters:
+        tau = add(15 * sign, pt, taueta, tauphi, 1.777, hardprocess, boson)
+        mode = rng.choice(['had', 'el', 'mu'], p=[0.65, 0.175, 0.175])
+        visfrac = rng.uniform(0.05, 1.) if mode != 'had' else rng.uniform(0.3, 1.)
+        viseta, visphi = taueta + rng.normal(0., 0.02), dphi(tauphi + rng.normal(0., 0.02), 0.)
+        add(16 * sign, pt * (1 - visfrac), taueta, tauphi, 0., taudecay, tau)
+        if mode == 'had':
+            npi = int(rng.choice([1, 1, 3]))
+            for k in range(npi):
+                add(211 * sign * (-1 if k == 1 else 1), pt * visfrac / npi, viseta, visphi, 0.1396, taudecay, tau)
+            # NanoAOD stores visible taus above 10 GeV, softer ones leave the event with a single GenVisTau
+            if pt * visfrac > 10.:
+                vistau.append((pt * visfrac, viseta, visphi, rng.uniform(0.14, 1.5), -sign, tau, int(rng.choice(vistau_status))))
+        else:
+            lepid = 11 if mode == 'el' else 13
+            add(-(lepid + 1) * sign, 0., taueta, tauphi, 0., taudecay, tau)
+            add(lepid * sign, pt * visfrac, viseta, visphi, 0.000511 if lepid == 11 else 0.106, taudecay, tau)
+    if rng.uniform() < 0.2:
+        # photon conversion electron, not a direct tau decay product
+        add(11, rng.exponential(20.), eta, phi, 0.000511, isTauDecayProduct | isLastCopy, boson)
+    # NanoAOD orders GenVisTau by decreasing pt
+    vistau.sort(key=lambda row: -row[0])
+    return genpart, vistau
+
+
+def write_fixture(fname, nevents, seed):
+    rng = np.random.RandomState(seed)
+    events = [htautau_event(rng) for _ in range(nevents)]
+    genpart = [row for gp, _ in events for row in gp]
+    vistau = [row for _, vt in events for row in vt]
+    ngenpart = np.array([len(gp) for gp, _ in events], dtype=np.int32)
+    ngenvistau = np.array([len(vt) for _, vt in events], dtype=np.int32)
+
+    def column(rows, i, counts, dtype):
+        return awkward.JaggedArray.fromcounts(counts, np.array([row[i] for row in rows], dtype=dtype).reshape(-1))
+
+    gp_branches = [('pt', 'f4'), ('eta', 'f4'), ('phi', 'f4'), ('mass', 'f4'), ('pdgId', 'i4'), ('status', 'i4'), ('statusFlags', 'i4'), ('genPartIdxMother', 'i4')]
+    vt_branches = [('pt', 'f4'), ('eta', 'f4'), ('phi', 'f4'), ('mass', 'f4'), ('charge', 'i4'), ('genPartIdxMother', 'i4'), ('status', 'i4')]
+    branches = {'event': 'int64', 'genWeight': 'float32'}
+    branches.update(('GenPart_%s' % name, uproot.newbranch(np.dtype(dtype), size='nGenPart')) for name, dtype in gp_branches)
+    branches.update(('GenVisTau_%s' % name, uproot.newbranch(np.dtype(dtype), size='nGenVisTau')) for name, dtype in vt_branches)
+    arrays = {'event': np.arange(1, nevents + 1, dtype=np.int64), 'genWeight': np.ones(nevents, dtype=np.float32), 'nGenPart': ngenpart, 'nGenVisTau': ngenvistau}
+    arrays.update(('GenPart_%s' % name, column(genpart, i, ngenpart, dtype)) for i, (name, dtype) in enumerate(gp_branches))
+    arrays.update(('GenVisTau_%s' % name, column(vistau, i, ngenvistau, dtype)) for i, (name, dtype) in enumerate(vt_branches))
+    with uproot.recreate(fname) as f:
+        f['Events'] = uproot.newtree(branches)
+        f['Events'].extend(arrays)
+    return ngenvistau
+
+
+if __name__ == "__main__":
+    #ex. python make_genhtt_fixture.py
+    parser = argparse.ArgumentParser(description='Write the small generator-level NanoAOD fixture used by benchmark.py genhtt')
+    parser.add_argument('--output', dest='output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'genhtt_nano.root'), help='output file')
+    parser.add_argument('--events', dest='events', default=500, help='number of events', type=int)
+    parser.add_argument('--seed',   dest='seed',   default=125, help='random seed', type=int)
+    args = parser.parse_args()
+
+    ngenvistau = write_fixture(args.output, args.events, args.seed)
+    print('%s: %d events, %s with 0/1/2 GenVisTau' % (args.output, args.events, '/'.join(str((ngenvistau == n).sum()) for n in range(3))))
@@ -13,7 +13,7 @@ plt.style.use(hep.styles.ROOT)
 import numpy as np
 
 from coffea import hist
-from coffea.util import load
+from boostedhiggs.merging import loadOutput
 
 import pickle
 import gzip
@@ -193,7 +193,7 @@ def getPlots(args,returnHist=False):
         args.hists = [h[:-7] for h in glob.glob('%s/*.coffea'%args.dirname)]
     for h in args.hists:
         # open hists
-        hists_unmapped = load('%s.coffea'%h)
+        hists_unmapped = loadOutput('%s.coffea'%h, args.xsec)
         # map to hists
         for key, val in hists_unmapped.items():
             if isinstance(val, hist.Hist):
@@ -257,6 +257,7 @@ if __name__ == "__main__":
     parser.add_argument('--rebin2',     dest='rebin2',    default=[1],          help='rebin2',     type=float,   nargs='+')
     parser.add_argument('--title',      dest='title',     default="",           help="title")
     parser.add_argument('--lumi',       dest='lumi',      default=50.,          help="lumi",       type=float)
+    parser.add_argument('--xsec',       dest='xsec',      default=None,         help='cross section json, scales unscaled (merged with -n) outputs at read time')
     parser.add_argument('--sel',        dest='sel',       default='',           help='selection',  nargs='+')
     parser.add_argument('--regions',    dest='regions',   default='',           help='regionsel',  nargs='+')
     parser.add_argument('--hist',       dest='hist',      default='',           help='histname')
@@ -11,7 +11,7 @@ plt.style.use(hep.styles.ROOT)
 import numpy as np
 
 from coffea import hist, processor
-from coffea.util import load
+from boostedhiggs.merging import loadOutput
 
 import pickle
 import gzip
@@ -266,7 +266,7 @@ def getPlots(args):
 
     for h in args.hists:
         # open hists
-        hists_unmapped = load('%s.coffea'%h)
+        hists_unmapped = loadOutput('%s.coffea'%h, args.xsec)
         for key, val in hists_unmapped.items():
             if key in args.regions:
                 if isinstance(val, processor.accumulator.defaultdict_accumulator):
@@ -301,6 +301,7 @@ if __name__ == "__main__":
     parser.add_argument('--tag',        dest='tag',       default="",           help="tag")
     parser.add_argument('--title',      dest='title',     default="",           help="title",      nargs='+')
     parser.add_argument('--lumi',       dest='lumi',      default=50.,          help="lumi",       type=float)
+    parser.add_argument('--xsec',       dest='xsec',      default=None,         help='cross section json, scales unscaled (merged with -n) outputs at read time')
     parser.add_argument('--regions',    dest='regions',   default='',           help='regionsel',  nargs='+')
     parser.add_argument('--defcolors',  dest='defcolors', action='store_false', help='defcolors')
     args = parser.parse_args()
@@ -11,7 +11,7 @@ plt.style.use(hep.styles.ROOT)
 import numpy as np
 
 from coffea import hist
-from coffea.util import load
+from boostedhiggs.merging import loadOutput
 
 import pickle
 import gzip
@@ -246,7 +246,7 @@ def getPlots(args):
     pwd = os.getcwd()
 
     # open hists
-    hists_unmapped = load('%s.coffea'%args.hists)
+    hists_unmapped = loadOutput('%s.coffea'%args.hists, args.xsec)
     os.chdir(odir)
 
     # map to hists
@@ -304,6 +304,7 @@ if __name__ == "__main__":
     parser.add_argument('--varlabel',   dest='varlabel',  default="",           help="varlabel")
     parser.add_argument('--title',      dest='title',     default="",           help="title")
     parser.add_argument('--lumi',       dest='lumi',      default=50.,          help="lumi",            type=float)
+    parser.add_argument('--xsec',       dest='xsec',      default=None,         help='cross section json, scales unscaled (merged with -n) outputs at read time')
     parser.add_argument('--sel',        dest='sel',       default='',           help='selection',       nargs='+')
     parser.add_argument('--selgrid',    dest='selgrid',   default='',           help='grid selection',  nargs='+')
     parser.add_argument('--labelgrid',  dest='labelgrid', default='',           help='grid labels',     nargs='+')
@@ -0,0 +1,20 @@
+from coffea import util
+from boostedhiggs.common import printTiming
+
+import argparse
+
+
+if __name__ == "__main__":
+    #ex. python print_timing.py htt_test.coffea
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', help='coffea output files produced with --timing', nargs='+')
+    args = parser.parse_args()
+
+    timing = None
+    for fn in args.files:
+        out = util.load(fn)
+        if timing is None:
+            timing = out['timing']
+        else:
+            timing.add(out['timing'])
+    printTiming(timing)
@@ -1,50 +1,187 @@
 import os
+import time
 import numpy as np
 from coffea import processor, util, hist
 import json
+import uproot
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from boostedhiggs import HtautauProcessor, BTagEfficiency
+import boostedhiggs
+from boostedhiggs.common import columnBytes, nanoColumns, mc_columns, dataset_ordering, ChunkCache, printTiming
+from boostedhiggs.fileindex import FileIndex, indexPath
 from coffea.nanoaod import NanoEvents
 
 import argparse
 
-def run_processor(year,selsamples,starti,endi,outname):
-    p = HtautauProcessor(year=year)
-    
+processors = {
+    'htt':        'HtautauProcessor',
+    'nn':         'HtautauProcessor_NN',
+    'Z':          'HtautauProcessor_Z',
+    'boostedtau': 'HtautauProcessor_BoostedTau',
+    'gen':        'HtautauProcessor_Gen',
+    'lepid':      'HtautauProcessor_LepID',
+    'trig':       'HtautauProcessor_Trigger',
+    'trig_gen':   'HtautauProcessor_Trigger_Gen',
+    'trig_fine':  'HtautauProcessor_Trigger_Fine',
+}
+
+filesets = {
+    'boostedtau': ['filesetBoostedTau.json'],
+}
+default_filesets = ['fileset2017.json', 'fileset2017UL.json', 'fileset2018UL.json']
+
+executors = {
+    'iterative': (processor.iterative_executor, {}),
+    'threads':   (processor.futures_executor, {'pool': ThreadPoolExecutor}),
+    'processes': (processor.futures_executor, {'pool': ProcessPoolExecutor}),
+}
+
+def index_files(filesetnames, selfiles, columns=None):
+    # the indexes of the filesets (data/make_fileindex.py) give the entries of the files, so the
+    # chunks are planned without opening every file, and their branches, checked here before running
+    indexes = [FileIndex('../data/%s' % name) for name in filesetnames if os.path.exists(indexPath('../data/%s' % name))]
+    if not indexes:
+        return selfiles, None
+    # files rewritten since the index was built are reindexed first (one listing per directory), files
+    # that cannot be listed or reopened are left out of the metadata cache and preprocessed by coffea
+    stale = set()
+    for index in indexes:
+        stats = index.update([url for urls in selfiles.values() for url in urls if url in index.files])
+        if stats['indexed'] or stats['refreshed']:
+            print('%s: %d files reindexed, %d refreshed' % (index.path, stats['indexed'], stats['refreshed']))
+        stale.update(stats['failed'])
+    if stale:
+        print('Could not refresh the index of %d files, preprocessing them' % len(stale))
+    out = {}
+    missing = {}
+    checked = {}
+    nempty = 0
+    for dataset, urls in selfiles.items():
+        out[dataset] = []
+        for url in urls:
+            index = next((i for i in indexes if url in i.files), None) if url not in stale else None
+            if index is not None and not index.files[url]['entries']:
+                nempty += 1
+                continue
+            out[dataset].append(url)
+            if index is None or columns is None:
+                continue
+            key = (index.path, index.files[url]['branchset'])
+            if key not in checked:
+                branches = index.branches(url)
+                # missing HLT paths are treated as not fired by TriggerMask
+                checked[key] = tuple(c for c in columns('genWeight' not in branches) if c not in branches and not c.startswith('HLT_'))
+            if checked[key]:
+                missing.setdefault(checked[key], []).append(url)
+    if missing:
+        raise ValueError('Input files without branches read by the processor:\n' + '\n'.join(
+            '%s: %d files, e.g. %s' % (' '.join(absent), len(urls), urls[0]) for absent, urls in missing.items()
+        ))
+    if nempty:
+        print('Skipping %d empty files' % nempty)
+    out = {k: v for k, v in out.items() if v}
+    metadata_cache = {}
+    for index in indexes:
+        metadata_cache.update(index.metadataCache({k: [url for url in v if url not in stale] for k, v in out.items()}))
+    return out, metadata_cache
+
+
+def column_report(p, year, selfiles, metrics):
+    read = sorted(metrics['columns'])
+    isdata = all(any(k.startswith(pd) for pd in dataset_ordering[year]) for k in selfiles)
+    declared = set(p.columns(isdata))
+    undeclared = [c for c in read if c not in declared]
+    if undeclared:
+        print('Columns read but not declared in the manifest:', ' '.join(undeclared))
+    if isdata:
+        mc = set(nanoColumns(mc_columns))
+        mc_read = [c for c in read if c in mc or c.startswith(('GenPart_', 'GenVisTau_', 'LHE'))]
+        if mc_read:
+            print('Simulation-only columns read for data:', ' '.join(mc_read))
+
+    nbytes = {}
+    for files in selfiles.values():
+        for fn in files:
+            for c, b in columnBytes(uproot.open(fn)['Events'], read).items():
+                nbytes[c] = nbytes.get(c, 0) + b
+    nchunks = max(metrics['chunks'].value, 1)
+    total = sum(nbytes.values())
+    print('%-40s %14s %12s' % ('branch', 'bytes', 'bytes/chunk'))
+    for c in sorted(nbytes, key=nbytes.get, reverse=True):
+        print('%-40s %14d %12d' % (c, nbytes[c], nbytes[c] / nchunks))
+    print('%-40s %14d %12d' % ('total (compressed baskets)', total, total / nchunks))
+    # coffea only counts the bytes read for xrootd sources
+    bytesread = metrics.get('bytesread')
+    if bytesread is not None and bytesread.value:
+        print('%-40s %14d %12d' % ('total (read from source)', bytesread.value, bytesread.value / nchunks))
+
+
+def timing_report(metrics, walltime):
+    entries = metrics['entries'].value
+    nchunks = max(metrics['chunks'].value, 1)
+    processtime = metrics['processtime'].value
+    print('%-30s %12d' % ('events', entries))
+    print('%-30s %12d' % ('chunks', metrics['chunks'].value))
+    print('%-30s %12.1f' % ('wall time [s]', walltime))
+    print('%-30s %12.1f' % ('events/s', entries / walltime if walltime > 0 else 0.))
+    print('%-30s %12.3f' % ('process time per chunk [s]', processtime / nchunks))
+    print('%-30s %12.1f' % ('events/s per worker', entries / processtime if processtime > 0 else 0.))
+
+
+def run_processor(year,selsamples,starti,endi,outname,proc='htt',filesetnames=None,executor='processes',workers=1,chunksize=100000,maxchunks=None,
+                  preread=False,report=False,cachedir=None,cachesize=10.,timing=False):
+    chunkcache = ChunkCache(cachedir, int(cachesize * 1024**3)) if cachedir else None
+    p = getattr(boostedhiggs, processors[proc])(year=year, preread=preread, chunkcache=chunkcache, timing=timing)
+
     files = {}
-    
-    with open('../data/fileset2017.json', 'r') as f:
-        newfiles = json.load(f)
-        files.update(newfiles)
-    
-    with open('../data/fileset2017UL.json', 'r') as f:
-        newfiles = json.load(f)
-        files.update(newfiles)
-    
-    with open('../data/fileset2018UL.json', 'r') as f:
-        newfiles = json.load(f)
-        files.update(newfiles)
-    
-    
+
+    filesetnames = filesetnames or filesets.get(proc, default_filesets)
+    for name in filesetnames:
+        with open('../data/%s' % name, 'r') as f:
+            newfiles = json.load(f)
+            files.update(newfiles)
+
     selfiles = {k: files[k][starti:endi] for k in selsamples}
-    
-    args = {'nano': True, 'workers': 1, 'savemetrics': True}
-    out, metrics = processor.run_uproot_job(selfiles, 'Events', p, processor.futures_executor, args)
-    
+    selfiles, metadata_cache = index_files(filesetnames, selfiles, getattr(p, 'columns', None))
+
+    executor, args = executors[executor]
+    args = dict(args, nano=True, workers=workers, savemetrics=True)
+    tic = time.time()
+    out, metrics = processor.run_uproot_job(selfiles, 'Events', p, executor, args, chunksize=chunksize, maxchunks=maxchunks, metadata_cache=metadata_cache)
+    toc = time.time()
+
     util.save(out, '%s.coffea'%outname)
+    timing_report(metrics, toc - tic)
+    if timing:
+        printTiming(out['timing'])
+    if report:
+        column_report(p, year, selfiles, metrics)
 
 
 if __name__ == "__main__":
     #ex. python run_htt.py --year 2018 --starti 0 --endi -1 --selsamples GluGluHToTauTau --outname htt_runtest
+    #ex. python run_htt.py --processor gen --workers 8 --chunksize 50000 --maxchunks 4 --year 2018 --starti 0 --endi 100 --selsamples GluGluHToTauTau --outname htt_runtest_gen
     parser = argparse.ArgumentParser()
     parser.add_argument('--year',       dest='year',       default='2017',       help="year",        type=str)
     parser.add_argument('--starti',     dest='starti',     default=0,            help="start index", type=int)
     parser.add_argument('--endi',       dest='endi',       default=-1,           help="end index",   type=int)
     parser.add_argument('--selsamples', dest='selsamples', default=[],           help='selsamples',  nargs='+')
     parser.add_argument('--outname',    dest='outname',    default='htt_test',   help='outname')
+    parser.add_argument('--processor',  dest='processor',  default='htt',        help='processor',   choices=sorted(processors))
+    parser.add_argument('--fileset',    dest='fileset',    default=None,         help='fileset json files in data/ (default depends on the processor)', nargs='+')
+    parser.add_argument('--executor',   dest='executor',   default='processes',  help='executor',    choices=sorted(executors))
+    parser.add_argument('--workers',    dest='workers',    default=1,            help='number of workers', type=int)
+    parser.add_argument('--chunksize',  dest='chunksize',  default=100000,       help='events per chunk',  type=int)
+    parser.add_argument('--maxchunks',  dest='maxchunks',  default=None,         help='maximum number of chunks per dataset', type=int)
+    parser.add_argument('--preread',    dest='preread',    action='store_true',  help='read the declared columns of each chunk in bulk')
+    parser.add_argument('--report',     dest='report',     action='store_true',  help='print the bytes read per branch and per chunk')
+    parser.add_argument('--cachedir',   dest='cachedir',   default=None,         help='local directory caching the branches read from the input files')
+    parser.add_argument('--cachesize',  dest='cachesize',  default=10.,          help='size cap of the cache in GB', type=float)
+    parser.add_argument('--timing',     dest='timing',     action='store_true',  help='time the stages of process() and print them ranked per dataset')
     args = parser.parse_args()
 
-    run_processor(args.year,args.selsamples,args.starti,args.endi,args.outname)
+    run_processor(args.year,args.selsamples,args.starti,args.endi,args.outname,args.processor,args.fileset,args.executor,args.workers,args.chunksize,args.maxchunks,
+                  args.preread,args.report,args.cachedir,args.cachesize,args.timing)
 
     possible = [
         'WW_TuneCP5_13TeV-pythia8',